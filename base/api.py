@@ -0,0 +1,206 @@
+# -*- encoding: utf-8 -*-
+""" JSON data API
+
+/api/v1/status, /api/v1/pilot, /api/v1/skills, /api/v1/skillqueue,
+/api/v1/implants and /api/v1/alts run the same data plans as the pages
+and return compact JSON instead of HTML. /api/v1/incursions serves the
+incursion tracker snapshot and its change feed, /api/v1/standings the
+standings store, /api/v1/sp/history and /api/v1/sp/rates the SP history.
+
+Every JSON response carries a strong ETag (a digest of the payload, so
+it changes exactly when the snapshot does) and a Cache-Control max-age
+up to the earliest ESI expiry of the data it was built from. Until that
+expiry the plan would only read the same cached ESI responses again, so
+the ETag given for a route, pilot and arguments is remembered with it:
+a request with that ETag in If-None-Match gets its 304 before the plan
+runs (not_modified). After the expiry the plan runs as usual, and the
+304 of an unchanged payload only saves the body.
+
+Streamed responses are the exception: /api/v1/export/<dataset> (NDJSON
+or CSV, see export.py) and the fleet invite outcomes (json_line) are
+sent as they are produced, without an ETag or max-age.
+"""
+from flask import Response
+from flask import request
+
+from incursions import EVENT_KINDS
+from incursions import STATES
+
+import hashlib
+import json
+import threading
+import time
+
+API_VERSION = 1
+
+# (route, pilot, arguments) -> (ETag, expires) of the last response
+MAX_VALIDATORS = 4096
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+# -----------------------------------------------------------------------
+# Payloads
+# -----------------------------------------------------------------------
+def server_payload(ctx):
+    status = ctx['server_status']
+    if status is None or status.status != 200:
+        return None
+    return {
+        'players': status.data.players,
+        'version': status.data.server_version,
+        'start_time': status.data.start_time,
+    }
+
+
+def character_payload(ctx):
+    character = ctx['current_character'].data
+    corporation = ctx['current_corporation']
+    return {
+        'id': ctx['character_id'],
+        'name': ctx['user'].character_name,
+        'birthday': character.birthday,
+        'security_status': character.security_status,
+        'corporation_id': character.corporation_id,
+        'corporation_ticker': (
+            corporation.data.ticker if corporation.status == 200 else None
+        ),
+        'alliance_id': character.alliance_id,
+    }
+
+
+def location_payload(ctx):
+    return {
+        'online': ctx['online'].data.online,
+        'system': ctx['location_solar_name'].data.name,
+        'system_id': ctx['location'].data.solar_system_id,
+        'docked': ctx['dock_status'] if ctx['dock'] is not None else None,
+        'fleet_id': ctx['fleet_id'] or None,
+    }
+
+
+def ship_payload(ctx, ship_roles):
+    ship_type = ctx['ship_type'].data
+    return {
+        'name': ctx['ship'].data.ship_name,
+        'type_id': ctx['ship'].data.ship_type_id,
+        'type': ship_type.name,
+        'class': ctx['ship_class'].data.name,
+        'role': ship_roles.get(ship_type.name),
+    }
+
+
+def implants_payload(ctx):
+    return [
+        {'id': implant_id, 'name': implant.data.name}
+        for implant_id, implant in zip(ctx['implants'].data, ctx['implant_types'])
+    ]
+
+
+def skills_payload(ctx, slots=6):
+    """ the first `slots` queue entries, /api/v1/skillqueue has them all """
+    skills = ctx['skills'].data
+    queue = ctx['skill_queue']
+    finish_dates = dict(
+        (entry.queue_position, entry.finish_date) for entry in ctx['skillqueue'].data
+    )
+    return {
+        'total_sp': skills.total_sp,
+        'unallocated_sp': skills.unallocated_sp,
+        'queue_length': len(queue),
+        'queue_end': queue.end,
+        'queue': [
+            {
+                'skill_id': entry.skill_id,
+                'name': entry.name,
+                'level': entry.level,
+                'finish_date': finish_dates.get(entry.position),
+            }
+            for entry in queue.entries[:slots]
+        ],
+    }
+
+
+def incursions_payload(tracker, after=0, limit=100):
+    """ current incursions and the feed events after `after` """
+    incursions = tracker.current()
+    feed = tracker.feed(after, limit)
+    feed['states'] = STATES
+    feed['kinds'] = EVENT_KINDS
+    return {
+        'polled_at': tracker.polled_at(),
+        'incursions': incursions,
+        'feed': feed,
+    }
+
+
+def freshness(ctx):
+    """ stale / unavailable markers, only present while ESI is in trouble """
+    markers = {}
+    if ctx['stale_as_of'] is not None:
+        markers['stale_as_of'] = int(ctx['stale_as_of'])
+    if ctx['esi_unavailable']:
+        markers['esi_unavailable'] = True
+    return markers
+
+
+# -----------------------------------------------------------------------
+# Responses
+# -----------------------------------------------------------------------
+def json_line(payload):
+    """ one line of a newline delimited JSON stream """
+    return json.dumps(payload, separators=(',', ':'), sort_keys=True, default=str) + '\n'
+
+
+def cache_headers(response, expires, private):
+    max_age = 0
+    if expires is not None:
+        max_age = max(0, int(expires - time.time()))
+    response.cache_control.max_age = max_age
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+
+def not_modified(key, private=True):
+    """ a 304 if the client sent the ETag last given for `key` and the data
+    it was built from has not expired yet, without running the plan;
+    None otherwise """
+    if not request.if_none_match:
+        return None
+    validator = _validators.get(key)
+    if validator is None or validator[1] <= time.time():
+        return None
+    if not request.if_none_match.contains(validator[0]):
+        return None
+    response = Response(status=304)
+    response.set_etag(validator[0])
+    return cache_headers(response, validator[1], private)
+
+
+def remember(key, etag, expires):
+    now = time.time()
+    with _validators_lock:
+        if len(_validators) >= MAX_VALIDATORS:
+            for old in [k for k, v in _validators.items() if v[1] <= now]:
+                del _validators[old]
+            if len(_validators) >= MAX_VALIDATORS:
+                _validators.clear()
+        _validators[key] = (etag, expires)
+
+
+def json_response(payload, expires=None, private=True, key=None):
+    """ compact JSON with a strong ETag and a max-age up to `expires`,
+    304 when the client already has this version; the ETag is remembered
+    for not_modified(`key`) until `expires` """
+    payload = dict(payload, v=API_VERSION)
+    body = json.dumps(payload, separators=(',', ':'), sort_keys=True, default=str)
+    response = Response(body, mimetype='application/json')
+    etag = hashlib.sha1(body.encode()).hexdigest()
+    response.set_etag(etag)
+    if key is not None and expires is not None and expires > time.time():
+        remember(key, etag, expires)
+    cache_headers(response, expires, private)
+    return response.make_conditional(request)
@@ -2,11 +2,14 @@
 from datetime import datetime
 from tokenize import Floatnumber, Number
 
+from esipy import App
 from esipy import EsiApp
 from esipy import EsiClient
 from esipy import EsiSecurity
 
 from flask import Flask
+from flask import Response
+from flask import jsonify
 from flask import render_template
 from flask import request
 from flask import session
@@ -20,15 +23,48 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm.exc import NoResultFound
 
 import config
+import copy
+import dataclasses
+import json
 import logging
 import time
 import urllib.parse
 
 #import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import create_engine, Column, BigInteger, Index, Integer, LargeBinary, SmallInteger, String, Text, DateTime
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
 
+from breaker import BreakerBoard
+from dataplan import DataPlan
+from dataplan import Fetch
+from dataplan import PlanRunner
+from dataplan import RowWriteFilter
+from dataplan import Section
+from dto import slim
+from entities import EntityStore
+from export import DATASETS as EXPORT_DATASETS
+from export import FORMATS as EXPORT_FORMATS
+from export import Exporter
+from fleetinvite import FleetInviter
+from fleetinvite import assign
+from fragments import FragmentCache
+from health import HealthMonitor
+from incursions import IncursionTracker
+from names import NameStore
+from notifications import Publisher
+from notifications import RedisMailbox
+from profiler import RequestProfiler
+from roster import Roster
+from skillqueue import SkillQueues
+from sphistory import SpHistory
+from standings import DEFAULT_THRESHOLDS
+from standings import StandingsStore
+
+import api
+import metrics
+
 # logger stuff
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter(
@@ -42,6 +78,7 @@ logger.addHandler(console)
 # init app and load conf
 app = Flask(__name__)
 app.config.from_object(config)
+fragment_cache = FragmentCache(app)
 @app.errorhandler(404)
 def not_found(e):
     return render_template("404.html")
@@ -70,10 +107,12 @@ class User(db.Model, UserMixin):
     )
     character_owner_hash = db.Column(db.String(255))
     character_name = db.Column(db.String(200))
+    # linked characters (alts) share the character ID of the main one
+    account_id = db.Column(db.BigInteger, index=True)
 
     # SSO Token stuff
     access_token = db.Column(db.String(4096))
-    access_token_expires = db.Column(db.DateTime())
+    access_token_expires = db.Column(db.DateTime(), index=True)
     refresh_token = db.Column(db.String(100))
 
     def get_id(self):
@@ -102,6 +141,11 @@ class User(db.Model, UserMixin):
 
 class Characters(Base):
     __tablename__ = 'characters'
+    __table_args__ = (
+        # roster pages, keyset paginated on the id
+        Index('ix_characters_corporation_id_id', 'corporation_id', 'id'),
+        Index('ix_characters_alliance_id_id', 'alliance_id', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(64))
     birthday = Column(String(32))
@@ -128,17 +172,116 @@ class CharacterStatus(Base):
     id = Column(Integer, primary_key=True)
     online = Column(String(8))
     location = Column(String(64))
+    system_id = Column(Integer, index=True)
     fleet = Column(String(8))
     docked = Column(String(64))
-    last_updated = Column(DateTime(timezone=True), onupdate=func.now())
+    ship_type = Column(String(64))
+    role = Column(String(16))
+    last_updated = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now(), index=True)
+    def __repr__(self):
+        return "<CharacterStatus(id='%s', online='%s', location='%s', system_id='%s', fleet='%s', docked='%s', ship_type='%s', role='%s', last_updated='%s')>" % (
+            self.id, self.online, self.location, self.system_id, self.fleet, self.docked, self.ship_type, self.role, self.last_updated)
+
+class Entities(Base):
+    __tablename__ = 'entities'
+    entity_type = Column(String(16), primary_key=True)
+    entity_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    status = Column(Integer)
+    data = Column(Text)
+    expires = Column(DateTime, index=True)
+    def __repr__(self):
+        return "<Entities(entity_type='%s', entity_id='%s', status='%s', expires='%s')>" % (
+            self.entity_type, self.entity_id, self.status, self.expires)
+
+class Names(Base):
+    __tablename__ = 'names'
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    name = Column(String(128))
+    category = Column(String(32))
+    def __repr__(self):
+        return "<Names(id='%s', name='%s', category='%s')>" % (
+            self.id, self.name, self.category)
+
+class Standings(Base):
+    __tablename__ = 'standings'
+    __table_args__ = (
+        # pilots below a standing toward a faction
+        Index('ix_standings_from_id_standing', 'from_id', 'standing'),
+    )
+    character_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    from_id = Column(Integer, primary_key=True, autoincrement=False)
+    from_type = Column(SmallInteger)
+    standing = Column(SmallInteger)
+    def __repr__(self):
+        return "<Standings(character_id='%s', from_id='%s', from_type='%s', standing='%s')>" % (
+            self.character_id, self.from_id, self.from_type, self.standing)
+
+class SkillPoints(Base):
+    __tablename__ = 'skill_points'
+    character_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    at = Column(Integer, primary_key=True, autoincrement=False)
+    total_sp = Column(BigInteger)
+    unallocated_sp = Column(BigInteger)
     def __repr__(self):
-        return "<CharacterStatus(id='%s', online='%s', location='%s', fleet='%s', docked='%s', last_updated='%s')>" % (
-            self.id, self.online, self.location, self.fleet, self.docked, self.last_updated)
+        return "<SkillPoints(character_id='%s', at='%s', total_sp='%s', unallocated_sp='%s')>" % (
+            self.character_id, self.at, self.total_sp, self.unallocated_sp)
+
+class SkillPointsArchive(Base):
+    __tablename__ = 'skill_points_archive'
+    character_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    start = Column(Integer, primary_key=True, autoincrement=False)
+    end = Column(Integer)
+    count = Column(Integer)
+    data = Column(LargeBinary)
+    def __repr__(self):
+        return "<SkillPointsArchive(character_id='%s', start='%s', end='%s', count='%s')>" % (
+            self.character_id, self.start, self.end, self.count)
+
+class IncursionSnapshots(Base):
+    __tablename__ = 'incursion_snapshots'
+    __table_args__ = (
+        # influence history of a constellation
+        Index('ix_incursion_snapshots_constellation_id_polled_at',
+              'constellation_id', 'polled_at'),
+    )
+    polled_at = Column(Integer, primary_key=True, autoincrement=False)
+    constellation_id = Column(Integer, primary_key=True, autoincrement=False)
+    staging_system_id = Column(Integer)
+    state = Column(SmallInteger)
+    influence = Column(SmallInteger)
+    has_boss = Column(SmallInteger)
+    def __repr__(self):
+        return "<IncursionSnapshots(polled_at='%s', constellation_id='%s', state='%s', influence='%s', has_boss='%s')>" % (
+            self.polled_at, self.constellation_id, self.state, self.influence, self.has_boss)
+
+class IncursionPolls(Base):
+    __tablename__ = 'incursion_polls'
+    polled_at = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(SmallInteger)
+    def __repr__(self):
+        return "<IncursionPolls(polled_at='%s', count='%s')>" % (
+            self.polled_at, self.count)
+
+class IncursionEvents(Base):
+    __tablename__ = 'incursion_events'
+    id = Column(Integer, primary_key=True)
+    at = Column(Integer)
+    kind = Column(SmallInteger)
+    constellation_id = Column(Integer)
+    staging_system_id = Column(Integer)
+    state = Column(SmallInteger)
+    previous_state = Column(SmallInteger)
+    influence = Column(SmallInteger)
+    has_boss = Column(SmallInteger)
+    def __repr__(self):
+        return "<IncursionEvents(id='%s', at='%s', kind='%s', constellation_id='%s', state='%s')>" % (
+            self.id, self.at, self.kind, self.constellation_id, self.state)
 
 # -----------------------------------------------------------------------
 # Create Database tables
 # -----------------------------------------------------------------------
 Base.metadata.create_all(engine)
+DataSession = sessionmaker(bind=engine)
 
 # -----------------------------------------------------------------------
 # Flask Login requirements
@@ -151,14 +294,20 @@ def load_user(character_id):
 # -----------------------------------------------------------------------
 # ESIPY Init
 # -----------------------------------------------------------------------
-# create the app
-esiapp = EsiApp().get_latest_swagger
+# create the app, from a local swagger spec (e.g. the bench stand-in) if set
+if app.config.get('ESI_SWAGGER_URL'):
+    esiapp = App.create(app.config['ESI_SWAGGER_URL'])
+else:
+    esiapp = EsiApp().get_latest_swagger
 
 # init the security object
 esisecurity = EsiSecurity(
     redirect_uri=config.ESI_CALLBACK,
     client_id=config.ESI_CLIENT_ID,
     secret_key=config.ESI_SECRET_KEY,
+    sso_endpoints_url='%s/.well-known/oauth-authorization-server' % app.config.get(
+        'ESI_SSO_URL', 'https://login.eveonline.com'
+    ),
     headers={'User-Agent': config.ESI_USER_AGENT}
 )
 
@@ -166,8 +315,12 @@ esisecurity = EsiSecurity(
 esiclient = EsiClient(
     security=esisecurity,
     cache=None,
-    headers={'User-Agent': config.ESI_USER_AGENT}
+    headers={'User-Agent': config.ESI_USER_AGENT},
+    timeout=app.config.get('ESI_TIMEOUT', 10),
 )
+# a local swagger spec (the bench stand-in) may be served over plain http
+if (app.config.get('ESI_SWAGGER_URL') or '').startswith('http://'):
+    esiclient.__schemes__ = set(['http', 'https'])
 
 # -----------------------------------------------------------------------
 # Configure global variables
@@ -178,986 +331,921 @@ sniper = ('Nightmare','Paladin','Vargur','Machariel')
 logi = ('Scimitar','Basilsk','Loki')
 support = ('Nestor','Claymore','Vulture','Proteus')
 transport = ('Crane','Viator','Bowhead')
+fleet_roles = {
+    'dps': dps,
+    'sniper': sniper,
+    'logi': logi,
+    'support': support,
+    'transport': transport,
+}
+# ship name -> fleet role
+ship_roles = dict(
+    (ship, role) for role, ships in fleet_roles.items() for ship in ships
+)
 
-# -----------------------------------------------------------------------
-# Index Redirect to Main
-# -----------------------------------------------------------------------
-@app.route('/')
-def index():
-    server_status = None
-    current_character = None
-    current_corporation = None
+# Incursions, recorded by the worker (see incursions.py)
+incursion_tracker = IncursionTracker(
+    DataSession, IncursionSnapshots, IncursionEvents, IncursionPolls,
+    keep=app.config.get('INCURSION_HISTORY_DAYS', 30),
+)
 
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
+# Fleet notifications, sent by the worker (see notifications.py)
+notifier = Publisher(
+    RedisMailbox(url=app.config['REDIS_URL'])
+    if app.config.get('REDIS_URL') and app.config.get('NOTIFY_WEBHOOKS') else None
+)
 
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
-        
-        op = esiapp.op['get_characters_character_id'](
-        character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-    
-    return render_template('main_redirect.html', **{
-        'server_status': server_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation
-    })
+# Number of implant slots and skill queue entries shown on the pages
+IMPLANT_SLOTS = 10
+SKILLQUEUE_SLOTS = 6
+
+# Names of skills (and other IDs) from a local store, see names.py
+def request_names(ids):
+    response = planner.request('post_universe_names', {'ids': ids})
+    return slim('post_universe_names', response)
+
+name_store = NameStore(
+    Names, DataSession, request=request_names,
+    negative_ttl=app.config.get('NAMES_NEGATIVE_TTL', 3600),
+)
+name_store.load()
+skill_queues = SkillQueues(name_store)
+
+# Standings, refreshed by the poller (see standings.py)
+standings_store = StandingsStore(Standings, DataSession)
+
+# Skill point history, recorded where the skills are read (see sphistory.py)
+sp_history = SpHistory(SkillPoints, SkillPointsArchive, DataSession)
 
 # -----------------------------------------------------------------------
-# Main Routes
+# Page data sections
 # -----------------------------------------------------------------------
-@app.route('/main')
-def main():
-    server_status = None
-    online = None
-    current_character = None
-    location = None
-    location_solar_name = None
-    current_corporation = None
+def character_params(ctx):
+    return {'character_id': ctx['character_id']}
+
+def build_character(ctx):
+    return {
+        'current_corp_url': urllib.parse.quote(
+            ctx['current_corporation'].data.url or '', safe='/:'
+        ),
+    }
+
+def persist_character(ctx):
+    current_character = ctx['current_character']
+    return [Characters(
+        id=ctx['character_id'],
+        name=ctx['user'].character_name,
+        birthday=str(current_character.data.birthday),
+        corporation_id=current_character.data.corporation_id,
+        alliance_id=current_character.data.alliance_id,
+        security_status=current_character.data.security_status,
+        description=current_character.data.description)]
+
+def build_location(ctx):
+    dock = ctx['dock_structure'] or ctx['dock_station']
+    if dock is None:
+        dock_status = "No"
+    elif dock.status != 200:
+        # a structure this pilot has no access to
+        dock_status = "Unknown structure"
+    else:
+        dock_status = dock.data.name
+    return {
+        'dock': dock,
+        'dock_status': dock_status,
+    }
 
+def build_fleet(ctx):
+    fleet = ctx['fleet']
+    if fleet.data is not None and fleet.data.role == 'fleet_commander':
+        notifier.fleet_formed(
+            fleet.data.fleet_id, ctx['character_id'], ctx['user'].character_name
+        )
+    return {
+        'fleet_id': fleet.data.fleet_id if fleet.data is not None else '',
+    }
+
+def persist_pilot_status(ctx):
+    ship_type = ctx['ship_type'].data.name
+    return [CharacterStatus(
+        id=ctx['character_id'],
+        online=ctx['online'].data.online,
+        location=ctx['location_solar_name'].data.name,
+        system_id=ctx['location'].data.solar_system_id,
+        fleet=ctx['fleet_id'],
+        docked=ctx['dock_status'],
+        ship_type=ship_type,
+        role=ship_roles.get(ship_type))]
+
+def poll_status(ctx, endpoints):
+    """ CharacterStatus columns of the endpoints the poller fetched, see
+    poller.py """
+    values = {}
+    if 'online' in endpoints and ctx['online'].status == 200:
+        values['online'] = ctx['online'].data.online
+    if 'location' in endpoints and ctx['location'].status == 200:
+        values['location'] = ctx['location_solar_name'].data.name
+        values['system_id'] = ctx['location'].data.solar_system_id
+        values['docked'] = build_location(ctx)['dock_status']
+    if 'ship' in endpoints and ctx['ship'].status == 200:
+        ship_type = ctx['ship_type'].data.name
+        values['ship_type'] = ship_type
+        values['role'] = ship_roles.get(ship_type)
+    if 'fleet' in endpoints and ctx['fleet'].status in (200, 404):
+        # 404: not in a fleet
+        values['fleet'] = build_fleet(ctx)['fleet_id']
+    if 'standings' in endpoints and ctx['standings'].status == 200:
+        # not a CharacterStatus column, the store replaces them itself
+        standings_store.update(ctx['character_id'], ctx['standings'].data)
+    if 'skills' in endpoints and ctx['skills'].status == 200:
+        # the skills table is the pages' business, only the history here
+        skills = ctx['skills'].data
+        sp_history.record(ctx['character_id'], skills.total_sp, skills.unallocated_sp)
+    if not values:
+        return []
+    return [CharacterStatus(id=ctx['character_id'], **values)]
+
+def build_implants(ctx):
+    implant_names = []
+    implant_ids = []
+    for slot in range(IMPLANT_SLOTS):
+        if slot < len(ctx['implant_types']):
+            implant_names.append(ctx['implant_types'][slot])
+            implant_ids.append({'data': {'id': ctx['implants'].data[slot]}})
+        else:
+            implant_names.append({'data': {'name': '< EMPTY SLOT >'}})
+            implant_ids.append({'data': {'id': '0'}})
+
+    # Implant Bonus check
+    # - Ascendancy
+    # - Saviour
+    # Skill Hardwiring - Slot: 6 - 10
+    # - Hybrid
+    # - Laser
+    # - Projectile
+    # - Logistics
+    # - muppet
+    return {
+        'implant_names': implant_names,
+        'implant_ids': implant_ids,
+        'implant_set_bonus': "Shit",
+    }
+
+def build_skills(ctx):
+    skill_queue = skill_queues.get(ctx['character_id'], ctx['skillqueue'])
+    values = {
+        'skill_queue': skill_queue,
+        'skillqueue_total': len(skill_queue),
+    }
+    for slot in range(SKILLQUEUE_SLOTS):
+        if slot < len(skill_queue):
+            entry = skill_queue.entries[slot]
+            values['skillqueue_%d_name' % slot] = entry.name or entry.skill_id
+            values['skillqueue_%d_level' % slot] = entry.level
+        else:
+            values['skillqueue_%d_name' % slot] = "  < empty >"
+            values['skillqueue_%d_level' % slot] = ""
+    return values
+
+def build_incursions(ctx):
+    system_names = dict(
+        (system.data.system_id, system.data.name)
+        for system in ctx['incursion_systems'] if system.status == 200
+    )
+    return {
+        'incursions': [
+            dict(incursion, staging_system=system_names.get(incursion['staging_system_id']))
+            for incursion in incursion_tracker.current()
+        ],
+        'incursions_polled_at': incursion_tracker.polled_at(),
+    }
+
+def persist_skills(ctx):
+    skills = ctx['skills']
+    sp_history.record(ctx['character_id'], skills.data.total_sp, skills.data.unallocated_sp)
+    return [Skills(
+        id=ctx['character_id'],
+        skills=json.dumps([dataclasses.asdict(skill) for skill in skills.data.skills]),
+        total_sp=skills.data.total_sp,
+        unallocated_sp=skills.data.unallocated_sp)]
+
+sections = dict((section.name, section) for section in (
     # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
+    Section('server_status', auth=False, stages=[
+        [Fetch('server_status', 'get_status')],
+    ]),
+    # Pilot and pilot corporation
+    Section('character', stages=[
+        [Fetch('current_character', 'get_characters_character_id', character_params)],
+        [Fetch('current_corporation', 'get_corporations_corporation_id',
+               lambda ctx: {'corporation_id': ctx['current_character'].data.corporation_id})],
+    ], build=build_character, persist=persist_character),
+    # Pilot status, location and dock
+    Section('location', stages=[
+        [Fetch('online', 'get_characters_character_id_online', character_params),
+         Fetch('location', 'get_characters_character_id_location', character_params)],
+        [Fetch('location_solar_name', 'get_universe_systems_system_id',
+               lambda ctx: {'system_id': ctx['location'].data.solar_system_id}),
+         Fetch('dock_structure', 'get_universe_structures_structure_id',
+               lambda ctx: {'structure_id': ctx['location'].data.structure_id},
+               when=lambda ctx: ctx['location'].data.structure_id is not None),
+         Fetch('dock_station', 'get_universe_stations_station_id',
+               lambda ctx: {'station_id': ctx['location'].data.station_id},
+               when=lambda ctx: ctx['location'].data.structure_id is None
+                                and ctx['location'].data.station_id is not None)],
+    ], build=build_location),
+    # Fleet
+    Section('fleet', stages=[
+        [Fetch('fleet', 'get_characters_character_id_fleet', character_params)],
+    ], build=build_fleet),
+    # Saved pilot status, needs the location, the fleet and the ship
+    Section('pilot_status', requires=('location', 'fleet', 'ship'),
+            persist=persist_pilot_status),
+    # Ship and Fittings
+    Section('ship', stages=[
+        [Fetch('ship', 'get_characters_character_id_ship', character_params)],
+        [Fetch('ship_type', 'get_universe_types_type_id',
+               lambda ctx: {'type_id': ctx['ship'].data.ship_type_id})],
+        [Fetch('ship_class', 'get_universe_groups_group_id',
+               lambda ctx: {'group_id': ctx['ship_type'].data.group_id})],
+    ]),
+    # Clone implants
+    Section('implants', stages=[
+        [Fetch('implants', 'get_characters_character_id_implants', character_params)],
+        [Fetch('implant_types', 'get_universe_types_type_id', many=True,
+               params=lambda ctx: [
+                   {'type_id': type_id}
+                   for type_id in ctx['implants'].data[:IMPLANT_SLOTS]
+               ])],
+    ], build=build_implants),
+    # Pilot Skills and Skill Queue
+    Section('skills', stages=[
+        [Fetch('skills', 'get_characters_character_id_skills', character_params),
+         Fetch('skillqueue', 'get_characters_character_id_skillqueue', character_params)],
+    ], build=build_skills, persist=persist_skills),
+    # Incursions status, from the tracker snapshot: only the staging
+    # system names come from ESI
+    Section('incursions', auth=False, stages=[
+        [Fetch('incursion_systems', 'get_universe_systems_system_id', many=True,
+               params=lambda ctx: [
+                   {'system_id': incursion['staging_system_id']}
+                   for incursion in incursion_tracker.current()
+               ])],
+    ], build=build_incursions),
+))
+
+# -----------------------------------------------------------------------
+# Page data plans
+# -----------------------------------------------------------------------
+header_sections = ('server_status', 'character')
+
+plans = {
+    'index': DataPlan('index', 'main_redirect.html', header_sections,
+                      sections, persist=False),
+    'main': DataPlan('main', 'main.html', header_sections + (
+        'location', 'incursions'), sections, persist=False),
+    'redir_implants': DataPlan('redir_implants', 'implants_redirect.html',
+                               header_sections, sections, persist=False),
+    'implants': DataPlan('implants', 'implants.html', header_sections + (
+        'pilot_status', 'implants', 'ship'), sections),
+    'redir_skills': DataPlan('redir_skills', 'skills_redirect.html',
+                             header_sections, sections, persist=False),
+    'skills': DataPlan('skills', 'skills.html', header_sections + (
+        'skills',), sections),
+    'redir_pilot': DataPlan('redir_pilot', 'pilot_redirect.html',
+                            header_sections, sections, persist=False),
+    'pilot': DataPlan('pilot', 'pilot.html', header_sections + (
+        'pilot_status', 'implants', 'ship', 'skills', 'incursions'), sections),
+    # run for all the linked characters at once, see run_linked
+    'alts': DataPlan('alts', 'alts.html', header_sections + (
+        'pilot_status', 'ship'), sections),
+    # JSON API only
+    'api_status': DataPlan('api_status', None, (
+        'server_status', 'location', 'fleet'), sections, persist=False),
+}
+
+entity_store = EntityStore(
+    Entities, DataSession,
+    ttl=app.config.get('ENTITY_TTL'),
+    negative_ttl=app.config.get('ENTITY_NEGATIVE_TTL'),
+)
+entity_store.load()
+planner = PlanRunner(
+    esiapp, esiclient, DataSession,
+    entities=entity_store,
+    breakers=BreakerBoard(
+        failures=app.config.get('ESI_BREAKER_FAILURES', 5),
+        reset_timeout=app.config.get('ESI_BREAKER_RESET', 30),
+    ),
+    writes=RowWriteFilter(
+        touch_interval=app.config.get('PERSIST_TOUCH_INTERVAL', 60),
+    ),
+)
+metrics.init_app(app, planner, plans)
+with app.app_context():
+    profiler = RequestProfiler(app, engines=(engine, db.engine))
 
+def run_plan(plan):
+    """ run a data plan for the current user, returns its context """
+    user = None
     if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
+        user = current_user._get_current_object()
+        esisecurity.update_token(user.get_sso_data())
+    return planner.run(plan, user, hooks=profiler.hooks())
+
+def linked_characters(user):
+    """ `user` first, then the characters linked to its account by name """
+    if user.account_id is None:
+        return [user]
+    return [user] + User.query.filter(
+        User.account_id == user.account_id,
+        User.character_id != user.character_id,
+    ).order_by(User.character_name).all()
+
+def client_for(user):
+    """ an ESI client with the token of `user`, sharing the connection
+    pool of esiclient, so pilots can be fetched side by side """
+    security = copy.copy(esisecurity)
+    security.update_token(user.get_sso_data())
+    client = copy.copy(esiclient)
+    client.security = security
+    # pyswagger keeps its own (name mangled) reference for the auth header
+    client._BaseClient__security = security
+    # and esipy binds request (or its retrying version) to the instance
+    client.request = getattr(client, esiclient.request.__name__)
+    return client
+
+def run_linked(plan, users=None):
+    """ run a data plan for the current user and its linked characters in
+    one go, returns their contexts, the current user first """
+    if users is None:
+        users = linked_characters(current_user._get_current_object())
+    return planner.run_many(
+        plan, users, [client_for(user) for user in users],
+        hooks=profiler.hooks(),
+    )
 
-        # Pilot status and location
-        op = esiapp.op['get_characters_character_id_online'](
-            character_id=current_user.character_id
-        )
-        online = esiclient.request(op)
-        op = esiapp.op['get_characters_character_id_location'](
-            character_id=current_user.character_id
-        )
-        location = esiclient.request(op)
-        op = esiapp.op['get_universe_systems_system_id'](
-            system_id=location.data.solar_system_id
-        )
-        location_solar_name = esiclient.request(op)
-        op = esiapp.op['get_characters_character_id'](
-            character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
+def render_plan(plan, **extra):
+    """ run a page data plan for the current user and render its template """
+    page = run_plan(plan)
+    page.update(extra)
+    return render_template(plan.template, **page)
 
-        # Pilot corporation
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-        current_corp_url = urllib.parse.quote(current_corporation.data.url, safe='/:')
-        
-
-        # Incursions status
-        op = esiapp.op['get_incursions']()
-        incursions = esiclient.request(op)
-
-
-    return render_template('main.html', **{
-        'server_status': server_status,
-        'online': online,
-        'current_character': current_character,
-        'current_corporation': current_corporation,
-        'current_corp_url': current_corp_url,
-        'location': location,
-        'location_solar_name': location_solar_name,
-    })
+# -----------------------------------------------------------------------
+# Health Routes
+# -----------------------------------------------------------------------
+health_monitor = HealthMonitor(
+    engine,
+    esiapp,
+    redis_url=app.config.get('REDIS_URL'),
+    interval=app.config.get('HEALTH_CHECK_INTERVAL', 10),
+    max_snapshot_age=app.config.get('HEALTH_MAX_SNAPSHOT_AGE'),
+)
+health_monitor.start()
+
+def after_fork():
+    """ gunicorn --preload: give each worker its own connections and
+    health thread, see gunicorn.conf.py """
+    engine.dispose(close=False)
+    with app.app_context():
+        db.engine.dispose(close=False)
+    health_monitor.start()
+
+@app.route('/healthz')
+def healthz():
+    """ liveness: the process answers, nothing else is checked """
+    return jsonify(health_monitor.liveness())
+
+@app.route('/readyz')
+def readyz():
+    """ readiness: last result of the background health checks """
+    ready, report = health_monitor.readiness()
+    return jsonify(report), 200 if ready else 503
 
 # -----------------------------------------------------------------------
-# Implant Routes
+# Roster Routes
 # -----------------------------------------------------------------------
-@app.route('/redir_implants')
-def redir_implants():
-    server_status = None
-    current_character = None
-    current_corporation = None
+roster = Roster(
+    DataSession, Characters, CharacterStatus,
+    max_limit=app.config.get('ROSTER_MAX_PAGE', 500),
+)
 
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
+@app.route('/roster')
+def roster_page():
+    """ registered pilots of the current pilot's corporation, or alliance
+    with ?scope=alliance; page with ?after=<next>&limit=N """
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'login required'}), 401
+    session = DataSession()
+    try:
+        character = session.get(Characters, current_user.character_id)
+    finally:
+        session.close()
+    if character is None:
+        return jsonify({'error': 'pilot not seen yet'}), 404
+
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', app.config.get('ROSTER_PAGE', 200)))
+    except ValueError:
+        return jsonify({'error': 'after and limit must be integers'}), 400
+    if request.args.get('scope') == 'alliance':
+        if character.alliance_id is None:
+            return jsonify({'error': 'pilot is not in an alliance'}), 404
+        page = roster.page(alliance_id=character.alliance_id, after=after, limit=limit)
+    else:
+        page = roster.page(corporation_id=character.corporation_id, after=after, limit=limit)
+    return jsonify(page)
 
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
-        
-        op = esiapp.op['get_characters_character_id'](
-        character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-    
-    return render_template('implants_redirect.html', **{
-        'server_status': server_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation
-    })
+# -----------------------------------------------------------------------
+# Export Routes
+# -----------------------------------------------------------------------
+exporter = Exporter(
+    DataSession, Characters, CharacterStatus, Skills, names=name_store,
+    yield_per=app.config.get('EXPORT_YIELD_PER', 500),
+    chunk_size=app.config.get('EXPORT_CHUNK_SIZE', 65536),
+)
 
-@app.route('/implants')
-def implants():
-    server_status = None
-    online = None
-    current_character = None
-    location = None
-    location_solar_name = None
-    dock = None
-    dock_status = None
-    current_corporation = None
-    current_corp_url = None
-    fleet = None
-    implant_names = []
-    implant_ids = []
-    implant_set_bonus = None
-    ship = None
-    ship_type = None
-    ship_class = None
-    fleet_id = None
-    incursions = None
+@app.route('/api/v%d/export/<dataset>' % api.API_VERSION)
+def api_export(dataset):
+    """ streams a dataset of export.py for the current pilot's corporation,
+    or alliance with ?scope=alliance; ?format=ndjson|csv, ?gzip=1 """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({'error': 'unknown dataset', 'datasets': sorted(EXPORT_DATASETS)}), 404
+    format = request.args.get('format', 'ndjson')
+    if format not in EXPORT_FORMATS:
+        return jsonify({'error': 'format must be one of %s' % ', '.join(EXPORT_FORMATS)}), 400
+    session = DataSession()
+    try:
+        character = session.get(Characters, current_user.character_id)
+    finally:
+        session.close()
+    if character is None:
+        return jsonify({'error': 'pilot not seen yet'}), 404
+
+    if request.args.get('scope') == 'alliance':
+        if character.alliance_id is None:
+            return jsonify({'error': 'pilot is not in an alliance'}), 404
+        scope = {'alliance_id': character.alliance_id}
+    else:
+        scope = {'corporation_id': character.corporation_id}
+    compress = request.args.get('gzip') in ('1', 'true')
+    filename = '%s-%s.%s' % (dataset, time.strftime('%Y%m%d-%H%M%S', time.gmtime()), format)
+    if compress:
+        filename += '.gz'
+    response = Response(
+        exporter.stream(dataset, format, compress, **scope),
+        mimetype='application/gzip' if compress else EXPORT_FORMATS[format],
+    )
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response.headers['Cache-Control'] = 'private, no-store'
+    # no proxy buffering, the first rows are on their way at once
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
+# -----------------------------------------------------------------------
+# JSON API Routes
+# -----------------------------------------------------------------------
+def api_login_required():
+    return api.json_response({'error': 'login required'}), 401
+
+def fresh_key(key, *ctxs):
+    """ `key` to remember the response by, None while ESI is in trouble:
+    a stale or degraded payload changes as soon as ESI is back """
+    if any(ctx['stale_as_of'] is not None or ctx['esi_unavailable'] for ctx in ctxs):
+        return None
+    return key
+
+@app.route('/api/v%d/status' % api.API_VERSION)
+def api_status():
+    private = current_user.is_authenticated
+    key = ('status', current_user.character_id if private else None)
+    cached = api.not_modified(key, private)
+    if cached is not None:
+        return cached
+    plan = plans['api_status']
+    ctx = run_plan(plan)
+    payload = {'server': api.server_payload(ctx)}
+    if ctx['user'] is not None:
+        payload['pilot'] = api.location_payload(ctx)
+    payload.update(api.freshness(ctx))
+    return api.json_response(
+        payload, plan.expiry(ctx), private=private, key=fresh_key(key, ctx)
+    )
 
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
+@app.route('/api/v%d/pilot' % api.API_VERSION)
+def api_pilot():
+    if not current_user.is_authenticated:
+        return api_login_required()
+    key = ('pilot', current_user.character_id)
+    cached = api.not_modified(key)
+    if cached is not None:
+        return cached
+    plan = plans['pilot']
+    ctx = run_plan(plan)
+    return api.json_response({
+        'server': api.server_payload(ctx),
+        'character': api.character_payload(ctx),
+        'location': api.location_payload(ctx),
+        'ship': api.ship_payload(ctx, ship_roles),
+        'implants': api.implants_payload(ctx),
+        'skills': api.skills_payload(ctx),
+        **api.freshness(ctx)
+    }, plan.expiry(ctx), key=fresh_key(key, ctx))
+
+@app.route('/api/v%d/skills' % api.API_VERSION)
+def api_skills():
+    if not current_user.is_authenticated:
+        return api_login_required()
+    key = ('skills', current_user.character_id)
+    cached = api.not_modified(key)
+    if cached is not None:
+        return cached
+    plan = plans['skills']
+    ctx = run_plan(plan)
+    return api.json_response({
+        'character': api.character_payload(ctx),
+        'skills': api.skills_payload(ctx),
+        **api.freshness(ctx)
+    }, plan.expiry(ctx), key=fresh_key(key, ctx))
+
+@app.route('/api/v%d/skillqueue' % api.API_VERSION)
+def api_skillqueue():
+    """ the whole skill queue, page through it with
+    ?after=<next>&limit=N """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    try:
+        after, limit = skillqueue_page_args()
+    except ValueError:
+        return api.json_response({'error': 'after and limit must be integers'}), 400
+    key = ('skillqueue', current_user.character_id, after, limit)
+    cached = api.not_modified(key)
+    if cached is not None:
+        return cached
+    plan = plans['skills']
+    ctx = run_plan(plan)
+    return api.json_response({
+        'character_id': ctx['character_id'],
+        'queue': ctx['skill_queue'].page(after, limit),
+        **api.freshness(ctx)
+    }, plan.expiry(ctx), key=fresh_key(key, ctx))
+
+@app.route('/api/v%d/implants' % api.API_VERSION)
+def api_implants():
+    if not current_user.is_authenticated:
+        return api_login_required()
+    key = ('implants', current_user.character_id)
+    cached = api.not_modified(key)
+    if cached is not None:
+        return cached
+    plan = plans['implants']
+    ctx = run_plan(plan)
+    return api.json_response({
+        'character': api.character_payload(ctx),
+        'ship': api.ship_payload(ctx, ship_roles),
+        'implants': api.implants_payload(ctx),
+        **api.freshness(ctx)
+    }, plan.expiry(ctx), key=fresh_key(key, ctx))
+
+@app.route('/api/v%d/alts' % api.API_VERSION)
+def api_alts():
+    if not current_user.is_authenticated:
+        return api_login_required()
+    users = linked_characters(current_user._get_current_object())
+    # linking or unlinking a pilot changes the list
+    key = ('alts',) + tuple(user.character_id for user in users)
+    cached = api.not_modified(key)
+    if cached is not None:
+        return cached
+    plan = plans['alts']
+    pilots = run_linked(plan, users)
+    return api.json_response({
+        'server': api.server_payload(pilots[0]),
+        'pilots': [{
+            'character': api.character_payload(ctx),
+            'location': api.location_payload(ctx),
+            'ship': api.ship_payload(ctx, ship_roles),
+            **api.freshness(ctx)
+        } for ctx in pilots],
+    }, min([
+        expires for expires in map(plan.expiry, pilots) if expires is not None
+    ] or [None]), key=fresh_key(key, *pilots))
+
+@app.route('/api/v%d/standings' % api.API_VERSION)
+def api_standings():
+    """ standings of the current pilot, from the standings store """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    return api.json_response({
+        'character_id': current_user.character_id,
+        'standings': standings_store.get(current_user.character_id),
+    })
 
-        # Pilot status and location
-        op = esiapp.op['get_characters_character_id_online'](
-            character_id=current_user.character_id
-        )
-        online = esiclient.request(op)
-        op = esiapp.op['get_characters_character_id_location'](
-            character_id=current_user.character_id
-        )
-        location = esiclient.request(op)
-        op = esiapp.op['get_universe_systems_system_id'](
-            system_id=location.data.solar_system_id
-        )
-        location_solar_name = esiclient.request(op)
-        op = esiapp.op['get_characters_character_id'](
-            character_id=current_user.character_id
+@app.route('/api/v%d/standings/filter' % api.API_VERSION, methods=['POST'])
+def api_standings_filter():
+    """ split pilots of the current pilot's corporation, or alliance with
+    "scope": "alliance", and its linked characters by standings:
+    {"character_ids": [...], "thresholds": {from_id: minimum}}, thresholds
+    default to FLEET_MIN_STANDINGS. Other pilots are listed under
+    "forbidden", without their standings. """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    body = request.get_json(silent=True) or {}
+    thresholds = body.get(
+        'thresholds', app.config.get('FLEET_MIN_STANDINGS', DEFAULT_THRESHOLDS)
+    )
+    error = 'character_ids must be a list of IDs and thresholds a map of ID to standing'
+    try:
+        ids = list(dict.fromkeys(int(i) for i in body.get('character_ids') or []))
+    except (TypeError, ValueError):
+        return api.json_response({'error': error}), 400
+    allowed = visible_characters(ids, body.get('scope') == 'alliance')
+    if allowed is None:
+        return api.json_response({'error': 'pilot is not in an alliance'}), 404
+    try:
+        result = standings_store.filter([i for i in ids if i in allowed], thresholds)
+    except (TypeError, ValueError, AttributeError):
+        return api.json_response({'error': error}), 400
+    return api.json_response(dict(
+        result, thresholds=thresholds, forbidden=[i for i in ids if i not in allowed],
+    ))
+
+@app.route('/api/v%d/sp/history' % api.API_VERSION)
+def api_sp_history():
+    """ SP history of the current pilot, or a linked one with
+    ?character_id=; ?since= and ?until= unix times """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    try:
+        character_id = int(request.args.get('character_id', current_user.character_id))
+        since = int(request.args.get('since', 0))
+        until = int(request.args['until']) if 'until' in request.args else None
+    except ValueError:
+        return api.json_response({'error': 'character_id, since and until must be integers'}), 400
+    linked = [user.character_id for user in linked_characters(current_user)]
+    if character_id not in linked:
+        return api.json_response({'error': 'not a linked character'}), 403
+    return api.json_response(dict(
+        sp_history.history(character_id, since, until), character_id=character_id,
+    ))
+
+def visible_characters(character_ids, alliance=False):
+    """ the IDs of `character_ids` the current pilot may read: its linked
+    characters and the pilots of its corporation, or alliance; None when
+    `alliance` and it is not in one """
+    session = DataSession()
+    try:
+        character = session.get(Characters, current_user.character_id)
+    finally:
+        session.close()
+    allowed = set(user.character_id for user in linked_characters(current_user))
+    if character is None:
+        return allowed
+    if alliance:
+        if character.alliance_id is None:
+            return None
+        scope = {'alliance_id': character.alliance_id}
+    else:
+        scope = {'corporation_id': character.corporation_id}
+    allowed.update(scoped_characters(
+        [i for i in character_ids if i not in allowed], scope
+    ))
+    return allowed
+
+def scoped_characters(character_ids, scope):
+    """ the IDs of `character_ids` in the corporation (or alliance) of
+    `scope`, {'corporation_id': ...} or {'alliance_id': ...} """
+    column, value = next(iter(scope.items()))
+    found = set()
+    session = DataSession()
+    try:
+        for start in range(0, len(character_ids), 500):
+            chunk = character_ids[start:start + 500]
+            found.update(character_id for (character_id,) in session.query(
+                Characters.id
+            ).filter(Characters.id.in_(chunk), getattr(Characters, column) == value))
+    finally:
+        session.close()
+    return found
+
+@app.route('/api/v%d/sp/rates' % api.API_VERSION, methods=['POST'])
+def api_sp_rates():
+    """ SP/day of pilots of the current pilot's corporation, or alliance
+    with "scope": "alliance", and of its linked characters:
+    {"character_ids": [...], "days": N}, days default to SP_RATE_DAYS.
+    Other pilots are listed under "forbidden", without their data. """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    body = request.get_json(silent=True) or {}
+    try:
+        days = float(body.get('days', app.config.get('SP_RATE_DAYS', 30)))
+        ids = list(dict.fromkeys(int(i) for i in body.get('character_ids') or []))
+    except (TypeError, ValueError):
+        return api.json_response({
+            'error': 'character_ids must be a list of IDs and days a number'
+        }), 400
+    if not 0 < days <= app.config.get('SP_RATE_MAX_DAYS', 3650):
+        # NaN and infinity included
+        return api.json_response({'error': 'days out of range'}), 400
+    if len(ids) > app.config.get('SP_RATE_MAX_PILOTS', 5000):
+        return api.json_response({'error': 'too many pilots'}), 400
+
+    allowed = visible_characters(ids, body.get('scope') == 'alliance')
+    if allowed is None:
+        return api.json_response({'error': 'pilot is not in an alliance'}), 404
+    until = int(time.time())
+    result = sp_history.rates(
+        [i for i in ids if i in allowed], until - int(days * 86400), until
+    )
+    return api.json_response(dict(
+        result, days=days, forbidden=[i for i in ids if i not in allowed],
+    ))
+
+@app.route('/api/v%d/fleet/invite' % api.API_VERSION, methods=['POST'])
+def api_fleet_invite():
+    """ invite registered pilots to the current pilot's fleet:
+    {"fleet_id": ..., "character_ids": [...], "standings": true}
+
+    Streams one JSON line per pilot as its invite completes, then a
+    summary line. Pilots failing FLEET_MIN_STANDINGS are skipped unless
+    "standings" is false.
+    """
+    if not current_user.is_authenticated:
+        return api_login_required()
+    body = request.get_json(silent=True) or {}
+    try:
+        fleet_id = int(body['fleet_id'])
+        character_ids = list(dict.fromkeys(int(i) for i in body.get('character_ids') or []))
+    except (KeyError, TypeError, ValueError):
+        return api.json_response({
+            'error': 'fleet_id and character_ids must be integers'
+        }), 400
+    limit = app.config.get('FLEET_INVITE_MAX', 256)
+    if len(character_ids) > limit:
+        return api.json_response({'error': 'at most %d pilots per invite' % limit}), 400
+
+    boss = current_user._get_current_object()
+    client = client_for(boss)
+
+    def esi(op, params):
+        return planner.request(op, params, client=client)
+
+    # only the fleet boss can read the wings, or invite
+    wings = slim('get_fleets_fleet_id_wings', esi(
+        'get_fleets_fleet_id_wings', {'fleet_id': fleet_id}
+    ))
+    if wings.status != 200:
+        return api.json_response({
+            'error': 'cannot read fleet %d, are you its boss?' % fleet_id
+        }), 403
+
+    skipped = {}
+    registered = set(
+        character_id for (character_id,) in User.query.filter(
+            User.character_id.in_(character_ids)
+        ).with_entities(User.character_id)
+    )
+    for character_id in character_ids:
+        if character_id == boss.character_id:
+            skipped[character_id] = 'fleet boss'
+        elif character_id not in registered:
+            skipped[character_id] = 'not registered'
+    if body.get('standings', True):
+        standings = standings_store.filter(
+            [i for i in character_ids if i not in skipped],
+            app.config.get('FLEET_MIN_STANDINGS', DEFAULT_THRESHOLDS),
         )
-        current_character = esiclient.request(op)
+        for character_id in standings['rejected']:
+            skipped[character_id] = 'standings'
+    session = DataSession()
+    try:
+        roles = dict(session.query(CharacterStatus.id, CharacterStatus.role).filter(
+            CharacterStatus.id.in_(character_ids)
+        ))
+    finally:
+        session.close()
+
+    invitations = assign(
+        [(i, roles.get(i)) for i in character_ids if i not in skipped],
+        wings.data, app.config.get('FLEET_ROLE_SQUADS'),
+    )
+    inviter = FleetInviter(
+        esi,
+        concurrency=app.config.get('FLEET_INVITE_CONCURRENCY', 8),
+        error_floor=app.config.get('FLEET_INVITE_ERROR_FLOOR', 20),
+    )
 
-        # Pilot corporation
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-        current_corp_url = urllib.parse.quote(current_corporation.data.url, safe='/:')
-        
-        # Clone implants
-        op = esiapp.op['get_characters_character_id_implants'](
-            character_id=current_user.character_id
-        )
-        implants = esiclient.request(op)
-
-        # Determine the Implant Set and relevant bonus totals
-
-        
-        # Query API for the Implant name
-        ascendancy_high = ['33516','33525']
-        for slot in range(10):
-            try:
-                op = esiapp.op['get_universe_types_type_id'](
-                    type_id=implants.data[slot]
-                    )
-                implant_names.append(esiclient.request(op))
-                implant_id = {'data': {'id': implants.data[slot] }}
-                implant_ids.append(implant_id)
-            except IndexError:
-                implant_name = {'data': {'name': '< EMPTY SLOT >'}}
-                implant_names.append(implant_name)
-                implant_id = {'data': {'id': '0' }}
-                implant_ids.append(implant_id)
-
-
-        # Implant Bonus check
-        # - Ascendancy
-        # - Saviour
-        bonus_check_status = "continue"
-        while bonus_check_status == "continue":
-
-            implant_set_bonus = "Shit"
-            bonus_check_status = "stop"
-
-        # Skill Hardwiring - Slot: 6 - 10
-        # - Hybrid
-        # - Laser
-        # - Projectile
-        # - Logistics
-        # - muppet
-
-        # Ship and Fittings
-        op = esiapp.op['get_characters_character_id_ship'](
-            character_id=current_user.character_id
-        )
-        ship = esiclient.request(op)
-        op = esiapp.op['get_universe_types_type_id'](
-            type_id=ship.data.ship_type_id
-        )
-        ship_type = esiclient.request(op)
-        op = esiapp.op['get_universe_groups_group_id'](
-            group_id=ship_type.data.group_id
-        )
-        ship_class = esiclient.request(op)
+    def stream():
+        start = time.time()
+        counts = {'invited': 0, 'failed': 0, 'skipped': len(skipped)}
+        for character_id, reason in skipped.items():
+            yield api.json_line({
+                'character_id': character_id, 'status': 'skipped', 'reason': reason,
+            })
+        for outcome in inviter.invite(fleet_id, invitations):
+            counts[outcome['status']] += 1
+            yield api.json_line(outcome)
+        yield api.json_line(dict(
+            counts, done=True, fleet_id=fleet_id,
+            elapsed=round(time.time() - start, 3),
+        ))
+
+    return Response(stream(), mimetype='application/x-ndjson')
+
+@app.route('/api/v%d/incursions' % api.API_VERSION)
+def api_incursions():
+    """ public: current incursions and the change feed, page through the
+    events with ?after=<feed.next>&limit=N """
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', app.config.get('INCURSION_FEED_PAGE', 100)))
+    except ValueError:
+        return api.json_response({'error': 'after and limit must be integers'}), 400
+    limit = max(1, min(limit, app.config.get('INCURSION_FEED_MAX_PAGE', 500)))
+    payload = api.incursions_payload(incursion_tracker, after, limit)
+    interval = app.config.get('INCURSION_POLL_INTERVAL', 300)
+    expires = payload['polled_at'] + interval if payload['polled_at'] else None
+    return api.json_response(payload, expires, private=False)
 
-        # Incursions status
-        op = esiapp.op['get_incursions']()
-        incursions = esiclient.request(op)
+# -----------------------------------------------------------------------
+# Index Redirect to Main
+# -----------------------------------------------------------------------
+@app.route('/')
+def index():
+    return render_plan(plans['index'])
 
-        # Fleet
-        op = esiapp.op['get_characters_character_id_fleet'](
-            character_id=current_user.character_id
-        )
-        fleet = esiclient.request(op)
+# -----------------------------------------------------------------------
+# Main Routes
+# -----------------------------------------------------------------------
+@app.route('/main')
+def main():
+    return render_plan(plans['main'])
 
-        if 'fleet_id' in fleet.data:
-            fleet_id = fleet.data.fleet_id
-        else:
-            fleet_id = ''
-        
-        if 'structure_id' in location.data:
-            op = esiapp.op['get_universe_structures_structure_id'](
-            structure_id=location.data.structure_id
-            )
-            dock = esiclient.request(op)
-            dock_status = dock.data.name
-        elif 'station_id' in location.data:
-            op = esiapp.op['get_universe_stations_station_id'](
-            station_id=location.data.station_id
-            )
-            dock = esiclient.request(op)            
-            dock_status = dock.data.name
-        else:
-            dock_status = "No"
-
-        #if 'fleet_id' in fleet.data:
-        #    ## Fleet boss only
-        #    op = esiapp.op['get_fleets_fleet_id'](
-        #        fleet_id=fleet.data.fleet_id
-        #    )
-        #    fleet_details = esiclient.request(op)
-        #    op = esiapp.op['get_fleets_fleet_id_members'](
-        #        fleet_id=fleet.data.fleet_id
-        #    )
-        #    fleet_members = esiclient.request(op)
-        def write_characters_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the Characters table entry
-            character = Characters(
-                id=current_user.character_id, 
-                name=current_user.character_name,
-                birthday=current_character.data.birthday,
-                corporation_id=current_character.data.corporation_id,
-                security_status=current_character.data.security_status,
-                description=current_character.data.description)
-            session.merge(character)
-            # Commit current changes to the database
-            session.commit()
-
-        def write_characterstatus_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the CharacterStatus table entry
-            characterstatus = CharacterStatus(
-                id=current_user.character_id, 
-                online=online.data.online,
-                location=location_solar_name.data.name,
-                fleet=fleet_id,
-                docked=dock_status)
-            session.merge(characterstatus)
-            # Commit current changes to the database
-            session.commit()
-        write_characters_db()
-        write_characterstatus_db()
-
-    return render_template('implants.html', **{
-        'server_status': server_status,
-        'dps': dps,
-        'sniper': sniper,
-        'logi': logi,
-        'support': support,
-        'transport': transport,
-        'online': online,
-        'dock': dock,
-        'dock_status': dock_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation,
-        'current_corp_url': current_corp_url,
-        'location': location,
-        'location_solar_name': location_solar_name,
-        'fleet': fleet,
-        'fleet_id': fleet_id,
-        'implant_names': implant_names,
-        'implant_ids': implant_ids,
-        'implant_set_bonus': implant_set_bonus,
-        'ship': ship,
-        'ship_type': ship_type,
-        'ship_class': ship_class,
-    })
+# -----------------------------------------------------------------------
+# Implant Routes
+# -----------------------------------------------------------------------
+@app.route('/redir_implants')
+def redir_implants():
+    return render_plan(plans['redir_implants'])
+
+@app.route('/implants')
+def implants():
+    return render_plan(plans['implants'], **fleet_roles)
 
 # -----------------------------------------------------------------------
-# Pilot Routes
+# Skill Routes
 # -----------------------------------------------------------------------
 @app.route('/redir_skills')
 def redir_skills():
-    server_status = None
-    current_character = None
-    current_corporation = None
+    return render_plan(plans['redir_skills'])
 
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
-
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
-        
-        op = esiapp.op['get_characters_character_id'](
-        character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-    
-    return render_template('skills_redirect.html', **{
-        'server_status': server_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation
-    })
+def skillqueue_page_args():
+    """ ?after= and ?limit= of a skill queue page """
+    after = int(request.args.get('after', -1))
+    limit = int(request.args.get('limit', app.config.get('SKILLQUEUE_PAGE', 50)))
+    return after, max(1, min(limit, app.config.get('SKILLQUEUE_MAX_PAGE', 500)))
 
 @app.route('/skills')
 def skills():
-    server_status = None
-    current_character = None
-    current_corporation = None
-    implant_names = []
-    implant_ids = []
-    implant_set_bonus = None
-    skills = None
-    skillqueue = None
-    skillqueue_total = None
-    skillqueue_0_name = None
-    skillqueue_1_name = None
-    skillqueue_2_name = None
-    skillqueue_3_name = None
-    skillqueue_4_name = None
-    skillqueue_5_name = None
-    skillqueue_0_level = None
-    skillqueue_1_level = None
-    skillqueue_2_level = None
-    skillqueue_3_level = None
-    skillqueue_4_level = None
-    skillqueue_5_level = None
-    incursions = None
-
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
-
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
-
-        # Pilot status and location
-        op = esiapp.op['get_characters_character_id'](
-            character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
-
-        # Pilot corporation
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-        
-        # Clone implants
-        op = esiapp.op['get_characters_character_id_implants'](
-            character_id=current_user.character_id
-        )
-        implants = esiclient.request(op)
-
-        # Determine the Implant Set and relevant bonus totals
-
-        
-        # Query API for the Implant name
-        ascendancy_high = ['33516','33525']
-        for slot in range(10):
-            try:
-                op = esiapp.op['get_universe_types_type_id'](
-                    type_id=implants.data[slot]
-                    )
-                implant_names.append(esiclient.request(op))
-                implant_id = {'data': {'id': implants.data[slot] }}
-                implant_ids.append(implant_id)
-            except IndexError:
-                implant_name = {'data': {'name': '< EMPTY SLOT >'}}
-                implant_names.append(implant_name)
-                implant_id = {'data': {'id': '0' }}
-                implant_ids.append(implant_id)
-
-
-        # Implant Bonus check
-        # - Ascendancy
-        # - Saviour
-        bonus_check_status = "continue"
-        while bonus_check_status == "continue":
-
-            implant_set_bonus = "Shit"
-            bonus_check_status = "stop"
-
-        # Skill Hardwiring - Slot: 6 - 10
-        # - Hybrid
-        # - Laser
-        # - Projectile
-        # - Logistics
-        # - muppet
-
-        # Pilot Skills
-        op = esiapp.op['get_characters_character_id_skills'](
-            character_id=current_user.character_id
-        )
-        skills = esiclient.request(op)
-
-        ## Skill Queue
-        op = esiapp.op['get_characters_character_id_skillqueue'](
-            character_id=current_user.character_id
-        )
-        skillqueue = esiclient.request(op)
-        skillqueue_total = len(skillqueue.data)
-
-        if 1 < skillqueue_total:
-            skillqueue_0 = skillqueue.data[0].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_0
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_0_level = skillqueue.data[0].finished_level
-            skillqueue_0_name = skill_lookup.data.name
-        else:
-            skillqueue_1_name = "  < empty >"
-            skillqueue_1_level = ""
-        if 1 < skillqueue_total:
-            skillqueue_1 = skillqueue.data[1].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_1
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_1_level = skillqueue.data[1].finished_level
-            skillqueue_1_name = skill_lookup.data.name
-        else:
-            skillqueue_1_name = "  < empty >"
-            skillqueue_1_level = ""
-        
-        if 2 < skillqueue_total:
-            skillqueue_2 = skillqueue.data[2].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_2
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_2_level = skillqueue.data[2].finished_level
-            skillqueue_2_name = skill_lookup.data.name
-        else:
-            skillqueue_2_name = "  < empty >"
-            skillqueue_2_level = ""
-        
-        if 3 < skillqueue_total:
-            skillqueue_3 = skillqueue.data[3].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_3
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_3_level = skillqueue.data[3].finished_level
-            skillqueue_3_name = skill_lookup.data.name
-        else:
-            skillqueue_3_name = "  < empty >"
-            skillqueue_3_level = ""
-
-        if 4 < skillqueue_total:
-            skillqueue_4 = skillqueue.data[4].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_4
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_4_level = skillqueue.data[4].finished_level
-            skillqueue_4_name = skill_lookup.data.name
-        else:
-            skillqueue_4_name = "  < empty >"
-            skillqueue_4_level = ""
-        if 5 < skillqueue_total:
-            skillqueue_5 = skillqueue.data[5].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_5
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_5_level = skillqueue.data[5].finished_level
-            skillqueue_5_name = skill_lookup.data.name
-        else:
-            skillqueue_5_name = "  < empty >"
-            skillqueue_5_level = ""
-
-        def write_characters_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the Characters table entry
-            character = Characters(
-                id=current_user.character_id, 
-                name=current_user.character_name,
-                birthday=current_character.data.birthday,
-                corporation_id=current_character.data.corporation_id,
-                security_status=current_character.data.security_status,
-                description=current_character.data.description)
-            session.merge(character)
-            # Commit current changes to the database
-            session.commit()
-
-        def write_skills_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the Skills table entry
-            skill = Skills(
-                id=current_user.character_id, 
-                skills=skills.data.skills,
-                total_sp=skills.data.total_sp,
-                unallocated_sp=skills.data.unallocated_sp)
-            session.merge(skill)
-            # Commit current changes to the database
-            session.commit()
-
-        write_characters_db()
-        write_skills_db()
-
-    return render_template('skills.html', **{
-        'server_status': server_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation,
-        'skills': skills,
-        'skillqueue': skillqueue,
-        'skillqueue_total': skillqueue_total,
-        'skillqueue_0_name': skillqueue_0_name,
-        'skillqueue_1_name': skillqueue_1_name,
-        'skillqueue_2_name': skillqueue_2_name,
-        'skillqueue_3_name': skillqueue_3_name,
-        'skillqueue_4_name': skillqueue_4_name,
-        'skillqueue_5_name': skillqueue_5_name,
-        'skillqueue_0_level': skillqueue_0_level,
-        'skillqueue_1_level': skillqueue_1_level,
-        'skillqueue_2_level': skillqueue_2_level,
-        'skillqueue_3_level': skillqueue_3_level,
-        'skillqueue_4_level': skillqueue_4_level,
-        'skillqueue_5_level': skillqueue_5_level,
-        'incursions': incursions,
-    })
+    try:
+        after, limit = skillqueue_page_args()
+    except ValueError:
+        after, limit = -1, app.config.get('SKILLQUEUE_PAGE', 50)
+    plan = plans['skills']
+    page = run_plan(plan)
+    if page['user'] is not None:
+        page['skill_queue_page'] = page['skill_queue'].page(after, limit)
+    return render_template(plan.template, **page)
 
 # -----------------------------------------------------------------------
 # Pilot Routes
 # -----------------------------------------------------------------------
 @app.route('/redir_pilot')
 def redir_pilot():
-    server_status = None
-    current_character = None
-    current_corporation = None
-
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
-
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
-        
-        op = esiapp.op['get_characters_character_id'](
-        character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-    
-    return render_template('pilot_redirect.html', **{
-        'server_status': server_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation
-    })
+    return render_plan(plans['redir_pilot'])
 
 @app.route('/pilot')
 def pilot():
-    server_status = None
-    online = None
-    current_character = None
-    location = None
-    location_solar_name = None
-    dock = None
-    dock_status = None
-    current_corporation = None
-    current_corp_url = None
-    fleet = None
-    implant_names = []
-    implant_ids = []
-    implant_set_bonus = None
-    ship = None
-    ship_type = None
-    ship_class = None
-    skills = None
-    skillqueue = None
-    skillqueue_total = None
-    skillqueue_0_name = None
-    skillqueue_1_name = None
-    skillqueue_2_name = None
-    skillqueue_3_name = None
-    skillqueue_4_name = None
-    skillqueue_5_name = None
-    skillqueue_0_level = None
-    skillqueue_1_level = None
-    skillqueue_2_level = None
-    skillqueue_3_level = None
-    skillqueue_4_level = None
-    skillqueue_5_level = None
-    fleet_id = None
-    incursions = None
-
-    # EVE Online Server Status
-    op = esiapp.op['get_status']()
-    server_status = esiclient.request(op)
+    return render_plan(plans['pilot'], **fleet_roles)
 
-    if current_user.is_authenticated:
-        esisecurity.update_token(current_user.get_sso_data())
-
-        # Pilot status and location
-        op = esiapp.op['get_characters_character_id_online'](
-            character_id=current_user.character_id
-        )
-        online = esiclient.request(op)
-        op = esiapp.op['get_characters_character_id_location'](
-            character_id=current_user.character_id
-        )
-        location = esiclient.request(op)
-        op = esiapp.op['get_universe_systems_system_id'](
-            system_id=location.data.solar_system_id
-        )
-        location_solar_name = esiclient.request(op)
-        op = esiapp.op['get_characters_character_id'](
-            character_id=current_user.character_id
-        )
-        current_character = esiclient.request(op)
-
-        # Pilot corporation
-        op = esiapp.op['get_corporations_corporation_id'](
-            corporation_id=current_character.data.corporation_id
-        )
-        current_corporation = esiclient.request(op)
-        current_corp_url = urllib.parse.quote(current_corporation.data.url, safe='/:')
-        
-        # Clone implants
-        op = esiapp.op['get_characters_character_id_implants'](
-            character_id=current_user.character_id
-        )
-        implants = esiclient.request(op)
-
-        # Determine the Implant Set and relevant bonus totals
-
-        
-        # Query API for the Implant name
-        ascendancy_high = ['33516','33525']
-        for slot in range(10):
-            try:
-                op = esiapp.op['get_universe_types_type_id'](
-                    type_id=implants.data[slot]
-                    )
-                implant_names.append(esiclient.request(op))
-                implant_id = {'data': {'id': implants.data[slot] }}
-                implant_ids.append(implant_id)
-            except IndexError:
-                implant_name = {'data': {'name': '< EMPTY SLOT >'}}
-                implant_names.append(implant_name)
-                implant_id = {'data': {'id': '0' }}
-                implant_ids.append(implant_id)
-
-
-        # Implant Bonus check
-        # - Ascendancy
-        # - Saviour
-        bonus_check_status = "continue"
-        while bonus_check_status == "continue":
-
-            implant_set_bonus = "Shit"
-            bonus_check_status = "stop"
-
-        # Skill Hardwiring - Slot: 6 - 10
-        # - Hybrid
-        # - Laser
-        # - Projectile
-        # - Logistics
-        # - muppet
-
-        # Ship and Fittings
-        op = esiapp.op['get_characters_character_id_ship'](
-            character_id=current_user.character_id
-        )
-        ship = esiclient.request(op)
-        op = esiapp.op['get_universe_types_type_id'](
-            type_id=ship.data.ship_type_id
-        )
-        ship_type = esiclient.request(op)
-        op = esiapp.op['get_universe_groups_group_id'](
-            group_id=ship_type.data.group_id
-        )
-        ship_class = esiclient.request(op)
-
-        # Pilot Skills
-        op = esiapp.op['get_characters_character_id_skills'](
-            character_id=current_user.character_id
-        )
-        skills = esiclient.request(op)
-
-        ## Skill Queue
-        op = esiapp.op['get_characters_character_id_skillqueue'](
-            character_id=current_user.character_id
-        )
-        skillqueue = esiclient.request(op)
-        skillqueue_total = len(skillqueue.data)
-
-        if 1 < skillqueue_total:
-            skillqueue_0 = skillqueue.data[0].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_0
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_0_level = skillqueue.data[0].finished_level
-            skillqueue_0_name = skill_lookup.data.name
-        else:
-            skillqueue_1_name = "  < empty >"
-            skillqueue_1_level = ""
-        if 1 < skillqueue_total:
-            skillqueue_1 = skillqueue.data[1].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_1
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_1_level = skillqueue.data[1].finished_level
-            skillqueue_1_name = skill_lookup.data.name
-        else:
-            skillqueue_1_name = "  < empty >"
-            skillqueue_1_level = ""
-        
-        if 2 < skillqueue_total:
-            skillqueue_2 = skillqueue.data[2].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_2
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_2_level = skillqueue.data[2].finished_level
-            skillqueue_2_name = skill_lookup.data.name
-        else:
-            skillqueue_2_name = "  < empty >"
-            skillqueue_2_level = ""
-        
-        if 3 < skillqueue_total:
-            skillqueue_3 = skillqueue.data[3].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_3
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_3_level = skillqueue.data[3].finished_level
-            skillqueue_3_name = skill_lookup.data.name
-        else:
-            skillqueue_3_name = "  < empty >"
-            skillqueue_3_level = ""
-
-        if 4 < skillqueue_total:
-            skillqueue_4 = skillqueue.data[4].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_4
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_4_level = skillqueue.data[4].finished_level
-            skillqueue_4_name = skill_lookup.data.name
-        else:
-            skillqueue_4_name = "  < empty >"
-            skillqueue_4_level = ""
-        if 5 < skillqueue_total:
-            skillqueue_5 = skillqueue.data[5].skill_id
-            op = esiapp.op['get_universe_types_type_id'](
-            type_id=skillqueue_5
-            )
-            skill_lookup = esiclient.request(op)
-            skillqueue_5_level = skillqueue.data[5].finished_level
-            skillqueue_5_name = skill_lookup.data.name
-        else:
-            skillqueue_5_name = "  < empty >"
-            skillqueue_5_level = ""
-
-        # Incursions status
-        op = esiapp.op['get_incursions']()
-        incursions = esiclient.request(op)
-
-        # Fleet
-        op = esiapp.op['get_characters_character_id_fleet'](
-            character_id=current_user.character_id
-        )
-        fleet = esiclient.request(op)
-
-        if 'fleet_id' in fleet.data:
-            fleet_id = fleet.data.fleet_id
-        else:
-            fleet_id = ''
-        
-        if 'structure_id' in location.data:
-            op = esiapp.op['get_universe_structures_structure_id'](
-            structure_id=location.data.structure_id
-            )
-            dock = esiclient.request(op)
-            dock_status = dock.data.name
-        elif 'station_id' in location.data:
-            op = esiapp.op['get_universe_stations_station_id'](
-            station_id=location.data.station_id
-            )
-            dock = esiclient.request(op)            
-            dock_status = dock.data.name
-        else:
-            dock_status = "No"
-
-        #if 'fleet_id' in fleet.data:
-        #    ## Fleet boss only
-        #    op = esiapp.op['get_fleets_fleet_id'](
-        #        fleet_id=fleet.data.fleet_id
-        #    )
-        #    fleet_details = esiclient.request(op)
-        #    op = esiapp.op['get_fleets_fleet_id_members'](
-        #        fleet_id=fleet.data.fleet_id
-        #    )
-        #    fleet_members = esiclient.request(op)
-        def write_characters_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the Characters table entry
-            character = Characters(
-                id=current_user.character_id, 
-                name=current_user.character_name,
-                birthday=current_character.data.birthday,
-                corporation_id=current_character.data.corporation_id,
-                security_status=current_character.data.security_status,
-                description=current_character.data.description)
-            session.merge(character)
-            # Commit current changes to the database
-            session.commit()
-
-        def write_skills_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the Skills table entry
-            skill = Skills(
-                id=current_user.character_id, 
-                skills=skills.data.skills,
-                total_sp=skills.data.total_sp,
-                unallocated_sp=skills.data.unallocated_sp)
-            session.merge(skill)
-            # Append or Create the CharacterStatus table entry
-            characterstatus = CharacterStatus(
-                id=current_user.character_id, 
-                online=online.data.online,
-                location=location_solar_name.data.name,
-                fleet=fleet_id,
-                docked=dock_status)
-            session.merge(characterstatus)
-            # Commit current changes to the database
-            session.commit()
-
-        def write_characterstatus_db():
-            ## Save to database
-            # Create a SQLAlchemy session object with ORM
-            from sqlalchemy.orm import sessionmaker
-            Session = sessionmaker(bind=engine)
-            Session.configure(bind=engine)
-            session = Session()
-            # Append or Create the CharacterStatus table entry
-            characterstatus = CharacterStatus(
-                id=current_user.character_id, 
-                online=online.data.online,
-                location=location_solar_name.data.name,
-                fleet=fleet_id,
-                docked=dock_status)
-            session.merge(characterstatus)
-            # Commit current changes to the database
-            session.commit()
-        write_characters_db()
-        write_skills_db()
-        write_characterstatus_db()
-
-    return render_template('pilot.html', **{
-        'server_status': server_status,
-        'dps': dps,
-        'sniper': sniper,
-        'logi': logi,
-        'support': support,
-        'transport': transport,
-        'online': online,
-        'dock': dock,
-        'dock_status': dock_status,
-        'current_character': current_character,
-        'current_corporation': current_corporation,
-        'current_corp_url': current_corp_url,
-        'location': location,
-        'location_solar_name': location_solar_name,
-        'fleet': fleet,
-        'fleet_id': fleet_id,
-        'implant_names': implant_names,
-        'implant_ids': implant_ids,
-        'implant_set_bonus': implant_set_bonus,
-        'ship': ship,
-        'ship_type': ship_type,
-        'ship_class': ship_class,
-        'skills': skills,
-        'skillqueue': skillqueue,
-        'skillqueue_total': skillqueue_total,
-        'skillqueue_0_name': skillqueue_0_name,
-        'skillqueue_1_name': skillqueue_1_name,
-        'skillqueue_2_name': skillqueue_2_name,
-        'skillqueue_3_name': skillqueue_3_name,
-        'skillqueue_4_name': skillqueue_4_name,
-        'skillqueue_5_name': skillqueue_5_name,
-        'skillqueue_0_level': skillqueue_0_level,
-        'skillqueue_1_level': skillqueue_1_level,
-        'skillqueue_2_level': skillqueue_2_level,
-        'skillqueue_3_level': skillqueue_3_level,
-        'skillqueue_4_level': skillqueue_4_level,
-        'skillqueue_5_level': skillqueue_5_level,
-        'incursions': incursions,
-    })
+# -----------------------------------------------------------------------
+# Linked Characters Routes
+# -----------------------------------------------------------------------
+@app.route('/alts')
+def alts():
+    if not current_user.is_authenticated:
+        return render_plan(plans['alts'], pilots=[])
+    pilots = run_linked(plans['alts'])
+    # the header shows the current pilot and warns for any of them
+    page = dict(pilots[0])
+    page['esi_unavailable'] = any(ctx['esi_unavailable'] for ctx in pilots)
+    page['stale_as_of'] = min(
+        [ctx['stale_as_of'] for ctx in pilots if ctx['stale_as_of']] or [None]
+    )
+    return render_template('alts.html', pilots=pilots, **dict(page, **fleet_roles))
 
 @app.route("/shit")
 def shit():
@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+""" Circuit breakers for ESI endpoint groups
+
+ESI operations are grouped by their first path segment (status,
+characters, universe, corporations, ...). When a group fails
+`failures` times in a row (5xx, 420 error limiting, timeouts), its
+breaker opens and the PlanRunner stops calling it: plans get the last
+known data, marked stale, straight away instead of waiting on ESI.
+After `reset_timeout` seconds the breaker is half-open and lets a single
+probe request through; its success closes the breaker, its failure
+opens it again for another `reset_timeout`.
+"""
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# ESI answers that count as a failure of the endpoint group
+FAILURE_STATUS = (420, 500, 502, 503, 504)
+
+
+def op_group(op):
+    """ endpoint group of an ESI operation id, e.g. 'characters' """
+    parts = op.split('_')
+    return parts[1] if len(parts) > 1 else op
+
+
+class CircuitBreaker(object):
+    """ closed -> open after `failures` failures in a row -> half-open
+    after `reset_timeout` seconds -> closed on a successful probe """
+    def __init__(self, name, failures=5, reset_timeout=30):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failed = 0
+        self.opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ may a request go through now """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self.opened < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+            # half-open: one probe at a time
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        """ returns the new state if it changed, else None """
+        with self._lock:
+            self.failed = 0
+            self._probing = False
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self.opened = None
+                return CLOSED
+        return None
+
+    def failure(self):
+        """ returns the new state if it changed, else None """
+        with self._lock:
+            self.failed += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (
+                    self.state == CLOSED and self.failed >= self.failures):
+                self.state = OPEN
+                self.opened = time.time()
+                return OPEN
+        return None
+
+
+class BreakerBoard(object):
+    """ one CircuitBreaker per ESI endpoint group """
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, op):
+        group = op_group(op)
+        breaker = self.breakers.get(group)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.setdefault(group, CircuitBreaker(
+                    group, self.failures, self.reset_timeout
+                ))
+        return breaker
+
+    def states(self):
+        return dict(
+            (group, breaker.state) for group, breaker in self.breakers.items()
+        )
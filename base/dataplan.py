@@ -0,0 +1,608 @@
+# -*- encoding: utf-8 -*-
+""" Declarative page data plans
+
+A page describes the data it needs as a list of sections. Each section
+lists the ESI operations it needs in stages (stage N may use the results
+of stage N-1), how to turn the results into template variables and which
+rows to persist. The PlanRunner executes every section of a plan together:
+all fetches of the same stage run in parallel, identical operations are
+only requested once, responses are cached until their ESI expiry (shared
+entities like corporations much longer, see entities.py) and all changed
+rows are written in a single transaction.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from sqlalchemy import func
+from sqlalchemy import inspect
+
+from breaker import FAILURE_STATUS
+from breaker import op_group
+from dto import UNAVAILABLE
+from dto import slim
+from dto import unavailable
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------
+# Plan declaration
+# -----------------------------------------------------------------------
+class Fetch(object):
+    """ One ESI operation needed by a section
+
+    key     name of the result in the plan context
+    op      ESI operation id, as in esiapp.op[...]
+    params  dict, or callable(ctx) returning the op parameters. When
+            `many` is set, the callable returns a list of parameter dicts
+            and the result is a list of responses in the same order.
+    when    optional callable(ctx) -> bool, the fetch is skipped (result
+            None) when it returns False
+    """
+    def __init__(self, key, op, params=None, when=None, many=False):
+        self.key = key
+        self.op = op
+        self.params = params
+        self.when = when
+        self.many = many
+
+    def resolve(self, ctx):
+        """ return the list of parameter dicts to request for this ctx """
+        if self.when is not None and not self.when(ctx):
+            return None
+        params = self.params(ctx) if callable(self.params) else self.params
+        if self.many:
+            return list(params or [])
+        return [params or {}]
+
+
+class Section(object):
+    """ A part of a page: what to fetch, what to render, what to save
+
+    stages    list of lists of Fetch, run in order
+    build     optional callable(ctx) -> dict of extra template variables
+    persist   optional callable(ctx) -> list of ORM rows to merge
+    requires  names of other sections this one reads from
+    auth      only run this section for an authenticated pilot
+    """
+    def __init__(self, name, stages=(), build=None, persist=None,
+                 requires=(), auth=True):
+        self.name = name
+        self.stages = [list(stage) for stage in stages]
+        self.build = build
+        self.persist = persist
+        self.requires = tuple(requires)
+        self.auth = auth
+
+
+class DataPlan(object):
+    """ The sections a page needs and the template to render them with """
+    def __init__(self, name, template, sections, registry, persist=True):
+        self.name = name
+        self.template = template
+        self.sections = self._expand(sections, registry)
+        self.persist = persist
+
+    @staticmethod
+    def _expand(names, registry):
+        """ resolve section names (and their requirements) in dependency
+        order, each section only once """
+        ordered = []
+        seen = set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            section = registry[name]
+            for required in section.requires:
+                visit(required)
+            ordered.append(section)
+
+        for name in names:
+            visit(name)
+        return ordered
+
+    def expiry(self, ctx):
+        """ earliest expiry (unix time) of the ESI data in ctx, None if
+        nothing in it has one """
+        expiries = []
+        for section in self.sections:
+            for stage in section.stages:
+                for fetch in stage:
+                    value = ctx.get(fetch.key)
+                    for response in (value if fetch.many else [value]):
+                        if response is not None:
+                            expiries.append(response_expiry(response))
+        expiries = [expires for expires in expiries if expires is not None]
+        return min(expiries) if expiries else None
+
+    def defaults(self):
+        """ every fetch key set to None, so templates can always render """
+        return dict(
+            (fetch.key, [] if fetch.many else None)
+            for section in self.sections
+            for stage in section.stages
+            for fetch in stage
+        )
+
+
+# -----------------------------------------------------------------------
+# Plan execution
+# -----------------------------------------------------------------------
+def header_value(response, name):
+    """ first value of an ESI response header, case insensitive """
+    header = getattr(response, 'header', None) or {}
+    value = header.get(name)
+    if value is None:
+        name = name.lower()
+        for key in header:
+            if key.lower() == name:
+                value = header[key]
+                break
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    return value
+
+
+def response_expiry(response):
+    """ unix time an ESI response (or stored entity) expires, or None """
+    expires = getattr(response, 'expires', None)
+    if expires is not None:
+        return expires
+    return ResponseCache.expiry(response)
+
+
+class PlanHook(object):
+    """ Observer of a PlanRunner, override what you need
+
+    Hooks are called from the fetch threads, keep them cheap.
+    """
+    def on_request(self, op, response, elapsed):
+        """ an ESI request finished; response is None if it raised """
+
+    def on_cache(self, op, hit):
+        """ an ESI response was looked up in the response cache """
+
+    def on_persist(self, plan, rows, elapsed):
+        """ the rows of a plan were written """
+
+    def on_breaker(self, group, state):
+        """ the circuit breaker of an ESI endpoint group changed state """
+
+
+class ResponseCache(object):
+    """ in-process cache of ESI responses, valid until their Expires
+
+    Expired responses are kept `stale_ttl` seconds longer, to be served
+    (marked stale) while ESI is unavailable.
+    """
+    def __init__(self, max_entries=4096, stale_ttl=86400):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, stale=False):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if not stale and expires < time.time():
+            return None
+        return response
+
+    def set(self, key, response):
+        expires = response_expiry(response)
+        if expires is None:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self.purge()
+            self._entries[key] = (expires, response)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def purge(self):
+        """ drop entries past their stale time, or everything if still over
+        the limit """
+        oldest = time.time() - self.stale_ttl
+        self._entries = dict(
+            (key, entry) for key, entry in self._entries.items()
+            if entry[0] >= oldest
+        )
+        if len(self._entries) >= self.max_entries:
+            self._entries = {}
+
+    @staticmethod
+    def expiry(response):
+        """ timestamp from the ESI Expires header, None if not cacheable """
+        value = header_value(response, 'Expires')
+        if not value:
+            return None
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+
+class RowWriteFilter(object):
+    """ skips rows identical to the stored version
+
+    Rows are compared with what the database holds, read in one query per
+    table: every web worker and the poller write the same tables, what
+    one process wrote last says nothing about the row now. Only the
+    columns a row sets are compared, the poller writes part of a row.
+    Unchanged rows that have a `touch_column` (e.g.
+    CharacterStatus.last_updated) only get that column bumped, at most
+    every `touch_interval` seconds, in one UPDATE per table.
+    """
+    def __init__(self, touch_column='last_updated', touch_interval=60,
+                 max_entries=100000):
+        self.touch_column = touch_column
+        self.touch_interval = touch_interval
+        self.max_entries = max_entries
+        self._touched = {}
+        self._lock = threading.Lock()
+
+    def key(self, row):
+        mapper = inspect(row).mapper
+        return (mapper.local_table.name,) + tuple(
+            mapper.primary_key_from_instance(row)
+        )
+
+    @staticmethod
+    def canonical(value):
+        """ a value as the database gives it back: the String columns
+        hold booleans as 1/0 and numbers as text """
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+
+    def stored(self, session, model, rows):
+        """ {primary key: {column: value}} of the stored `rows` """
+        mapper = inspect(model)
+        primary_key = mapper.primary_key[0]
+        columns = [
+            attr for attr in mapper.column_attrs if attr.key != self.touch_column
+        ]
+        ids = [mapper.primary_key_from_instance(row)[0] for row in rows]
+        query = session.query(*[attr.class_attribute for attr in columns]).filter(
+            primary_key.in_(ids)
+        )
+        return dict(
+            (getattr(stored, primary_key.key), stored._asdict()) for stored in query
+        )
+
+    def split(self, session, rows):
+        """ returns (changed, touched): rows to merge, rows to touch """
+        now = time.time()
+        models = {}
+        for row in rows:
+            models.setdefault(type(row), []).append(row)
+        changed = []
+        touched = []
+        for model, model_rows in models.items():
+            stored = self.stored(session, model, model_rows)
+            mapper = inspect(model)
+            for row in model_rows:
+                current = stored.get(mapper.primary_key_from_instance(row)[0])
+                values = inspect(row).dict
+                if current is None or any(
+                    self.canonical(values[key]) != self.canonical(current[key])
+                    for key in current if key in values
+                ):
+                    changed.append(row)
+                elif (hasattr(row, self.touch_column)
+                      and now - self._touched.get(self.key(row), 0) >= self.touch_interval):
+                    touched.append(row)
+        return changed, touched
+
+    def written(self, rows):
+        """ remember when rows were written or touched, once their
+        transaction is committed """
+        now = time.time()
+        with self._lock:
+            if len(self._touched) + len(rows) > self.max_entries:
+                self._touched = {}
+            for row in rows:
+                self._touched[self.key(row)] = now
+
+    def touch(self, session, rows):
+        """ bump the touch column of unchanged rows, one UPDATE per table """
+        models = {}
+        for row in rows:
+            models.setdefault(type(row), []).append(
+                inspect(row).mapper.primary_key_from_instance(row)[0]
+            )
+        for model, ids in models.items():
+            primary_key = inspect(model).primary_key[0]
+            session.query(model).filter(primary_key.in_(ids)).update(
+                {self.touch_column: func.now()}, synchronize_session=False
+            )
+
+    def clear(self):
+        with self._lock:
+            self._touched = {}
+
+
+class PlanRunner(object):
+    """ Runs DataPlans against ESI and persists their rows """
+    def __init__(self, esiapp, esiclient, sessionmaker, cache=None,
+                 threads=8, entities=None, writes=None, breakers=None):
+        self.esiapp = esiapp
+        self.esiclient = esiclient
+        self.sessionmaker = sessionmaker
+        self.cache = cache if cache is not None else ResponseCache()
+        # optional long lived store for shared entities (see entities.py)
+        self.entities = entities
+        self.writes = writes if writes is not None else RowWriteFilter()
+        # optional breaker.BreakerBoard, ESI groups in trouble are skipped
+        self.breakers = breakers
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.hooks = []
+
+    def run(self, plan, user=None, hooks=()):
+        """ fetch, build and persist everything `plan` needs for `user`
+
+        Returns the template context. Sections that need authentication
+        are skipped when `user` is None. `hooks` are observers for this
+        run only, on top of the runner wide ones.
+
+        When ESI fails, earlier responses are used instead and
+        ctx['stale_as_of'] is the earliest expiry among them; if there are
+        none, the result is an empty placeholder, ctx['esi_unavailable']
+        is set and the sections depending on it are not persisted.
+        """
+        return self.run_many(plan, [user], hooks=hooks)[0]
+
+    def run_many(self, plan, users, clients=None, hooks=()):
+        """ run `plan` for several pilots at once (linked characters)
+
+        Each stage is fetched for all of them together: what they share
+        (corporations, systems, types) is requested once, the rest in
+        parallel, so a handful of pilots costs about the latency of one.
+        `clients` are ESI clients carrying each pilot's token, in the
+        order of `users`; without them the runner's client is used.
+        Returns the contexts, in the order of `users`.
+        """
+        hooks = self.hooks + list(hooks) if hooks else self.hooks
+        sections = [
+            section for section in plan.sections
+            if None not in users or not section.auth
+        ]
+        ctxs = []
+        for index, user in enumerate(users):
+            ctx = plan.defaults()
+            ctx['user'] = user
+            ctx['character_id'] = user.character_id if user is not None else None
+            ctx['stale_as_of'] = None
+            ctx['esi_unavailable'] = False
+            ctx['esiclient'] = clients[index] if clients else None
+            ctxs.append(ctx)
+
+        depth = max([len(section.stages) for section in sections] or [0])
+        for stage in range(depth):
+            self.fetch_many([
+                fetch
+                for section in sections if stage < len(section.stages)
+                for fetch in section.stages[stage]
+            ], ctxs, hooks)
+
+        for ctx in ctxs:
+            for section in sections:
+                if section.build is not None:
+                    ctx.update(section.build(ctx))
+
+        if plan.persist:
+            rows = []
+            for ctx in ctxs:
+                degraded = self.degraded(sections, ctx)
+                rows.extend(
+                    row
+                    for section in sections
+                    if section.persist is not None and section.name not in degraded
+                    for row in section.persist(ctx)
+                )
+            self.persist(plan, rows, hooks)
+        return ctxs
+
+    @staticmethod
+    def degraded(sections, ctx):
+        """ names of the sections built from placeholders (or requiring
+        such a section) """
+        degraded = set()
+        for section in sections:
+            if any(name in degraded for name in section.requires):
+                degraded.add(section.name)
+                continue
+            for stage in section.stages:
+                for fetch in stage:
+                    value = ctx.get(fetch.key)
+                    for result in (value if fetch.many else [value]):
+                        if result is not None and result.status == UNAVAILABLE:
+                            degraded.add(section.name)
+        return degraded
+
+    def fetch(self, fetches, ctx, hooks=None):
+        """ request all fetches of one stage in parallel, deduplicated """
+        self.fetch_many(fetches, [ctx], hooks)
+
+    def fetch_many(self, fetches, ctxs, hooks=None):
+        """ the same stage for several contexts, operations they share
+        are requested once """
+        hooks = self.hooks if hooks is None else hooks
+        wanted = {}
+        readers = {}
+        resolved = []
+        for ctx in ctxs:
+            keys_done = set()
+            for fetch in fetches:
+                if fetch.key in keys_done:
+                    continue
+                params_list = fetch.resolve(ctx)
+                keys_done.add(fetch.key)
+                resolved.append((ctx, fetch.key))
+                if params_list is None:
+                    ctx[fetch.key] = [] if fetch.many else None
+                    continue
+                keys = [self.make_key(fetch.op, params) for params in params_list]
+                for key, params in zip(keys, params_list):
+                    wanted.setdefault(key, (fetch.op, params, ctx.get('esiclient')))
+                    readers.setdefault(key, []).append(ctx)
+                ctx[fetch.key] = keys if fetch.many else keys[0]
+
+        results = {}
+        pending = []
+        for key, (op, params, client) in wanted.items():
+            if None in params.values():
+                # built from a placeholder, nothing to look up or ask ESI
+                for ctx in readers[key]:
+                    ctx['esi_unavailable'] = True
+                results[key] = unavailable(op)
+                continue
+            if self.stores(op):
+                cached = self.entities.get(op, params)
+            else:
+                cached = self.cache.get(key)
+            for hook in hooks:
+                hook.on_cache(op, cached is not None)
+            if cached is not None:
+                results[key] = cached
+            else:
+                pending.append((key, op, params, client))
+
+        futures = []
+        for key, op, params, client in pending:
+            if self.breakers is not None and not self.breakers.breaker(op).allow():
+                results[key] = self.fallback(key, op, params, readers[key])
+            else:
+                futures.append((key, self.executor.submit(
+                    self.request, op, params, hooks, client
+                )))
+
+        stored = False
+        for key, future in futures:
+            op, params, _ = wanted[key]
+            try:
+                response = future.result()
+            except Exception:
+                logger.exception("ESI request %s failed" % op)
+                response = None
+            failed = response is None or response.status in FAILURE_STATUS
+            self.account(op, failed, hooks)
+            if failed:
+                results[key] = self.fallback(key, op, params, readers[key])
+                continue
+            # keep the few fields we use, not the pyswagger response
+            response = slim(op, response, ResponseCache.expiry(response))
+            record = None
+            if self.stores(op):
+                record = self.entities.put(op, params, response)
+            if record is not None:
+                response = record
+                stored = True
+            else:
+                self.cache.set(key, response)
+            results[key] = response
+        if stored:
+            self.entities.flush()
+
+        for ctx, key in resolved:
+            value = ctx[key]
+            if isinstance(value, list):
+                ctx[key] = [results[item] for item in value]
+            elif value is not None:
+                ctx[key] = results[value]
+
+    def stores(self, op):
+        return self.entities is not None and self.entities.handles(op)
+
+    def fallback(self, key, op, params, ctxs):
+        """ the last known result when ESI cannot answer, else a placeholder;
+        flags the contexts reading it """
+        if self.stores(op):
+            stale = self.entities.get(op, params, stale=True)
+        else:
+            stale = self.cache.get(key, stale=True)
+        if stale is not None and stale.status == 200:
+            if stale.expires is not None and stale.expires < time.time():
+                for ctx in ctxs:
+                    ctx['stale_as_of'] = min(
+                        ctx['stale_as_of'] or stale.expires, stale.expires
+                    )
+            return stale
+        for ctx in ctxs:
+            ctx['esi_unavailable'] = True
+        return unavailable(op)
+
+    def account(self, op, failed, hooks):
+        """ report a request outcome to the endpoint group breaker """
+        if self.breakers is None:
+            return
+        breaker = self.breakers.breaker(op)
+        state = breaker.failure() if failed else breaker.success()
+        if state is not None:
+            logger.warning("ESI circuit %s is now %s" % (op_group(op), state))
+            for hook in hooks:
+                hook.on_breaker(op_group(op), state)
+
+    def request(self, op, params, hooks=None, client=None):
+        """ the single place where plans talk to ESI """
+        hooks = self.hooks if hooks is None else hooks
+        client = client or self.esiclient
+        if not hooks:
+            return client.request(self.esiapp.op[op](**params))
+
+        response = None
+        start = time.perf_counter()
+        try:
+            response = client.request(self.esiapp.op[op](**params))
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            for hook in hooks:
+                hook.on_request(op, response, elapsed)
+
+    def persist(self, plan, rows, hooks=None):
+        """ merge the changed rows of a page in one transaction """
+        hooks = self.hooks if hooks is None else hooks
+        if not rows:
+            return
+        start = time.perf_counter()
+        # split reads the database: nothing to report if it cannot
+        changed = touched = []
+        session = self.sessionmaker()
+        try:
+            changed, touched = self.writes.split(session, rows)
+            if not changed and not touched:
+                return
+            for row in changed:
+                session.merge(row)
+            if touched:
+                self.writes.touch(session, touched)
+            session.commit()
+        except Exception:
+            logger.exception("Cannot persist rows of plan %s" % plan.name)
+            session.rollback()
+        else:
+            self.writes.written(changed + touched)
+        finally:
+            session.close()
+        elapsed = time.perf_counter() - start
+        for hook in hooks:
+            hook.on_persist(plan, changed, elapsed)
+
+    @staticmethod
+    def make_key(op, params):
+        return (op,) + tuple(sorted(params.items()))
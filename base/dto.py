@@ -0,0 +1,279 @@
+# -*- encoding: utf-8 -*-
+""" Slim ESI results
+
+A pyswagger response keeps the raw body, all headers and the parsed
+models. The PlanRunner turns every response into a Result instead: the
+status, the expiry and a frozen, slotted dataclass holding only the
+fields this app reads. Results are what the response cache, the entity
+store and the templates hold, and they serialize with
+dataclasses.asdict.
+
+Operations without an entry in SLIM_OPS keep their parsed data as is.
+"""
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import fields
+
+import datetime
+
+
+# status of a placeholder Result: ESI did not answer and nothing is known
+UNAVAILABLE = 0
+
+
+@dataclass(frozen=True, slots=True)
+class Result:
+    """ what is kept of an ESI response; data is None unless status 200
+    (or an empty placeholder when status is UNAVAILABLE) """
+    status: int
+    data: object
+    expires: float = None
+
+
+def item(cls):
+    """ field of a tuple of `cls` """
+    return field(default=(), metadata={'item': cls})
+
+
+@dataclass(frozen=True, slots=True)
+class ServerStatus:
+    players: int = None
+    server_version: str = None
+    start_time: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Character:
+    name: str = None
+    birthday: str = None
+    corporation_id: int = None
+    alliance_id: int = None
+    security_status: float = None
+    description: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Corporation:
+    name: str = None
+    ticker: str = None
+    url: str = None
+    alliance_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Alliance:
+    name: str = None
+    ticker: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Online:
+    online: bool = None
+    last_login: str = None
+    last_logout: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Location:
+    solar_system_id: int = None
+    station_id: int = None
+    structure_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class SolarSystem:
+    system_id: int = None
+    name: str = None
+    constellation_id: int = None
+    security_status: float = None
+
+
+@dataclass(frozen=True, slots=True)
+class Station:
+    station_id: int = None
+    name: str = None
+    system_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Structure:
+    name: str = None
+    solar_system_id: int = None
+    type_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Fleet:
+    fleet_id: int = None
+    role: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Squad:
+    id: int = None
+    name: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Wing:
+    id: int = None
+    name: str = None
+    squads: tuple = item(Squad)
+
+
+@dataclass(frozen=True, slots=True)
+class Ship:
+    ship_name: str = None
+    ship_type_id: int = None
+    ship_item_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Type:
+    type_id: int = None
+    name: str = None
+    group_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Group:
+    group_id: int = None
+    name: str = None
+    category_id: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Skill:
+    skill_id: int = None
+    trained_skill_level: int = None
+    active_skill_level: int = None
+    skillpoints_in_skill: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Skills:
+    total_sp: int = None
+    unallocated_sp: int = None
+    skills: tuple = item(Skill)
+
+
+@dataclass(frozen=True, slots=True)
+class QueuedSkill:
+    skill_id: int = None
+    finished_level: int = None
+    queue_position: int = None
+    start_date: str = None
+    finish_date: str = None
+    level_start_sp: int = None
+    level_end_sp: int = None
+    training_start_sp: int = None
+
+
+@dataclass(frozen=True, slots=True)
+class Standing:
+    from_id: int = None
+    from_type: str = None
+    standing: float = None
+
+
+@dataclass(frozen=True, slots=True)
+class Name:
+    id: int = None
+    name: str = None
+    category: str = None
+
+
+@dataclass(frozen=True, slots=True)
+class Incursion:
+    constellation_id: int = None
+    staging_solar_system_id: int = None
+    state: str = None
+    type: str = None
+    has_boss: bool = None
+    influence: float = None
+    faction_id: int = None
+    infested_solar_systems: tuple = item(int)
+
+
+# ESI operation -> (data class, the response is a list of it)
+SLIM_OPS = {
+    'get_status': (ServerStatus, False),
+    'get_characters_character_id': (Character, False),
+    'get_corporations_corporation_id': (Corporation, False),
+    'get_alliances_alliance_id': (Alliance, False),
+    'get_characters_character_id_online': (Online, False),
+    'get_characters_character_id_location': (Location, False),
+    'get_universe_systems_system_id': (SolarSystem, False),
+    'get_universe_stations_station_id': (Station, False),
+    'get_universe_structures_structure_id': (Structure, False),
+    'get_characters_character_id_fleet': (Fleet, False),
+    'get_fleets_fleet_id_wings': (Wing, True),
+    'get_characters_character_id_ship': (Ship, False),
+    'get_universe_types_type_id': (Type, False),
+    'get_universe_groups_group_id': (Group, False),
+    'get_characters_character_id_implants': (int, True),
+    'get_characters_character_id_skills': (Skills, False),
+    'get_characters_character_id_skillqueue': (QueuedSkill, True),
+    'get_characters_character_id_standings': (Standing, True),
+    'get_incursions': (Incursion, True),
+    'post_universe_names': (Name, True),
+}
+
+
+def plain(value):
+    """ pyswagger primitives to plain, hashable python values """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return tuple(plain(entry) for entry in value)
+    # pyswagger Datetime / Date
+    return str(value)
+
+
+def build(cls, data):
+    """ a `cls` from a parsed model (or a dict), unknown fields dropped """
+    if cls in (int, str, float):
+        return cls(data)
+    values = {}
+    for attr in fields(cls):
+        value = data.get(attr.name)
+        nested = attr.metadata.get('item')
+        if nested is not None:
+            value = tuple(build(nested, entry) for entry in value or ())
+        else:
+            value = plain(value)
+        values[attr.name] = value
+    return cls(**values)
+
+
+def slim_data(op, data):
+    """ the slim data of an `op` response body """
+    slim = SLIM_OPS.get(op)
+    if slim is None:
+        return data
+    cls, many = slim
+    if many:
+        return tuple(build(cls, entry) for entry in data or ())
+    return build(cls, data)
+
+
+def unavailable(op):
+    """ placeholder Result for `op` when ESI cannot be reached and there is
+    no earlier data: empty data, so pages still render """
+    cls, many = SLIM_OPS.get(op, (None, False))
+    if many:
+        data = ()
+    elif cls is None or cls in (int, str, float):
+        data = None
+    else:
+        data = cls()
+    return Result(UNAVAILABLE, data, None)
+
+
+def slim(op, response, expires=None):
+    """ the Result of an `op` response """
+    if response.status != 200:
+        return Result(response.status, None, expires)
+    return Result(200, slim_data(op, response.data), expires)
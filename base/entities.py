@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+""" Shared entity metadata store
+
+Corporations, alliances, stations and structures rarely change and many
+pilots share the same ones. Their ESI responses are kept per entity type
+and ID for all users, much longer than the ESI Expires header says
+(ENTITY_TTL), and saved in the database so a new process starts warm.
+
+Entities ESI does not know (404), and stations and corporations a token
+is refused (403), are cached as negative entries for ENTITY_NEGATIVE_TTL
+so they do not cost an ESI error on every page. A 403 on a structure is
+not: it is about the docking ACL of that one pilot, others may well see
+it. A 401 is about the caller's token, never the entity. A negative
+entry never replaces a known positive one.
+"""
+from datetime import datetime
+
+from dto import Result
+from dto import slim_data
+
+import dataclasses
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# ESI operation -> (entity type, id parameter)
+ENTITY_OPS = {
+    'get_corporations_corporation_id': ('corporation', 'corporation_id'),
+    'get_alliances_alliance_id': ('alliance', 'alliance_id'),
+    'get_universe_stations_station_id': ('station', 'station_id'),
+    'get_universe_structures_structure_id': ('structure', 'structure_id'),
+}
+ENTITY_TYPE_OPS = dict((kind, op) for op, (kind, _) in ENTITY_OPS.items())
+
+# seconds an entity is served from the store
+DEFAULT_TTL = {
+    'corporation': 86400,
+    'alliance': 86400,
+    'station': 7 * 86400,
+    'structure': 86400,
+}
+DEFAULT_NEGATIVE_TTL = 3600
+
+# responses cached as negative, by entity type: what holds for everyone
+NEGATIVE_STATUS = {
+    'corporation': (403, 404),
+    'alliance': (403, 404),
+    'station': (403, 404),
+    'structure': (404,),
+}
+
+
+class EntityStore(object):
+    """ process wide entity cache, backed by a database table
+
+    model        ORM class with entity_type, entity_id, status, data and
+                 expires columns
+    sessionmaker session factory of the model's database
+    """
+    def __init__(self, model, sessionmaker, ttl=None, negative_ttl=None):
+        self.model = model
+        self.sessionmaker = sessionmaker
+        self.ttl = dict(DEFAULT_TTL, **(ttl or {}))
+        self.negative_ttl = (
+            DEFAULT_NEGATIVE_TTL if negative_ttl is None else negative_ttl
+        )
+        self._entries = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def handles(op):
+        return op in ENTITY_OPS
+
+    @staticmethod
+    def entity_key(op, params):
+        kind, id_param = ENTITY_OPS[op]
+        return kind, int(params[id_param])
+
+    def load(self):
+        """ read every unexpired entity from the database """
+        session = self.sessionmaker()
+        try:
+            rows = session.query(self.model).filter(
+                self.model.expires > datetime.utcnow()
+            ).all()
+            entries = {}
+            for row in rows:
+                op = ENTITY_TYPE_OPS.get(row.entity_type)
+                if op is None:
+                    continue
+                if row.status != 200 and row.status not in NEGATIVE_STATUS[row.entity_type]:
+                    # saved before these were per pilot
+                    continue
+                entries[row.entity_type, row.entity_id] = Result(
+                    row.status,
+                    slim_data(op, json.loads(row.data)) if row.data else None,
+                    (row.expires - datetime(1970, 1, 1)).total_seconds(),
+                )
+        except Exception:
+            logger.exception("Cannot load the entity store")
+            return 0
+        finally:
+            session.close()
+        with self._lock:
+            self._entries.update(entries)
+        return len(entries)
+
+    def get(self, op, params, stale=False):
+        """ the stored record for this ESI call, None if unknown or expired
+        (unless `stale`) """
+        record = self._entries.get(self.entity_key(op, params))
+        if record is None or (not stale and record.expires < time.time()):
+            return None
+        return record
+
+    def put(self, op, params, result):
+        """ keep an ESI result; returns the record to use in its place,
+        or None when the result is not storable (errors, timeouts) """
+        if result is None:
+            return None
+        key = self.entity_key(op, params)
+        status = result.status
+        if status == 200:
+            record = Result(200, result.data, time.time() + self.ttl[key[0]])
+        elif status in NEGATIVE_STATUS[key[0]]:
+            current = self._entries.get(key)
+            if current is not None and current.status == 200:
+                return None
+            record = Result(status, None, time.time() + self.negative_ttl)
+        else:
+            return None
+        with self._lock:
+            self._entries[key] = record
+            self._dirty[key] = record
+        return record
+
+    def flush(self):
+        """ write the entities stored since the last flush, one transaction """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        session = self.sessionmaker()
+        try:
+            for (kind, entity_id), record in dirty.items():
+                session.merge(self.model(
+                    entity_type=kind,
+                    entity_id=entity_id,
+                    status=record.status,
+                    data=(
+                        json.dumps(dataclasses.asdict(record.data))
+                        if record.data is not None else None
+                    ),
+                    expires=datetime.utcfromtimestamp(record.expires),
+                ))
+            session.commit()
+        except Exception:
+            logger.exception("Cannot persist %d entities" % len(dirty))
+            session.rollback()
+        finally:
+            session.close()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._dirty = {}
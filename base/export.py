@@ -0,0 +1,191 @@
+# -*- encoding: utf-8 -*-
+""" Streaming exports of the pilot data
+
+/api/v1/export/<dataset> streams the registered pilots of a corporation
+(or alliance) as NDJSON or CSV, optionally gzipped, for spreadsheets:
+
+    pilots  one row per pilot: status, ship role and skill points
+    fleets  the pilots in a fleet, by fleet
+    skills  one row per trained skill of each pilot
+
+Rows are read with a server-side cursor, `yield_per` at a time, and
+written out in chunks of about `chunk_size` bytes, so memory does not
+grow with the number of rows. The header (or the first row) goes out
+before the rest is read.
+"""
+import calendar
+import csv
+import io
+import json
+import zlib
+
+DATASETS = {
+    'pilots': (
+        'id', 'name', 'corporation_id', 'alliance_id', 'online', 'system',
+        'system_id', 'docked', 'fleet', 'ship', 'role', 'total_sp',
+        'unallocated_sp', 'last_updated',
+    ),
+    'fleets': (
+        'fleet', 'id', 'name', 'role', 'ship', 'system', 'system_id',
+        'docked', 'last_updated',
+    ),
+    'skills': (
+        'id', 'name', 'skill_id', 'skill', 'trained_skill_level',
+        'active_skill_level', 'skillpoints_in_skill',
+    ),
+}
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def timestamp(value):
+    return calendar.timegm(value.utctimetuple()) if value is not None else None
+
+
+def number(value):
+    """ SP columns are stored as strings """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Exporter(object):
+    """ streams the DATASETS
+
+    names   NameStore of the skill names, only what it already knows is
+            used: an export never calls ESI
+    """
+    def __init__(self, sessionmaker, characters, status, skills, names=None,
+                 yield_per=500, chunk_size=65536):
+        self.sessionmaker = sessionmaker
+        self.Characters = characters
+        self.CharacterStatus = status
+        self.Skills = skills
+        self.names = names
+        self.yield_per = yield_per
+        self.chunk_size = chunk_size
+
+    # -------------------------------------------------------------------
+    # Rows
+    # -------------------------------------------------------------------
+    def query(self, session, dataset, corporation_id=None, alliance_id=None):
+        Characters = self.Characters
+        CharacterStatus = self.CharacterStatus
+        Skills = self.Skills
+        if dataset == 'pilots':
+            query = session.query(
+                Characters.id, Characters.name, Characters.corporation_id,
+                Characters.alliance_id, CharacterStatus.online,
+                CharacterStatus.location, CharacterStatus.system_id,
+                CharacterStatus.docked, CharacterStatus.fleet,
+                CharacterStatus.ship_type, CharacterStatus.role,
+                Skills.total_sp, Skills.unallocated_sp,
+                CharacterStatus.last_updated,
+            ).outerjoin(
+                CharacterStatus, CharacterStatus.id == Characters.id
+            ).outerjoin(Skills, Skills.id == Characters.id)
+        elif dataset == 'fleets':
+            query = session.query(
+                CharacterStatus.fleet, Characters.id, Characters.name,
+                CharacterStatus.role, CharacterStatus.ship_type,
+                CharacterStatus.location, CharacterStatus.system_id,
+                CharacterStatus.docked, CharacterStatus.last_updated,
+            ).join(
+                CharacterStatus, CharacterStatus.id == Characters.id
+            ).filter(CharacterStatus.fleet.isnot(None), CharacterStatus.fleet != '')
+        else:
+            query = session.query(
+                Characters.id, Characters.name, Skills.skills,
+            ).join(Skills, Skills.id == Characters.id)
+        if alliance_id is not None:
+            query = query.filter(Characters.alliance_id == alliance_id)
+        else:
+            query = query.filter(Characters.corporation_id == corporation_id)
+        if dataset == 'fleets':
+            query = query.order_by(CharacterStatus.fleet, Characters.id)
+        else:
+            query = query.order_by(Characters.id)
+        return query.execution_options(
+            stream_results=True, yield_per=self.yield_per
+        )
+
+    def rows(self, dataset, corporation_id=None, alliance_id=None):
+        """ the rows of `dataset`, as tuples of DATASETS[dataset] """
+        session = self.sessionmaker()
+        try:
+            query = self.query(session, dataset, corporation_id, alliance_id)
+            if dataset == 'pilots':
+                for row in query:
+                    yield row[:4] + (
+                        row.online in ('1', 'True', 'true'),
+                    ) + row[5:8] + (row.fleet or None,) + row[9:11] + (
+                        number(row.total_sp), number(row.unallocated_sp),
+                        timestamp(row.last_updated),
+                    )
+            elif dataset == 'fleets':
+                for row in query:
+                    yield row[:8] + (timestamp(row.last_updated),)
+            else:
+                for character_id, name, skills in query:
+                    for skill in json.loads(skills or '[]'):
+                        yield (
+                            character_id, name, skill['skill_id'],
+                            self.skill_name(skill['skill_id']),
+                            skill['trained_skill_level'],
+                            skill['active_skill_level'],
+                            skill['skillpoints_in_skill'],
+                        )
+        finally:
+            session.close()
+
+    def skill_name(self, skill_id):
+        if self.names is None:
+            return None
+        return self.names.known(skill_id)
+
+    # -------------------------------------------------------------------
+    # Encoding
+    # -------------------------------------------------------------------
+    def lines(self, dataset, format, rows):
+        """ text of the export, the header first, then chunks of rows """
+        fields = DATASETS[dataset]
+        buffer = io.StringIO()
+        if format == 'csv':
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(fields)
+            write = writer.writerow
+        else:
+            def write(row):
+                buffer.write(json.dumps(
+                    dict(zip(fields, row)), separators=(',', ':')
+                ))
+                buffer.write('\n')
+        # the header (or the first row) right away
+        first = True
+        for row in rows:
+            write(row)
+            if first or buffer.tell() >= self.chunk_size:
+                first = False
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if first or buffer.tell():
+            yield buffer.getvalue()
+
+    def stream(self, dataset, format='ndjson', compress=False, **scope):
+        """ bytes of the export, gzipped if `compress` """
+        chunks = (
+            chunk.encode('utf-8')
+            for chunk in self.lines(dataset, format, self.rows(dataset, **scope))
+        )
+        if not compress:
+            yield from chunks
+            return
+        gzip = zlib.compressobj(wbits=31)
+        for chunk in chunks:
+            # a sync flush per chunk, so what is read is also sent
+            yield gzip.compress(chunk) + gzip.flush(zlib.Z_SYNC_FLUSH)
+        yield gzip.flush()
@@ -0,0 +1,147 @@
+# -*- encoding: utf-8 -*-
+""" Bulk fleet invites
+
+The fleet boss posts the registered pilots to invite; each is placed in
+a squad by its role in the pilot status table (the ship roles: logi,
+dps, sniper, ...). A squad named like the role (or as FLEET_ROLE_SQUADS
+says) gets the pilots of that role. The others go to the emptiest
+squad, so the assignment is decided before the first call.
+
+The invites go out with the boss's token, `concurrency` at a time, and
+each outcome is yielded as soon as it is known, so the caller can
+stream them. Failed invites (pilot offline, already in a fleet, ...)
+cost ESI error budget: when X-Esi-Error-Limit-Remain drops to
+`error_floor`, no new invite is sent until the error window resets.
+"""
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from dataplan import header_value
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+Invitation = namedtuple('Invitation', 'character_id role wing_id squad_id')
+
+
+def assign(pilots, wings, role_squads=None):
+    """ Invitations of `pilots`, [(character ID, ship role)], over the
+    dto.Wing list of the fleet; `role_squads` maps a role to a squad name
+    when they are not named alike """
+    role_squads = role_squads or {}
+    squads = [(wing.id, squad) for wing in wings for squad in wing.squads]
+    by_name = {}
+    for wing_id, squad in squads:
+        by_name.setdefault((squad.name or '').strip().lower(), (wing_id, squad.id))
+    members = dict(((wing_id, squad.id), 0) for wing_id, squad in squads)
+
+    invitations = []
+    for character_id, role in pilots:
+        place = None
+        if role:
+            place = by_name.get(role_squads.get(role, role).strip().lower())
+        if place is None and members:
+            # no squad for this role: the emptiest one, first on ties
+            place = min(members, key=lambda key: members[key])
+        if place is not None:
+            members[place] += 1
+            invitations.append(Invitation(character_id, role, *place))
+        else:
+            # a fleet without squads: ESI picks one
+            invitations.append(Invitation(character_id, role, None, None))
+    return invitations
+
+
+class ErrorBudget(object):
+    """ the ESI error limit, as the last response told it """
+    def __init__(self, floor=20):
+        self.floor = floor
+        self.remain = None
+        self.reset_at = 0
+        self._lock = threading.Lock()
+
+    def observe(self, response):
+        remain = header_value(response, 'X-Esi-Error-Limit-Remain')
+        reset = header_value(response, 'X-Esi-Error-Limit-Reset')
+        if remain is None:
+            return
+        with self._lock:
+            self.remain = int(remain)
+            self.reset_at = time.time() + int(reset or 0)
+
+    def delay(self):
+        """ seconds to wait before the next call, 0 to go ahead """
+        with self._lock:
+            if self.remain is None or self.remain > self.floor:
+                return 0
+            return max(0, self.reset_at - time.time())
+
+
+class FleetInviter(object):
+    """ sends the invitations of one fleet
+
+    request      callable(op, params) -> ESI response, with the boss's token
+    concurrency  invites in flight at most
+    """
+    def __init__(self, request, concurrency=8, error_floor=20):
+        self.request = request
+        self.concurrency = concurrency
+        self.budget = ErrorBudget(error_floor)
+
+    def invite(self, fleet_id, invitations):
+        """ yields the outcome of each invitation, as they complete """
+        invitations = list(invitations)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            pending = {}
+            position = 0
+            while position < len(invitations) or pending:
+                while position < len(invitations) and len(pending) < self.concurrency:
+                    delay = self.budget.delay()
+                    if delay:
+                        if pending:
+                            break
+                        logger.warning("Fleet %d: ESI error limit low, waiting %ds" % (
+                            fleet_id, delay))
+                        time.sleep(delay)
+                    invitation = invitations[position]
+                    position += 1
+                    pending[executor.submit(self.send, fleet_id, invitation)] = invitation
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    invitation = pending.pop(future)
+                    yield self.outcome(invitation, future)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def send(self, fleet_id, invitation):
+        invite = {'character_id': invitation.character_id, 'role': 'squad_member'}
+        if invitation.squad_id is not None:
+            invite['wing_id'] = invitation.wing_id
+            invite['squad_id'] = invitation.squad_id
+        response = self.request(
+            'post_fleets_fleet_id_members',
+            {'fleet_id': fleet_id, 'invitation': invite},
+        )
+        self.budget.observe(response)
+        return response
+
+    @staticmethod
+    def outcome(invitation, future):
+        outcome = dict(invitation._asdict(), status='invited')
+        try:
+            response = future.result()
+        except Exception as e:
+            logger.exception("Fleet invite of %d failed" % invitation.character_id)
+            return dict(outcome, status='failed', code=None, reason=str(e))
+        outcome['code'] = response.status
+        if response.status != 204:
+            data = getattr(response, 'data', None)
+            outcome['status'] = 'failed'
+            outcome['reason'] = data.get('error') if isinstance(data, dict) else None
+        return outcome
@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+""" Template fragment cache
+
+Wrap a part of a template in a cache block, listing the data it is
+rendered from:
+
+    {% cache 'skills', skills, skillqueue %}
+        ... only uses skills and skillqueue ...
+    {% endcache %}
+
+The rendered HTML is stored under the template name, the fragment name
+and a digest of those values (their ESI data), so a fragment is
+rendered again exactly when its data changes: a new snapshot means a new
+key, and the stale entry ages out of the LRU (or its Redis TTL). Every
+value the fragment shows must be in the list.
+
+Entries live in an in-process LRU, and also in Redis when
+FRAGMENT_CACHE_REDIS is set, so gunicorn workers share their renders.
+"""
+from jinja2 import Undefined
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from markupsafe import Markup
+
+import collections
+import dataclasses
+import hashlib
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+REDIS_PREFIX = 'fragment:'
+
+
+def snapshot(value):
+    """ the JSON-able data behind a template value """
+    if isinstance(value, Undefined):
+        return None
+    if isinstance(value, (list, tuple)):
+        return [snapshot(item) for item in value]
+    data = getattr(value, 'data', None)
+    if data is not None:
+        value = data
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    return value
+
+
+def version(values):
+    """ digest of the data a fragment is rendered from """
+    body = json.dumps(
+        snapshot(values), sort_keys=True, separators=(',', ':'), default=str
+    )
+    return hashlib.blake2b(body.encode(), digest_size=16).hexdigest()
+
+
+class FragmentCache(object):
+    """ Flask extension: LRU of rendered fragments, optionally in Redis """
+    def __init__(self, app=None):
+        self.enabled = False
+        self.max_entries = 1024
+        self.ttl = 3600
+        self.redis_url = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+        self.max_entries = app.config.get('FRAGMENT_CACHE_SIZE', 1024)
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', 3600)
+        if app.config.get('FRAGMENT_CACHE_REDIS'):
+            self.redis_url = app.config.get('REDIS_URL')
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+
+    @staticmethod
+    def key(template, name, values):
+        return '%s:%s:%s' % (template, name, version(values))
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        if self.redis_url:
+            try:
+                value = self.redis().get(REDIS_PREFIX + key)
+            except Exception:
+                logger.warning("Fragment cache: Redis get failed", exc_info=True)
+                return None
+            if value is not None:
+                value = value.decode('utf-8')
+                self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if self.redis_url:
+            try:
+                self.redis().setex(REDIS_PREFIX + key, self.ttl, value)
+            except Exception:
+                logger.warning("Fragment cache: Redis set failed", exc_info=True)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def redis(self):
+        if self._redis is None:
+            import redis
+            self._redis = redis.from_url(
+                self.redis_url, socket_timeout=1, socket_connect_timeout=1
+            )
+        return self._redis
+
+    def clear(self):
+        with self._lock:
+            self._entries = collections.OrderedDict()
+
+
+class FragmentCacheExtension(Extension):
+    """ the {% cache name, value, ... %} ... {% endcache %} tag """
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        values = []
+        while parser.stream.skip_if('comma'):
+            values.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        args = [nodes.Const(parser.name), name, nodes.List(values)]
+        return nodes.CallBlock(
+            self.call_method('_render', args), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, template, name, values, caller):
+        cache = getattr(self.environment, 'fragment_cache', None)
+        if cache is None or not cache.enabled:
+            return caller()
+        key = cache.key(template, name, values)
+        value = cache.get(key)
+        if value is None:
+            value = str(caller())
+            cache.set(key, value)
+        return Markup(value)
@@ -0,0 +1,49 @@
+# -*- encoding: utf-8 -*-
+# gunicorn loads ./gunicorn.conf.py automatically, the command line
+# flags in the Dockerfile still apply on top of it.
+import glob
+import logging
+import os
+
+
+def on_starting(server):
+    """ start with an empty prometheus multiprocess directory """
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for name in glob.glob(os.path.join(path, '*.db')):
+            os.remove(name)
+
+
+def child_exit(server, worker):
+    """ drop the live gauges of a dead worker from /metrics """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    """ with --preload the app is imported by now: compile and freeze
+    what the workers share before they fork """
+    if server.cfg.preload_app:
+        import warmup
+        warmup.warm(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        import base
+        base.after_fork()
+
+
+def post_worker_init(worker):
+    """ log the memory of every new worker, shared vs private """
+    import warmup
+    values = warmup.memory()
+    if values:
+        logging.getLogger('gunicorn.error').info(
+            "Worker %d memory: RSS %.1f MB, PSS %.1f MB, shared %.1f MB, "
+            "private %.1f MB" % (
+                os.getpid(), values['Rss'] / 1024.0, values['Pss'] / 1024.0,
+                values['Shared'] / 1024.0, values['Private'] / 1024.0)
+        )
@@ -0,0 +1,117 @@
+# -*- encoding: utf-8 -*-
+""" Liveness and readiness state
+
+The probes must not do any I/O themselves: a daemon thread checks the
+database, the cache tier and the poller heartbeat every few seconds and
+keeps the result in memory, /readyz only reads it.
+"""
+from sqlalchemy import text
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# redis key holding the unix time of the last poller snapshot
+POLLER_HEARTBEAT_KEY = 'poller:last_snapshot'
+
+
+class HealthMonitor(object):
+    """ background checks for /readyz """
+    def __init__(self, engine, esiapp, redis_url=None, interval=10,
+                 max_snapshot_age=None):
+        self.engine = engine
+        self.esiapp = esiapp
+        self.redis_url = redis_url
+        self.interval = interval
+        self.max_snapshot_age = max_snapshot_age
+        self.started = time.time()
+        self.state = {
+            'database': False,
+            'swagger': esiapp is not None,
+            'cache': None,
+            'snapshot_time': None,
+            'checked': None,
+        }
+        self._redis = None
+        self._thread = None
+
+    def start(self):
+        """ start the check thread, once per process """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._loop, name='health-monitor', daemon=True
+        )
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def check(self):
+        """ run every check and swap in the new state at once """
+        state = dict(self.state)
+        state['database'] = self._check_database()
+        state['swagger'] = self.esiapp is not None
+        if self.redis_url:
+            state['cache'], state['snapshot_time'] = self._check_cache()
+        state['checked'] = time.time()
+        self.state = state
+
+    def _check_database(self):
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            logger.exception("Health check: database unreachable")
+            return False
+
+    def _check_cache(self):
+        try:
+            if self._redis is None:
+                import redis
+                self._redis = redis.from_url(
+                    self.redis_url, socket_timeout=1, socket_connect_timeout=1
+                )
+            snapshot = self._redis.get(POLLER_HEARTBEAT_KEY)
+            return True, float(snapshot) if snapshot is not None else None
+        except Exception:
+            logger.exception("Health check: cache unreachable")
+            return False, None
+
+    def liveness(self):
+        return {'status': 'ok', 'uptime': round(time.time() - self.started, 1)}
+
+    def readiness(self):
+        """ (ready, report) from the last check, no I/O """
+        state = self.state
+        now = time.time()
+        snapshot_age = None
+        if state['snapshot_time'] is not None:
+            snapshot_age = round(now - state['snapshot_time'], 1)
+
+        ready = (
+            state['checked'] is not None
+            and state['database']
+            and state['swagger']
+            and state['cache'] is not False
+        )
+        if (self.max_snapshot_age and snapshot_age is not None
+                and snapshot_age > self.max_snapshot_age):
+            ready = False
+
+        return ready, {
+            'status': 'ok' if ready else 'unavailable',
+            'database': state['database'],
+            'swagger': state['swagger'],
+            'cache': state['cache'],
+            'snapshot_age': snapshot_age,
+            'checked_age': (
+                round(now - state['checked'], 1)
+                if state['checked'] is not None else None
+            ),
+        }
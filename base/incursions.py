@@ -0,0 +1,277 @@
+# -*- encoding: utf-8 -*-
+""" Incursion tracker and change feed
+
+The worker polls /incursions/ once per ESI cache period
+(poll_incursions_job) and keeps every poll as a snapshot of small integer
+rows: constellation, staging system, state, influence (per mille) and
+boss. Each snapshot is diffed against the previous one and the changes
+are appended to the event table: spawns, despawns, state and boss
+changes. The event ID is the feed offset; readers (the pages, the API,
+notifications) ask for the events after the last ID they have seen and
+never call ESI for incursions themselves.
+
+The snapshots double as the influence time-series of a constellation.
+Every poll is also a row of its own in the polls table, with the number
+of incursions: a poll without any incursion has no snapshot rows, and
+it is still the one the next poll is diffed against and the one
+current() shows.
+"""
+from sqlalchemy import func
+
+from jobs import schedule_once
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# incursion states, integer coded; 0 is a state this code does not know
+STATES = ('unknown', 'established', 'mobilizing', 'withdrawing')
+STATE_CODES = dict((name, code) for code, name in enumerate(STATES))
+
+# event kinds
+SPAWN = 1
+DESPAWN = 2
+STATE = 3
+BOSS = 4
+EVENT_KINDS = {SPAWN: 'spawn', DESPAWN: 'despawn', STATE: 'state', BOSS: 'boss'}
+
+# one snapshot row: the diffed fields, in this order
+SNAPSHOT_FIELDS = (
+    'constellation_id', 'staging_system_id', 'state', 'influence', 'has_boss',
+)
+EVENT_FIELDS = (
+    'id', 'at', 'kind', 'constellation_id', 'staging_system_id', 'state',
+    'previous_state', 'influence', 'has_boss',
+)
+
+# same ESI cache period as /incursions/
+DEFAULT_POLL_INTERVAL = 300
+
+# one scheduled poll job at a time, whoever schedules it
+JOB_ID = 'poll-incursions'
+
+
+def encode(incursion):
+    """ snapshot row of a dto.Incursion, as a tuple of SNAPSHOT_FIELDS """
+    return (
+        incursion.constellation_id,
+        incursion.staging_solar_system_id,
+        STATE_CODES.get(incursion.state, 0),
+        int(round((incursion.influence or 0) * 1000)),
+        1 if incursion.has_boss else 0,
+    )
+
+
+def diff(previous, current):
+    """ events turning the `previous` snapshot into `current`; both map
+    constellation ID -> snapshot row. Events are (kind, row, previous
+    state) tuples """
+    events = []
+    for constellation_id, row in current.items():
+        before = previous.get(constellation_id)
+        if before is None:
+            events.append((SPAWN, row, None))
+            continue
+        if row[2] != before[2]:
+            events.append((STATE, row, before[2]))
+        if row[4] != before[4]:
+            events.append((BOSS, row, None))
+    for constellation_id, before in previous.items():
+        if constellation_id not in current:
+            events.append((DESPAWN, before, before[2]))
+    return events
+
+
+class IncursionTracker(object):
+    """ snapshots and change feed of the incursions
+
+    snapshots  ORM class with polled_at + SNAPSHOT_FIELDS columns
+    events     ORM class with EVENT_FIELDS columns, id autoincremented
+    polls      ORM class with polled_at (primary key) and count columns
+    keep       days of snapshots kept for the influence history
+    refresh    seconds readers reuse the current snapshot before reading
+               the table again
+    """
+    def __init__(self, sessionmaker, snapshots, events, polls, keep=30, refresh=30):
+        self.sessionmaker = sessionmaker
+        self.Snapshots = snapshots
+        self.Events = events
+        self.Polls = polls
+        self.keep = keep
+        self.refresh = refresh
+        self._current = (0, None, [])
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------------------------
+    # Writer (the worker)
+    # -------------------------------------------------------------------
+    def latest(self, session):
+        """ (polled_at, {constellation ID: row}) of the last poll, empty
+        if it saw no incursion """
+        Snapshots = self.Snapshots
+        polled_at = session.query(func.max(self.Polls.polled_at)).scalar()
+        if polled_at is None:
+            # recorded before there was a polls table
+            polled_at = session.query(func.max(Snapshots.polled_at)).scalar()
+        if polled_at is None:
+            return None, {}
+        rows = session.query(
+            *[getattr(Snapshots, name) for name in SNAPSHOT_FIELDS]
+        ).filter(Snapshots.polled_at == polled_at).all()
+        return polled_at, dict((row[0], tuple(row)) for row in rows)
+
+    def record(self, incursions, polled_at=None):
+        """ store a poll of dto.Incursion and the events since the last
+        one, in one transaction; returns the number of new events """
+        polled_at = int(polled_at or time.time())
+        current = dict(
+            (row[0], row) for row in map(encode, incursions)
+            if row[0] is not None
+        )
+        session = self.sessionmaker()
+        try:
+            last_polled, previous = self.latest(session)
+            if last_polled is not None and polled_at <= last_polled:
+                # same ESI data polled twice in a second
+                return 0
+            events = diff(previous, current)
+            session.add(self.Polls(polled_at=polled_at, count=len(current)))
+            session.add_all([
+                self.Snapshots(polled_at=polled_at, **dict(zip(SNAPSHOT_FIELDS, row)))
+                for row in current.values()
+            ])
+            session.add_all([
+                self.Events(
+                    at=polled_at,
+                    kind=kind,
+                    previous_state=previous_state,
+                    **dict(zip(SNAPSHOT_FIELDS, row))
+                )
+                for kind, row, previous_state in events
+            ])
+            if self.keep:
+                for model in (self.Snapshots, self.Polls):
+                    session.query(model).filter(
+                        model.polled_at < polled_at - self.keep * 86400
+                    ).delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            logger.exception("Cannot record the incursions poll")
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return len(events)
+
+    # -------------------------------------------------------------------
+    # Readers
+    # -------------------------------------------------------------------
+    def current(self):
+        """ the incursions of the last poll, as dicts; read from the
+        tables at most every `refresh` seconds """
+        checked, polled_at, incursions = self._current
+        if time.time() - checked < self.refresh:
+            return incursions
+        session = self.sessionmaker()
+        try:
+            polled_at, rows = self.latest(session)
+        except Exception:
+            logger.exception("Cannot read the incursions snapshot")
+            return incursions
+        finally:
+            session.close()
+        incursions = [self.decode(row) for row in sorted(rows.values())]
+        self._current = (time.time(), polled_at, incursions)
+        return incursions
+
+    def polled_at(self):
+        """ unix time of the poll current() returns, None if none """
+        return self._current[1]
+
+    def feed(self, after=0, limit=100):
+        """ events with an ID above `after`, oldest first, at most `limit`
+
+        Returns {'fields': EVENT_FIELDS, 'rows': ..., 'next': ID}; pass
+        'next' as `after` to get the events that came in since.
+        """
+        Events = self.Events
+        session = self.sessionmaker()
+        try:
+            rows = session.query(
+                *[getattr(Events, name) for name in EVENT_FIELDS]
+            ).filter(Events.id > after).order_by(Events.id).limit(limit).all()
+        finally:
+            session.close()
+        return {
+            'fields': EVENT_FIELDS,
+            'rows': [list(row) for row in rows],
+            'next': rows[-1].id if rows else after,
+        }
+
+    def last_id(self):
+        """ ID of the newest event, 0 if there is none """
+        session = self.sessionmaker()
+        try:
+            return session.query(func.max(self.Events.id)).scalar() or 0
+        finally:
+            session.close()
+
+    def history(self, constellation_id, since=0):
+        """ influence time-series of a constellation: [(polled_at,
+        influence per mille), ...] """
+        Snapshots = self.Snapshots
+        session = self.sessionmaker()
+        try:
+            return [tuple(row) for row in session.query(
+                Snapshots.polled_at, Snapshots.influence
+            ).filter(
+                Snapshots.constellation_id == constellation_id,
+                Snapshots.polled_at >= since,
+            ).order_by(Snapshots.polled_at).all()]
+        finally:
+            session.close()
+
+    @staticmethod
+    def decode(row):
+        values = dict(zip(SNAPSHOT_FIELDS, row))
+        values['state'] = STATES[values['state'] or 0]
+        values['influence'] = values['influence'] / 1000.0
+        values['has_boss'] = bool(values['has_boss'])
+        return values
+
+
+def poll_incursions_job():
+    """ RQ job: record the incursions, then schedule the next poll right
+    after the ESI cache expires """
+    from base import app
+    from base import esiapp
+    from base import esiclient
+    from base import incursion_tracker
+    from dataplan import ResponseCache
+    from dto import slim
+
+    from rq import get_current_job
+    job = get_current_job()
+    delay = app.config.get('INCURSION_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+    try:
+        response = esiclient.request(esiapp.op['get_incursions']())
+        if response.status != 200:
+            logger.warning("Incursions poll failed - status: %d" % response.status)
+            return None
+        expires = ResponseCache.expiry(response)
+        if expires is not None:
+            delay = max(1, int(expires - time.time()) + 1)
+        count = incursion_tracker.record(slim('get_incursions', response).data)
+        logger.info("Incursions poll: %d events" % count)
+        return count
+    finally:
+        # a failed poll must not break the chain
+        if job is not None:
+            schedule(job.connection, delay)
+
+
+def schedule(connection, delay=0):
+    """ (re)schedule the poll job, there is only ever one """
+    return schedule_once(connection, poll_incursions_job, JOB_ID, delay)
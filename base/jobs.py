@@ -0,0 +1,46 @@
+# -*- encoding: utf-8 -*-
+""" Self-rescheduling RQ jobs
+
+The background jobs (token refresh, incursions poll, notifications
+dispatch, SP history archive) each schedule their next run when they
+end, and the worker schedules them once when it starts. Every run gets
+its own job ID, '<name>-<due time>': a run that reused the ID of the
+one scheduling it would be marked finished (and expire) with it.
+
+There is still only ever one run of each waiting or running:
+schedule_once() does nothing if another one is scheduled, queued or
+started already.
+"""
+from datetime import timedelta
+
+import time
+
+
+def pending(queue, name, current=None):
+    """ IDs of the runs of `name` scheduled, queued or started, but
+    `current` """
+    prefix = name + '-'
+    job_ids = (
+        queue.scheduled_job_registry.get_job_ids()
+        + queue.get_job_ids()
+        + queue.started_job_registry.get_job_ids()
+    )
+    return [
+        job_id for job_id in job_ids
+        if job_id.startswith(prefix) and job_id != current
+    ]
+
+
+def schedule_once(connection, func, name, delay=0):
+    """ run `func` in `delay` seconds, unless a run of `name` is pending;
+    returns the job, None if it was not scheduled """
+    from rq import Queue
+    from rq import get_current_job
+    queue = Queue('default', connection=connection)
+    current = get_current_job()
+    if pending(queue, name, current.id if current is not None else None):
+        return None
+    return queue.enqueue_in(
+        timedelta(seconds=delay), func,
+        job_id='%s-%d' % (name, int(time.time() + delay)),
+    )
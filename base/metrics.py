@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+""" Prometheus metrics
+
+ESI and database timings come from a PlanHook on the PlanRunner, route
+timings from the Flask request lifecycle and token refreshes from the
+esipy AFTER_TOKEN_REFRESH signal. With gunicorn, set
+PROMETHEUS_MULTIPROC_DIR so /metrics aggregates every worker (see
+gunicorn.conf.py).
+"""
+from esipy.events import AFTER_TOKEN_REFRESH
+
+from flask import Response
+from flask import g
+from flask import request
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+
+from dataplan import PlanHook
+from dataplan import header_value
+
+import os
+import time
+
+ESI_BUCKETS = (.025, .05, .1, .2, .4, .8, 1.6, 3.2, 6.4, 12.8)
+ROUTE_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2, 4, 8, 16)
+DB_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+esi_request_seconds = Histogram(
+    'esi_request_seconds', 'ESI request latency', ['op'],
+    buckets=ESI_BUCKETS,
+)
+esi_responses_total = Counter(
+    'esi_responses_total', 'ESI responses by status code', ['op', 'status'],
+)
+esi_cache_total = Counter(
+    'esi_cache_total', 'ESI response cache lookups', ['op', 'result'],
+)
+esi_error_limit_remain = Gauge(
+    'esi_error_limit_remain', 'Remaining ESI error limit budget',
+    multiprocess_mode='livemin',
+)
+esi_error_limit_reset_seconds = Gauge(
+    'esi_error_limit_reset_seconds', 'Seconds until the ESI error limit resets',
+    multiprocess_mode='livemax',
+)
+route_seconds = Histogram(
+    'route_seconds', 'Route handling time, render included', ['endpoint'],
+    buckets=ROUTE_BUCKETS,
+)
+db_write_seconds = Histogram(
+    'db_write_seconds', 'Plan persistence transaction time', ['plan'],
+    buckets=DB_BUCKETS,
+)
+esi_breaker_open = Gauge(
+    'esi_breaker_open', 'ESI endpoint group circuit breaker open (1) or not',
+    ['group'], multiprocess_mode='livemax',
+)
+token_refresh_total = Counter(
+    'token_refresh_total', 'SSO access token refreshes',
+)
+
+
+class PlanMetrics(PlanHook):
+    """ records ESI and persistence metrics of a PlanRunner """
+    def __init__(self):
+        self._request = {}
+        self._status = {}
+        self._hit = {}
+        self._miss = {}
+        self._write = {}
+
+    def prepare(self, ops, plans):
+        """ create the labelled children up front, so observing a request
+        is a dict lookup plus the counter update """
+        for op in ops:
+            self._request[op] = esi_request_seconds.labels(op)
+            self._hit[op] = esi_cache_total.labels(op, 'hit')
+            self._miss[op] = esi_cache_total.labels(op, 'miss')
+            for status in ('200', '304', '403', '404', '420', '500', '502',
+                           '503', '504', 'error'):
+                self._status[op, status] = esi_responses_total.labels(op, status)
+        for plan in plans:
+            self._write[plan] = db_write_seconds.labels(plan)
+
+    def on_request(self, op, response, elapsed):
+        histogram = self._request.get(op) or esi_request_seconds.labels(op)
+        histogram.observe(elapsed)
+
+        status = str(response.status) if response is not None else 'error'
+        counter = self._status.get((op, status))
+        if counter is None:
+            counter = esi_responses_total.labels(op, status)
+        counter.inc()
+
+        if response is not None:
+            remain = header_value(response, 'X-Esi-Error-Limit-Remain')
+            if remain is not None:
+                esi_error_limit_remain.set(int(remain))
+            reset = header_value(response, 'X-Esi-Error-Limit-Reset')
+            if reset is not None:
+                esi_error_limit_reset_seconds.set(int(reset))
+
+    def on_cache(self, op, hit):
+        counter = (self._hit if hit else self._miss).get(op)
+        if counter is None:
+            counter = esi_cache_total.labels(op, 'hit' if hit else 'miss')
+        counter.inc()
+
+    def on_persist(self, plan, rows, elapsed):
+        histogram = self._write.get(plan.name) or db_write_seconds.labels(plan.name)
+        histogram.observe(elapsed)
+
+    def on_breaker(self, group, state):
+        esi_breaker_open.labels(group).set(1 if state == 'open' else 0)
+
+
+def count_token_refresh(**kwargs):
+    token_refresh_total.inc()
+
+
+def init_app(app, planner, plans):
+    """ hook the metrics into the app and planner, add /metrics """
+    plan_metrics = PlanMetrics()
+    plan_metrics.prepare(
+        set(
+            fetch.op
+            for plan in plans.values()
+            for section in plan.sections
+            for stage in section.stages
+            for fetch in stage
+        ),
+        plans.keys(),
+    )
+    planner.hooks.append(plan_metrics)
+    AFTER_TOKEN_REFRESH.add_receiver(count_token_refresh)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_route(response):
+        start = g.get('metrics_start')
+        if start is not None and request.endpoint is not None:
+            route_seconds.labels(request.endpoint).observe(
+                time.perf_counter() - start
+            )
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+    return plan_metrics
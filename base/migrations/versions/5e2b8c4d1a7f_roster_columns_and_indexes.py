@@ -0,0 +1,52 @@
+"""roster_columns_and_indexes
+
+Revision ID: 5e2b8c4d1a7f
+Revises: 3c1d5e7a9b20
+Create Date: 2026-10-19 11:40:03.552000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2b8c4d1a7f'
+down_revision = '3c1d5e7a9b20'
+branch_labels = None
+depends_on = None
+
+# characters and characterstatus are created by Base.metadata.create_all
+# on startup, so only add what an existing database is missing
+NEW_COLUMNS = (
+    ('characterstatus', sa.Column('system_id', sa.Integer(), nullable=True)),
+    ('characterstatus', sa.Column('ship_type', sa.String(length=64), nullable=True)),
+    ('characterstatus', sa.Column('role', sa.String(length=16), nullable=True)),
+)
+NEW_INDEXES = (
+    ('ix_characters_corporation_id_id', 'characters', ['corporation_id', 'id']),
+    ('ix_characters_alliance_id_id', 'characters', ['alliance_id', 'id']),
+    ('ix_characterstatus_system_id', 'characterstatus', ['system_id']),
+    ('ix_characterstatus_last_updated', 'characterstatus', ['last_updated']),
+)
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+    for table, column in NEW_COLUMNS:
+        if table not in tables:
+            continue
+        if column.name not in [c['name'] for c in inspector.get_columns(table)]:
+            op.add_column(table, column)
+    for name, table, columns in NEW_INDEXES:
+        if table not in tables:
+            continue
+        if name not in [i['name'] for i in inspector.get_indexes(table)]:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(NEW_INDEXES):
+        op.drop_index(name, table_name=table)
+    for table, column in reversed(NEW_COLUMNS):
+        op.drop_column(table, column.name)
@@ -0,0 +1,29 @@
+"""user_account_id
+
+Revision ID: 7a1c3e5b9d42
+Revises: 5e2b8c4d1a7f
+Create Date: 2026-10-19 15:02:27.904000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1c3e5b9d42'
+down_revision = '5e2b8c4d1a7f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # base and sso share the user table, either may get here first
+    inspector = sa.inspect(op.get_bind())
+    if 'account_id' not in [c['name'] for c in inspector.get_columns('user')]:
+        op.add_column('user', sa.Column('account_id', sa.BigInteger(), nullable=True))
+        op.create_index(op.f('ix_user_account_id'), 'user', ['account_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_account_id'), table_name='user')
+    op.drop_column('user', 'account_id')
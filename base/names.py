@@ -0,0 +1,146 @@
+# -*- encoding: utf-8 -*-
+""" Local store of EVE names
+
+The names of types, systems, corporations and characters are all a page
+needs from most lookups, and they (almost) never change. They are kept
+in memory and in the names table; IDs never seen before are resolved in
+bulk with POST /universe/names/, up to CHUNK IDs per call. Naming a list
+of any length costs one ESI call per CHUNK unknown IDs, and none once
+they are known.
+
+IDs ESI cannot name are remembered for `negative_ttl` seconds, so they
+are not asked for again on every render. One such ID makes ESI refuse
+the whole call (404), so a refused chunk is split in halves and asked
+again until the bad IDs are found; the others are named as usual. A
+call that fails otherwise (timeout, 5xx) marks nothing: it is only
+tried again on the next lookup.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# most IDs ESI takes in one /universe/names/ call
+CHUNK = 1000
+
+DEFAULT_NEGATIVE_TTL = 3600
+
+
+class NameStore(object):
+    """ process wide ID -> name map, backed by a database table
+
+    model        ORM class with id, name and category columns
+    sessionmaker session factory of the model's database
+    request      callable(IDs) -> Result of post_universe_names
+    """
+    def __init__(self, model, sessionmaker, request=None, chunk=CHUNK,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.model = model
+        self.sessionmaker = sessionmaker
+        self.request = request
+        self.chunk = chunk
+        self.negative_ttl = negative_ttl
+        self._names = {}
+        self._missing = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ read every known name from the database """
+        session = self.sessionmaker()
+        try:
+            rows = session.query(self.model.id, self.model.name).all()
+        except Exception:
+            logger.exception("Cannot load the name store")
+            return 0
+        finally:
+            session.close()
+        with self._lock:
+            self._names.update((row.id, row.name) for row in rows)
+        return len(rows)
+
+    def get(self, ids):
+        """ {ID: name} of `ids`; unknown ones are resolved first, those ESI
+        cannot name are left out """
+        ids = set(ids)
+        now = time.time()
+        unknown = [
+            entity_id for entity_id in ids
+            if entity_id not in self._names
+            and self._missing.get(entity_id, 0) < now
+        ]
+        if unknown:
+            self.resolve(sorted(unknown))
+        names = self._names
+        return dict(
+            (entity_id, names[entity_id]) for entity_id in ids
+            if entity_id in names
+        )
+
+    def name(self, entity_id):
+        return self.get([entity_id]).get(entity_id)
+
+    def known(self, entity_id):
+        """ name of `entity_id` if it is known, without asking ESI """
+        return self._names.get(entity_id)
+
+    def resolve(self, ids):
+        """ ask ESI for the names of `ids` and keep them """
+        if self.request is None:
+            return 0
+        resolved = []
+        missing = []
+        for start in range(0, len(ids), self.chunk):
+            self.lookup(ids[start:start + self.chunk], resolved, missing)
+        if missing:
+            with self._lock:
+                until = time.time() + self.negative_ttl
+                self._missing.update((entity_id, until) for entity_id in missing)
+        if resolved:
+            with self._lock:
+                self._names.update((entry.id, entry.name) for entry in resolved)
+            self.save(resolved)
+        return len(resolved)
+
+    def lookup(self, ids, resolved, missing):
+        """ one /universe/names/ call for `ids`, bisected on a 404 """
+        try:
+            result = self.request(ids)
+        except Exception:
+            logger.exception("Cannot resolve %d names" % len(ids))
+            return
+        if result is None:
+            return
+        if result.status == 200:
+            resolved.extend(result.data)
+        elif result.status == 404:
+            # one invalid ID fails the whole call
+            if len(ids) == 1:
+                missing.append(ids[0])
+                return
+            middle = len(ids) // 2
+            self.lookup(ids[:middle], resolved, missing)
+            self.lookup(ids[middle:], resolved, missing)
+        else:
+            logger.warning("Cannot resolve %d names - status: %d" % (
+                len(ids), result.status))
+
+    def save(self, entries):
+        """ write resolved names, one transaction """
+        session = self.sessionmaker()
+        try:
+            for entry in entries:
+                session.merge(self.model(
+                    id=entry.id, name=entry.name, category=entry.category,
+                ))
+            session.commit()
+        except Exception:
+            logger.exception("Cannot persist %d names" % len(entries))
+            session.rollback()
+        finally:
+            session.close()
+
+    def clear(self):
+        with self._lock:
+            self._names = {}
+            self._missing = {}
@@ -0,0 +1,513 @@
+# -*- encoding: utf-8 -*-
+""" Webhook notifications
+
+Incursion events (the tracker feed, see incursions.py) and fleet events
+(published by the web workers) are relayed to chat webhooks.
+
+The web workers only publish: one Redis command per event, never any
+HTTP. The worker runs dispatch_notifications_job every NOTIFY_INTERVAL
+seconds: it collects the new events, queues them per subscriber
+(NOTIFY_WEBHOOKS) and drains every subscriber's queue in its own thread,
+through one pooled HTTP session:
+
+- batching: up to `batch` events per webhook call
+- rate limiting: at most `rate` calls per second per destination, 429
+  answers and their Retry-After are honoured
+- retries: failed calls (5xx, timeouts) are retried with exponential
+  backoff; meanwhile the destination is skipped, the others go on
+- a slow destination only holds its own thread, each call is bounded
+  by NOTIFY_TIMEOUT; a run waits for the drains at most NOTIFY_INTERVAL
+  seconds, a drain still going on is left to finish and not started
+  again, so the next collect never waits for it
+
+The worker keeps one Dispatcher (its HTTP session and threads) for as
+long as it runs, see dispatcher_from_config.
+
+bench/webhooks.py is a local webhook stand-in to try it against.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from requests.adapters import HTTPAdapter
+
+from incursions import BOSS
+from incursions import DESPAWN
+from incursions import SPAWN
+from incursions import STATE
+from incursions import STATES
+from jobs import schedule_once
+
+import collections
+import json
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_KEY = 'notifications:outbox'
+PENDING_KEY = 'notifications:pending:%s'
+STATE_KEY = 'notifications:state:%s'
+FEED_OFFSET_KEY = 'notifications:incursion_offset'
+FLEET_KEY = 'notifications:fleet:%s'
+
+# event kinds
+INCURSION_SPAWN = 'incursion_spawn'
+INCURSION_DESPAWN = 'incursion_despawn'
+INCURSION_STATE = 'incursion_state'
+INCURSION_BOSS = 'incursion_boss'
+FLEET_FORM = 'fleet_form'
+INCURSION_EVENTS = {
+    SPAWN: INCURSION_SPAWN,
+    DESPAWN: INCURSION_DESPAWN,
+    STATE: INCURSION_STATE,
+    BOSS: INCURSION_BOSS,
+}
+DEFAULT_EVENTS = (INCURSION_SPAWN, INCURSION_BOSS, FLEET_FORM)
+
+MESSAGES = {
+    INCURSION_SPAWN: 'New incursion, staging in {system} ({state})',
+    INCURSION_DESPAWN: 'The incursion staging in {system} is over',
+    INCURSION_STATE: 'The incursion staging in {system} is now {state}',
+    INCURSION_BOSS: 'Incursion boss spawned, staging in {system}',
+    FLEET_FORM: '{character_name} formed a fleet',
+}
+
+# one scheduled dispatch job at a time, whoever schedules it
+JOB_ID = 'dispatch-notifications'
+
+
+def message(event):
+    """ chat line of an event """
+    return MESSAGES[event['kind']].format(**event)
+
+
+def body(format, events):
+    """ webhook payload of a batch of events """
+    if format == 'json':
+        return {'events': events}
+    text = '\n'.join(message(event) for event in events)
+    if format == 'slack':
+        return {'text': text}
+    # discord
+    return {'content': text}
+
+
+class Webhook(object):
+    """ a subscriber endpoint
+
+    events  event kinds it gets
+    format  'discord', 'slack' or 'json'
+    rate    most calls per second
+    batch   most events per call
+    """
+    def __init__(self, name, url, events=DEFAULT_EVENTS, format='discord',
+                 rate=1.0, batch=10):
+        self.name = name
+        self.url = url
+        self.events = frozenset(events)
+        self.format = format
+        self.rate = rate
+        self.batch = batch
+
+
+# -----------------------------------------------------------------------
+# Queues
+# -----------------------------------------------------------------------
+class MemoryMailbox(object):
+    """ outbox, per destination queues and state in this process only;
+    for a single process, e.g. the bench """
+    def __init__(self):
+        self.outbox = []
+        self.queues = collections.defaultdict(list)
+        self.states = {}
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            self.outbox.append(event)
+
+    def take(self):
+        """ every event in the outbox, which is emptied """
+        with self._lock:
+            events, self.outbox = self.outbox, []
+        return events
+
+    def claim(self, key, ttl):
+        """ True the first time `key` is claimed within `ttl` seconds """
+        with self._lock:
+            now = time.time()
+            if self.values.get(key, 0) > now:
+                return False
+            self.values[key] = now + ttl
+            return True
+
+    def offset(self):
+        return self.values.get(FEED_OFFSET_KEY)
+
+    def set_offset(self, offset):
+        self.values[FEED_OFFSET_KEY] = offset
+
+    def push(self, name, events):
+        with self._lock:
+            self.queues[name].extend(events)
+
+    def peek(self, name, count):
+        with self._lock:
+            return list(self.queues[name][:count])
+
+    def drop(self, name, count):
+        with self._lock:
+            del self.queues[name][:count]
+
+    def pending(self, name):
+        return len(self.queues[name])
+
+    def state(self, name):
+        return dict(self.states.get(name) or {})
+
+    def set_state(self, name, state):
+        self.states[name] = state
+
+
+class RedisMailbox(object):
+    """ the same, in Redis: shared by the web workers and the worker """
+    def __init__(self, connection=None, url=None):
+        self._redis = connection
+        self.url = url
+
+    def redis(self):
+        if self._redis is None:
+            import redis
+            # the web workers must not hang on a slow Redis
+            self._redis = redis.from_url(
+                self.url, socket_timeout=1, socket_connect_timeout=1
+            )
+        return self._redis
+
+    def publish(self, event):
+        self.redis().rpush(OUTBOX_KEY, json.dumps(event))
+
+    def take(self):
+        pipe = self.redis().pipeline()
+        pipe.lrange(OUTBOX_KEY, 0, -1)
+        pipe.delete(OUTBOX_KEY)
+        events, _ = pipe.execute()
+        return [json.loads(event) for event in events]
+
+    def claim(self, key, ttl):
+        return bool(self.redis().set(key, 1, nx=True, ex=int(ttl)))
+
+    def offset(self):
+        offset = self.redis().get(FEED_OFFSET_KEY)
+        return int(offset) if offset is not None else None
+
+    def set_offset(self, offset):
+        self.redis().set(FEED_OFFSET_KEY, offset)
+
+    def push(self, name, events):
+        if events:
+            self.redis().rpush(
+                PENDING_KEY % name, *[json.dumps(event) for event in events]
+            )
+
+    def peek(self, name, count):
+        return [
+            json.loads(event)
+            for event in self.redis().lrange(PENDING_KEY % name, 0, count - 1)
+        ]
+
+    def drop(self, name, count):
+        self.redis().ltrim(PENDING_KEY % name, count, -1)
+
+    def pending(self, name):
+        return self.redis().llen(PENDING_KEY % name)
+
+    def state(self, name):
+        state = self.redis().get(STATE_KEY % name)
+        return json.loads(state) if state else {}
+
+    def set_state(self, name, state):
+        self.redis().set(STATE_KEY % name, json.dumps(state))
+
+
+# -----------------------------------------------------------------------
+# Web side
+# -----------------------------------------------------------------------
+class Publisher(object):
+    """ queues events for the dispatcher; a no-op without a mailbox, and
+    never raises into a page """
+    def __init__(self, mailbox=None):
+        self.mailbox = mailbox
+        self._announced = set()
+
+    def publish(self, kind, **event):
+        if self.mailbox is None:
+            return
+        event.update(kind=kind, at=int(time.time()))
+        try:
+            self.mailbox.publish(event)
+        except Exception:
+            logger.exception("Cannot publish a %s notification" % kind)
+
+    def fleet_formed(self, fleet_id, character_id, character_name):
+        """ a fleet boss was seen in `fleet_id`, announced once per fleet
+        whichever process sees it first """
+        if self.mailbox is None or fleet_id in self._announced:
+            return
+        if len(self._announced) > 10000:
+            self._announced.clear()
+        self._announced.add(fleet_id)
+        try:
+            if not self.mailbox.claim(FLEET_KEY % fleet_id, 86400):
+                return
+        except Exception:
+            logger.exception("Cannot claim the fleet %s notification" % fleet_id)
+            return
+        self.publish(FLEET_FORM, fleet_id=fleet_id, character_id=character_id,
+                     character_name=character_name)
+
+
+# -----------------------------------------------------------------------
+# Worker side
+# -----------------------------------------------------------------------
+class Dispatcher(object):
+    """ fans events out to the webhooks and sends them
+
+    mailbox  MemoryMailbox or RedisMailbox
+    names    optional callable(system IDs) -> {system ID: name}, for the
+             incursion messages
+    """
+    def __init__(self, mailbox, webhooks, timeout=5, retries=5, backoff=2.0,
+                 max_backoff=300, max_pending=1000, names=None):
+        self.mailbox = mailbox
+        self.webhooks = list(webhooks)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self.names = names
+
+        size = max(1, len(self.webhooks))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        # webhook name -> future of its drain still running
+        self._draining = {}
+
+    def incursion_events(self, rows):
+        """ notification events of incursion feed rows """
+        events = []
+        for row in rows:
+            if row['kind'] == BOSS and not row['has_boss']:
+                # the boss is dead, nobody needs a ping for that
+                continue
+            events.append({
+                'kind': INCURSION_EVENTS[row['kind']],
+                'at': row['at'],
+                'constellation_id': row['constellation_id'],
+                'staging_system_id': row['staging_system_id'],
+                'state': STATES[row['state'] or 0],
+                'influence': row['influence'] / 1000.0,
+            })
+        system_ids = set(event['staging_system_id'] for event in events)
+        names = self.names(system_ids) if self.names and system_ids else {}
+        for event in events:
+            event['system'] = names.get(
+                event['staging_system_id'], event['staging_system_id']
+            )
+        return events
+
+    def collect(self, tracker=None, limit=500):
+        """ queue the outbox events, and the incursion feed events of the
+        IncursionTracker since the last run, per subscriber; returns the
+        number of events collected """
+        events = self.mailbox.take()
+        if tracker is not None:
+            offset = self.mailbox.offset()
+            if offset is None:
+                # first run: start at the end of the feed, not replay it
+                self.mailbox.set_offset(tracker.last_id())
+            else:
+                page = tracker.feed(offset, limit)
+                rows = [dict(zip(page['fields'], row)) for row in page['rows']]
+                events.extend(self.incursion_events(rows))
+                self.mailbox.set_offset(page['next'])
+        for webhook in self.webhooks:
+            self.mailbox.push(webhook.name, [
+                event for event in events if event['kind'] in webhook.events
+            ])
+            if webhook.name in self._draining:
+                # its drain takes from the head of the queue, trimmed next time
+                continue
+            # a destination down for long loses its oldest events
+            overflow = self.mailbox.pending(webhook.name) - self.max_pending
+            if overflow > 0:
+                logger.warning("Webhook %s: dropping %d queued events" % (
+                    webhook.name, overflow))
+                self.mailbox.drop(webhook.name, overflow)
+        return len(events)
+
+    def deliver(self, duration=5):
+        """ send the queued events of every webhook in parallel for up to
+        `duration` seconds; returns {webhook name: events sent} of the
+        drains done by then, the others go on in the background """
+        deadline = time.time() + duration
+        for webhook in self.webhooks:
+            if webhook.name not in self._draining:
+                self._draining[webhook.name] = self.executor.submit(
+                    self.drain, webhook, deadline
+                )
+        wait(list(self._draining.values()), timeout=duration)
+        sent = {}
+        for name, future in list(self._draining.items()):
+            if not future.done():
+                logger.warning("Webhook %s: still sending, skipped this run" % name)
+                continue
+            del self._draining[name]
+            try:
+                sent[name] = future.result()
+            except Exception:
+                logger.exception("Webhook %s: drain failed" % name)
+                sent[name] = 0
+        return sent
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def drain(self, webhook, deadline):
+        """ send the queue of one webhook in batches until it is empty,
+        the deadline passes or the webhook must be left alone for now """
+        sent = 0
+        while True:
+            state = self.mailbox.state(webhook.name)
+            wait = state.get('next_at', 0) - time.time()
+            if time.time() + max(wait, 0) >= deadline:
+                break
+            if wait > 0:
+                time.sleep(wait)
+            batch = self.mailbox.peek(webhook.name, webhook.batch)
+            if not batch:
+                break
+            status, retry_after = self.send(webhook, batch)
+            now = time.time()
+            failures = state.get('failures', 0)
+            if status is not None and status < 300:
+                self.mailbox.drop(webhook.name, len(batch))
+                sent += len(batch)
+                failures = 0
+                next_at = now + 1.0 / webhook.rate
+            elif status == 429:
+                next_at = now + retry_after
+            elif status is not None and status < 500:
+                # the endpoint will not take it, retrying cannot help
+                logger.error("Webhook %s refused %d events - status: %d" % (
+                    webhook.name, len(batch), status))
+                self.mailbox.drop(webhook.name, len(batch))
+                failures = 0
+                next_at = now + 1.0 / webhook.rate
+            else:
+                failures += 1
+                if failures > self.retries:
+                    logger.error("Webhook %s: dropping %d events after %d tries" % (
+                        webhook.name, len(batch), failures))
+                    self.mailbox.drop(webhook.name, len(batch))
+                    failures = 0
+                next_at = now + min(self.max_backoff, self.backoff ** failures)
+            self.mailbox.set_state(webhook.name, {
+                'next_at': next_at, 'failures': failures,
+            })
+        return sent
+
+    def send(self, webhook, batch):
+        """ one webhook call; returns (status, seconds to wait on a 429),
+        status None when the call did not complete """
+        try:
+            response = self.session.post(
+                webhook.url, json=body(webhook.format, batch),
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            logger.warning("Webhook %s failed: %s" % (webhook.name, e))
+            return None, None
+        retry_after = None
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get('Retry-After', 1))
+            except ValueError:
+                retry_after = 1.0
+        return response.status_code, retry_after
+
+
+def webhooks_from_config(config):
+    """ Webhooks of the NOTIFY_WEBHOOKS setting """
+    return [Webhook(**options) for options in config.get('NOTIFY_WEBHOOKS') or []]
+
+
+# the worker's Dispatcher, kept from one run to the next
+_dispatcher = None
+
+
+def dispatcher_from_config(app, connection=None, names=None):
+    """ the Dispatcher of this process, made on the first call """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = Dispatcher(
+            RedisMailbox(connection, url=app.config.get('REDIS_URL')),
+            webhooks_from_config(app.config),
+            timeout=app.config.get('NOTIFY_TIMEOUT', 5),
+            retries=app.config.get('NOTIFY_RETRIES', 5),
+            backoff=app.config.get('NOTIFY_BACKOFF', 2.0),
+            names=names,
+        )
+    return _dispatcher
+
+
+def dispatch_notifications_job():
+    """ RQ job: collect and send the notifications, then schedule the
+    next run """
+    from base import app
+    from base import incursion_tracker
+    from base import planner
+    from dataplan import Fetch
+
+    from rq import get_current_job
+    job = get_current_job()
+    interval = app.config.get('NOTIFY_INTERVAL', 5)
+    start = time.time()
+
+    def system_names(system_ids):
+        ctx = {}
+        planner.fetch([Fetch(
+            'systems', 'get_universe_systems_system_id', many=True,
+            params=[{'system_id': system_id} for system_id in system_ids],
+        )], ctx)
+        return dict(
+            (system.data.system_id, system.data.name)
+            for system in ctx['systems'] if system.status == 200
+        )
+
+    try:
+        dispatcher = dispatcher_from_config(
+            app, job.connection if job is not None else None, system_names,
+        )
+        collected = dispatcher.collect(incursion_tracker)
+        sent = dispatcher.deliver(interval)
+        if collected or any(sent.values()):
+            logger.info("Notifications: %d collected, sent %s" % (collected, sent))
+        return sent
+    finally:
+        # a failed run must not break the chain
+        if job is not None:
+            schedule(job.connection, max(0, interval - (time.time() - start)))
+
+
+def schedule(connection, delay=0):
+    """ (re)schedule the dispatch job, there is only ever one """
+    return schedule_once(connection, dispatch_notifications_job, JOB_ID, delay)
@@ -0,0 +1,370 @@
+# -*- encoding: utf-8 -*-
+""" Background polling of the registered pilots
+
+The online status, location, ship and fleet of every registered pilot
+are polled in the background and saved in CharacterStatus, so the
+roster is fresh without anyone opening a page. Their standings and
+skill points are polled too, rarely, for the standings store
+(standings.py) and the SP history (sphistory.py).
+
+Polling is sharded: every worker pod runs one poller loop
+(`python worker.py poller`, see run_poller), and the pilots are spread
+over the live pollers by consistent hashing (shards.py). A poller keeps
+the tokens, schedule and ESI responses of its own pilots in memory, so
+adding pods adds polling throughput.
+
+Each endpoint of each pilot has its own due time. The interval depends
+on what the pilot is doing:
+
+    offline    the online status is checked every few minutes, the
+               rest rarely
+    online     docked or flying: a medium rate
+    incursion  in a fleet, in a constellation with an incursion: often
+
+and a due time is never before the ESI cache of the last response
+expires, polling sooner would only get the same data again.
+
+A run polls all its due pilots together (PlanRunner.run_many style):
+each pilot gets its own ESI client with its token (client_for), and
+every stage is fetched for the whole batch at once, `threads` requests
+in flight, so a run costs a few round trips whatever its size.
+"""
+from dataplan import DataPlan
+from dataplan import Fetch
+from health import POLLER_HEARTBEAT_KEY
+
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+OFFLINE = 'offline'
+ONLINE = 'online'
+INCURSION = 'incursion'
+
+ENDPOINTS = ('online', 'location', 'ship', 'fleet', 'standings', 'skills')
+
+# seconds between two polls of an endpoint, by pilot state
+DEFAULT_INTERVALS = {
+    OFFLINE: {'online': 300, 'location': 3600, 'ship': 3600, 'fleet': 3600,
+              'standings': 86400, 'skills': 21600},
+    ONLINE: {'online': 60, 'location': 120, 'ship': 300, 'fleet': 120,
+             'standings': 3600, 'skills': 3600},
+    INCURSION: {'online': 60, 'location': 10, 'ship': 30, 'fleet': 10,
+                'standings': 3600, 'skills': 3600},
+}
+
+
+
+def character_params(ctx):
+    return {'character_id': ctx['character_id']}
+
+
+# endpoint -> stages of fetches; later stages resolve the names
+ENDPOINT_FETCHES = {
+    'online': [
+        [Fetch('online', 'get_characters_character_id_online', character_params)],
+    ],
+    'location': [
+        [Fetch('location', 'get_characters_character_id_location', character_params)],
+        [Fetch('location_solar_name', 'get_universe_systems_system_id',
+               lambda ctx: {'system_id': ctx['location'].data.solar_system_id}),
+         Fetch('dock_structure', 'get_universe_structures_structure_id',
+               lambda ctx: {'structure_id': ctx['location'].data.structure_id},
+               when=lambda ctx: ctx['location'].data.structure_id is not None),
+         Fetch('dock_station', 'get_universe_stations_station_id',
+               lambda ctx: {'station_id': ctx['location'].data.station_id},
+               when=lambda ctx: ctx['location'].data.structure_id is None
+                                and ctx['location'].data.station_id is not None)],
+    ],
+    'ship': [
+        [Fetch('ship', 'get_characters_character_id_ship', character_params)],
+        [Fetch('ship_type', 'get_universe_types_type_id',
+               lambda ctx: {'type_id': ctx['ship'].data.ship_type_id})],
+    ],
+    'fleet': [
+        [Fetch('fleet', 'get_characters_character_id_fleet', character_params)],
+    ],
+    'standings': [
+        [Fetch('standings', 'get_characters_character_id_standings', character_params)],
+    ],
+    'skills': [
+        [Fetch('skills', 'get_characters_character_id_skills', character_params)],
+    ],
+}
+
+
+def due_fetch(endpoint, fetch):
+    """ `fetch`, only for the pilots `endpoint` is due for """
+    def when(ctx):
+        if endpoint not in ctx['endpoints']:
+            return False
+        return fetch.when is None or fetch.when(ctx)
+    return Fetch(fetch.key, fetch.op, fetch.params, when=when, many=fetch.many)
+
+
+# stages of the fetches of every endpoint, each gated on the endpoint
+POLL_STAGES = [
+    [
+        due_fetch(endpoint, fetch)
+        for endpoint, stages in ENDPOINT_FETCHES.items() if stage < len(stages)
+        for fetch in stages[stage]
+    ]
+    for stage in range(max(len(stages) for stages in ENDPOINT_FETCHES.values()))
+]
+
+
+def pilot_state(state, incursion_constellations):
+    """ OFFLINE, ONLINE or INCURSION from the last known pilot state """
+    if not state.get('online'):
+        return OFFLINE
+    if state.get('fleet_id') and (
+            state.get('constellation_id') in incursion_constellations):
+        return INCURSION
+    return ONLINE
+
+
+# -----------------------------------------------------------------------
+# Schedule
+# -----------------------------------------------------------------------
+class Schedule(object):
+    """ due times and last known states of the pilots a poller owns """
+    def __init__(self):
+        self.due_at = {}
+        self.states = {}
+
+    def due(self, now, limit):
+        """ (character ID, endpoint) pairs due at `now`, earliest first """
+        due = sorted(
+            (at, member) for member, at in self.due_at.items() if at <= now
+        )
+        return [member for _, member in due[:limit]]
+
+    def set(self, character_id, endpoint, at):
+        self.due_at[character_id, endpoint] = at
+
+    def add(self, character_ids, at):
+        """ schedule every endpoint of new pilots, keep the others """
+        for character_id in character_ids:
+            for endpoint in ENDPOINTS:
+                self.due_at.setdefault((character_id, endpoint), at)
+
+    def remove(self, character_ids):
+        for character_id in character_ids:
+            for endpoint in ENDPOINTS:
+                self.due_at.pop((character_id, endpoint), None)
+            self.states.pop(character_id, None)
+
+    def characters(self):
+        return set(character_id for character_id, _ in self.due_at)
+
+    def state(self, character_id):
+        return dict(self.states.get(character_id) or {})
+
+    def set_state(self, character_id, state):
+        self.states[character_id] = state
+
+
+# -----------------------------------------------------------------------
+# Poller
+# -----------------------------------------------------------------------
+class Poller(object):
+    """ polls the due endpoints of the registered pilots
+
+    planner      PlanRunner, its fetch_many does the ESI calls
+    client_for   callable(User) -> ESI client with that pilot's token
+    status       callable(ctx, endpoints) -> ORM rows to persist
+    incursions   callable() -> constellation IDs with an incursion
+    """
+    def __init__(self, planner, client_for, status, incursions, intervals=None,
+                 batch=200, sync_interval=60):
+        self.planner = planner
+        self.client_for = client_for
+        self.schedule = Schedule()
+        self.users = {}
+        self.synced = 0
+        self.status = status
+        self.incursions = incursions
+        self.intervals = dict(
+            (name, dict(values, **(intervals or {}).get(name, {})))
+            for name, values in DEFAULT_INTERVALS.items()
+        )
+        self.batch = batch
+        self.sync_interval = sync_interval
+        self.plan = DataPlan('poll', None, (), {}, persist=True)
+
+    def sync(self, character_ids, users, now=None, force=False):
+        """ own `character_ids`: schedule the new ones right away, drop the
+        others, and reload their tokens (`users` is callable(IDs) ->
+        {ID: User}); at most every `sync_interval` seconds unless `force` """
+        now = now or time.time()
+        if not force and now - self.synced < self.sync_interval:
+            return False
+        character_ids = set(character_ids)
+        known = self.schedule.characters()
+        self.schedule.add(character_ids - known, now)
+        self.schedule.remove(known - character_ids)
+        # the token refresh job keeps the tokens in the database fresh
+        self.users = users(list(character_ids)) if character_ids else {}
+        self.synced = now
+        return True
+
+    def run(self, now=None):
+        """ poll what is due, returns the number of endpoints polled """
+        now = now or time.time()
+        due = collections.OrderedDict()
+        for character_id, endpoint in self.schedule.due(now, self.batch):
+            due.setdefault(character_id, []).append(endpoint)
+        if not due:
+            return 0
+        ctxs = []
+        for character_id, endpoints in due.items():
+            user = self.users.get(character_id)
+            if user is None:
+                self.schedule.remove([character_id])
+                continue
+            try:
+                client = self.client_for(user)
+            except Exception:
+                logger.exception("Poller: no ESI client for %d" % character_id)
+                continue
+            ctxs.append({
+                'user': user,
+                'character_id': character_id,
+                'endpoints': endpoints,
+                'esiclient': client,
+                'stale_as_of': None,
+                'esi_unavailable': False,
+            })
+        if not ctxs:
+            return 0
+        for fetches in POLL_STAGES:
+            self.planner.fetch_many(fetches, ctxs)
+
+        constellations = self.incursions()
+        rows = []
+        for ctx in ctxs:
+            rows.extend(self.reschedule(ctx, constellations))
+        self.planner.persist(self.plan, rows)
+        return sum(len(ctx['endpoints']) for ctx in ctxs)
+
+    def reschedule(self, ctx, constellations):
+        """ keep what a pilot's poll told and set its next due times;
+        returns the rows to persist """
+        character_id = ctx['character_id']
+        endpoints = ctx['endpoints']
+        state = self.schedule.state(character_id)
+        state.update(self.observe(ctx, endpoints))
+        self.schedule.set_state(character_id, state)
+
+        # a failed poll keeps the last state and is retried on schedule
+        intervals = self.intervals[pilot_state(state, constellations)]
+        now = time.time()
+        for endpoint in endpoints:
+            result = ctx[endpoint]
+            expires = result.expires if result is not None else None
+            self.schedule.set(
+                character_id, endpoint,
+                max(now + intervals[endpoint], expires or 0),
+            )
+        if ctx['esi_unavailable']:
+            return []
+        return self.status(ctx, endpoints)
+
+    @staticmethod
+    def observe(ctx, endpoints):
+        """ the pilot state fields the polled endpoints tell """
+        state = {}
+        if 'online' in endpoints and ctx['online'].status == 200:
+            state['online'] = bool(ctx['online'].data.online)
+        if 'location' in endpoints and ctx['location'].status == 200:
+            system = ctx['location_solar_name']
+            state['system_id'] = ctx['location'].data.solar_system_id
+            state['constellation_id'] = (
+                system.data.constellation_id if system.status == 200 else None
+            )
+        if 'fleet' in endpoints and ctx['fleet'].status in (200, 404):
+            # 404: not in a fleet
+            state['fleet_id'] = (
+                ctx['fleet'].data.fleet_id if ctx['fleet'].status == 200 else None
+            )
+        return state
+
+
+def run_poller(connection, member=None):
+    """ the poller loop of one worker instance: poll the pilots this
+    instance owns on the hash ring of the live instances, every POLL_TICK
+    seconds, until stopped """
+    from base import User
+    from base import app
+    from base import client_for
+    from base import incursion_tracker
+    from base import planner
+    from base import poll_status
+    from dataplan import PlanRunner
+
+    from shards import HashRing
+    from shards import Membership
+
+    tick = app.config.get('POLL_TICK', 5)
+    membership = Membership(
+        connection, member, ttl=app.config.get('POLL_MEMBER_TTL', 30)
+    )
+    # the web planner's caches and stores, with more requests in flight
+    poll_planner = PlanRunner(
+        planner.esiapp, planner.esiclient, planner.sessionmaker,
+        cache=planner.cache, entities=planner.entities, writes=planner.writes,
+        breakers=planner.breakers, threads=app.config.get('POLL_THREADS', 32),
+    )
+    poll_planner.hooks = planner.hooks
+    poller = Poller(
+        poll_planner, client_for, poll_status,
+        lambda: set(
+            incursion['constellation_id']
+            for incursion in incursion_tracker.current()
+        ),
+        intervals=app.config.get('POLL_INTERVALS'),
+        batch=app.config.get('POLL_BATCH', 200),
+    )
+
+    def users(ids):
+        return dict(
+            (user.character_id, user)
+            for user in User.query.filter(User.character_id.in_(ids))
+        )
+
+    ring = HashRing()
+    logger.info("Poller %s started" % membership.member)
+    try:
+        while True:
+            start = time.time()
+            try:
+                members = membership.beat()
+                rebalance = members != ring.members
+                if rebalance:
+                    ring = HashRing(members)
+                with app.app_context():
+                    if rebalance or time.time() - poller.synced >= poller.sync_interval:
+                        registered = [
+                            character_id for (character_id,) in User.query.filter(
+                                User.refresh_token.isnot(None)
+                            ).with_entities(User.character_id)
+                        ]
+                        poller.sync(
+                            ring.share(membership.member, registered), users,
+                            force=True,
+                        )
+                        if rebalance:
+                            logger.info("Poller %s: %d members, owns %d of %d pilots" % (
+                                membership.member, len(members),
+                                len(poller.users), len(registered)))
+                    polled = poller.run()
+                connection.set(POLLER_HEARTBEAT_KEY, time.time())
+                if polled:
+                    logger.debug("Poller: %d endpoints polled" % polled)
+            except Exception:
+                logger.exception("Poller run failed")
+            time.sleep(max(0, tick - (time.time() - start)))
+    finally:
+        membership.leave()
@@ -0,0 +1,248 @@
+# -*- encoding: utf-8 -*-
+""" On-demand request profiler
+
+Admins add `?profile=1` to a page (or `?profile=pyinstrument` /
+`?profile=cprofile` for a full call profile), or a share of all requests
+is sampled with PROFILER_SAMPLE_RATE. A profile is a wall-clock
+breakdown of the request into ESI requests, database statements and
+template rendering. The last PROFILER_RING_SIZE profiles are kept in
+memory and listed on /admin/profiles.
+
+When PROFILER_ENABLED is off nothing is registered at all: no request
+hooks, no SQLAlchemy events, no template signals.
+"""
+from flask import abort
+from flask import before_render_template
+from flask import g
+from flask import jsonify
+from flask import request
+from flask import template_rendered
+
+from flask_login import current_user
+
+from sqlalchemy import event
+
+from dataplan import PlanHook
+
+import collections
+import cProfile
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+
+# longest SQL statement kept in a profile
+STATEMENT_LENGTH = 200
+
+
+class Profile(object):
+    """ timings of a single request """
+    def __init__(self, number, dump=None):
+        self.number = number
+        self.method = request.method
+        self.path = request.full_path
+        self.endpoint = request.endpoint
+        self.character_id = (
+            current_user.character_id if current_user.is_authenticated else None
+        )
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.total = None
+        self.esi = []
+        self.db = []
+        self.templates = []
+        self.dump_kind = dump
+        self.dump = None
+        self._profiler = None
+        self._template_start = None
+
+        if dump == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                self.dump_kind = 'cprofile'
+            else:
+                self._profiler = Profiler()
+                self._profiler.start()
+        if self.dump_kind == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        if self.dump_kind == 'pyinstrument':
+            self._profiler.stop()
+            self.dump = self._profiler.output_text(unicode=True)
+        elif self.dump_kind == 'cprofile':
+            self._profiler.disable()
+            output = io.StringIO()
+            stats = pstats.Stats(self._profiler, stream=output)
+            stats.sort_stats('cumulative').print_stats(50)
+            self.dump = output.getvalue()
+        self._profiler = None
+
+    def summary(self):
+        esi = sum(span[2] for span in self.esi)
+        db = sum(span[1] for span in self.db)
+        templates = sum(span[1] for span in self.templates)
+        return {
+            'number': self.number,
+            'method': self.method,
+            'path': self.path,
+            'endpoint': self.endpoint,
+            'character_id': self.character_id,
+            'started': self.started,
+            'total': self.total,
+            # ESI requests run in parallel, so their sum can exceed total
+            'esi': esi,
+            'esi_requests': len(self.esi),
+            'db': db,
+            'db_statements': len(self.db),
+            'templates': templates,
+            'dump': self.dump_kind,
+        }
+
+    def details(self):
+        details = self.summary()
+        details['esi_spans'] = [
+            {'op': op, 'status': status, 'seconds': seconds}
+            for op, status, seconds in self.esi
+        ]
+        details['db_spans'] = [
+            {'statement': statement, 'seconds': seconds}
+            for statement, seconds in self.db
+        ]
+        details['template_spans'] = [
+            {'template': name, 'seconds': seconds}
+            for name, seconds in self.templates
+        ]
+        details['profile'] = self.dump
+        return details
+
+
+class ProfileHook(PlanHook):
+    """ records the ESI spans of a plan run into a Profile """
+    def __init__(self, profile):
+        self.profile = profile
+
+    def on_request(self, op, response, elapsed):
+        status = response.status if response is not None else 'error'
+        self.profile.esi.append((op, status, elapsed))
+
+
+class RequestProfiler(object):
+    """ Flask extension holding the profile ring buffer """
+    def __init__(self, app=None, engines=()):
+        self.enabled = False
+        self.sample_rate = 0
+        self.admins = ()
+        self.profiles = collections.deque()
+        self._numbers = itertools.count(1)
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app, engines)
+
+    def init_app(self, app, engines=()):
+        self.enabled = app.config.get('PROFILER_ENABLED', False)
+        if not self.enabled:
+            return
+        self.sample_rate = app.config.get('PROFILER_SAMPLE_RATE', 0)
+        self.admins = tuple(app.config.get('PROFILER_ADMINS', ()))
+        self.profiles = collections.deque(
+            maxlen=app.config.get('PROFILER_RING_SIZE', 50)
+        )
+
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+        app.add_url_rule('/admin/profiles', 'admin_profiles', self.list_view)
+        app.add_url_rule(
+            '/admin/profiles/<int:number>', 'admin_profile', self.detail_view
+        )
+
+    def is_admin(self):
+        return (
+            current_user.is_authenticated
+            and current_user.character_id in self.admins
+        )
+
+    @property
+    def current(self):
+        return getattr(self._local, 'profile', None)
+
+    def hooks(self):
+        """ per-run PlanRunner hooks for the current request """
+        profile = self.current
+        if profile is None:
+            return ()
+        return (ProfileHook(profile),)
+
+    # request lifecycle
+    def _start(self):
+        self._local.profile = None
+        wanted = request.args.get('profile')
+        if wanted and self.is_admin():
+            dump = wanted if wanted in ('pyinstrument', 'cprofile') else None
+        elif self.sample_rate and random.random() < self.sample_rate:
+            dump = None
+        else:
+            return
+        self._local.profile = g.profile = Profile(next(self._numbers), dump)
+
+    def _finish(self, exc=None):
+        profile = self.current
+        if profile is None:
+            return
+        self._local.profile = None
+        profile.finish()
+        self.profiles.append(profile)
+
+    # template spans
+    def _before_render(self, sender, template, context, **extra):
+        profile = self.current
+        if profile is not None:
+            profile._template_start = time.perf_counter()
+
+    def _rendered(self, sender, template, context, **extra):
+        profile = self.current
+        if profile is not None and profile._template_start is not None:
+            profile.templates.append(
+                (template.name, time.perf_counter() - profile._template_start)
+            )
+            profile._template_start = None
+
+    # database spans
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        if self.current is not None:
+            conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        profile = self.current
+        if profile is not None and conn.info.get('profiler_start'):
+            start = conn.info['profiler_start'].pop()
+            profile.db.append(
+                (statement[:STATEMENT_LENGTH], time.perf_counter() - start)
+            )
+
+    # admin views
+    def list_view(self):
+        if not self.is_admin():
+            abort(404)
+        return jsonify([profile.summary() for profile in reversed(self.profiles)])
+
+    def detail_view(self, number):
+        if not self.is_admin():
+            abort(404)
+        for profile in self.profiles:
+            if profile.number == number:
+                return jsonify(profile.details())
+        abort(404)
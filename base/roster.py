@@ -0,0 +1,83 @@
+# -*- encoding: utf-8 -*-
+""" Corporation / alliance roster of the registered pilots
+
+One joined query over Characters and CharacterStatus per page, keyset
+paginated on the character ID: the next page starts after the last ID
+of the previous one, so every page is an index range scan on
+(corporation_id, id) or (alliance_id, id), however deep the roster is.
+
+The payload is compact: the field names once, then one list per pilot.
+"""
+import calendar
+
+ROSTER_FIELDS = (
+    'id', 'name', 'online', 'system', 'system_id', 'docked', 'fleet',
+    'ship', 'role', 'last_updated',
+)
+
+
+class Roster(object):
+    """ roster pages of a corporation or alliance """
+    def __init__(self, sessionmaker, characters, status, max_limit=500):
+        self.sessionmaker = sessionmaker
+        self.Characters = characters
+        self.CharacterStatus = status
+        self.max_limit = max_limit
+
+    def page(self, corporation_id=None, alliance_id=None, after=0, limit=200):
+        """ pilots with an ID above `after`, at most `limit` of them
+
+        Returns {'fields': ..., 'rows': ..., 'next': ID or None}, pass
+        'next' as `after` to get the following page.
+        """
+        Characters = self.Characters
+        CharacterStatus = self.CharacterStatus
+        limit = max(1, min(limit, self.max_limit))
+
+        session = self.sessionmaker()
+        try:
+            query = session.query(
+                Characters.id,
+                Characters.name,
+                CharacterStatus.online,
+                CharacterStatus.location,
+                CharacterStatus.system_id,
+                CharacterStatus.docked,
+                CharacterStatus.fleet,
+                CharacterStatus.ship_type,
+                CharacterStatus.role,
+                CharacterStatus.last_updated,
+            ).outerjoin(CharacterStatus, CharacterStatus.id == Characters.id)
+            if alliance_id is not None:
+                query = query.filter(Characters.alliance_id == alliance_id)
+            else:
+                query = query.filter(Characters.corporation_id == corporation_id)
+            rows = query.filter(
+                Characters.id > after
+            ).order_by(Characters.id).limit(limit + 1).all()
+        finally:
+            session.close()
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            'fields': ROSTER_FIELDS,
+            'rows': [self.compact(row) for row in rows],
+            'next': rows[-1].id if more else None,
+        }
+
+    @staticmethod
+    def compact(row):
+        return [
+            row.id,
+            row.name,
+            row.online in ('1', 'True', 'true'),
+            row.location,
+            row.system_id,
+            row.docked if row.docked != "No" else None,
+            row.fleet or None,
+            row.ship_type,
+            row.role,
+            calendar.timegm(row.last_updated.utctimetuple())
+            if row.last_updated is not None else None,
+        ]
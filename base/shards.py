@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+""" Consistent hashing of pilots over poller instances
+
+Every poller instance (one per worker pod) registers itself in a Redis
+sorted set, scored by its last heartbeat. The live members form a hash
+ring with `vnodes` points per member; a pilot belongs to the member
+owning the first point after the hash of its ID. When a member joins or
+leaves (or misses heartbeats for `ttl` seconds) only the pilots of the
+arcs it gains or loses change owner, about 1/N of them.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+MEMBERS_KEY = 'poller:members'
+
+
+def point(value):
+    """ position of `value` on the ring, 64 bits """
+    return int.from_bytes(
+        hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big'
+    )
+
+
+def member_id():
+    """ this instance: the pod name and the pid """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class HashRing(object):
+    """ consistent hash ring of `members` """
+    def __init__(self, members=(), vnodes=128):
+        self.members = tuple(sorted(members))
+        self.vnodes = vnodes
+        ring = sorted(
+            (point('%s#%d' % (member, vnode)), member)
+            for member in self.members for vnode in range(vnodes)
+        )
+        self._points = [position for position, _ in ring]
+        self._owners = [member for _, member in ring]
+
+    def owner(self, key):
+        """ member owning `key`, None on an empty ring """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, point(key)) % len(self._points)
+        return self._owners[index]
+
+    def share(self, member, keys):
+        """ the keys owned by `member` """
+        return [key for key in keys if self.owner(key) == member]
+
+
+class Membership(object):
+    """ heartbeat of one instance in the member set """
+    def __init__(self, connection, member=None, ttl=30):
+        self.redis = connection
+        self.member = member or member_id()
+        self.ttl = ttl
+
+    def beat(self):
+        """ refresh this member, forget the silent ones; returns the live
+        members, sorted """
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(MEMBERS_KEY, {self.member: now})
+        pipe.zremrangebyscore(MEMBERS_KEY, '-inf', now - self.ttl)
+        pipe.zrange(MEMBERS_KEY, 0, -1)
+        members = pipe.execute()[-1]
+        return tuple(sorted(member.decode() for member in members))
+
+    def leave(self):
+        """ hand the pilots over now rather than after `ttl` """
+        try:
+            self.redis.zrem(MEMBERS_KEY, self.member)
+        except Exception:
+            logger.exception("Cannot leave the poller members")
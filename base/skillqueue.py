@@ -0,0 +1,141 @@
+# -*- encoding: utf-8 -*-
+""" Full skill queue
+
+ESI returns the whole queue in one call; what used to be limited was the
+skill names, one /universe/types/ call each. They come from the name
+store (names.py) instead, so a queue of any length costs the queue call
+plus at most one bulk name lookup for skills never seen before.
+
+Each queue is prepared once per ESI response: entries in queue order
+with their name, their own training time and the time the queue reaches
+them. Pages are slices of it, keyset paginated on the queue position,
+in the compact fields + rows form of the other paged payloads.
+"""
+from dataclasses import dataclass
+
+import bisect
+import collections
+import datetime
+import threading
+import time
+
+QUEUE_FIELDS = (
+    'position', 'skill_id', 'name', 'level', 'start', 'finish', 'duration',
+    'finishes_in',
+)
+
+
+@dataclass(frozen=True, slots=True)
+class QueueEntry:
+    position: int
+    skill_id: int
+    name: str
+    level: int
+    start: int = None
+    finish: int = None
+    duration: int = None
+
+
+def timestamp(value):
+    """ unix time of an ESI date-time, None if there is none (paused queue) """
+    if not value:
+        return None
+    try:
+        return int(datetime.datetime.fromisoformat(
+            str(value).replace('Z', '+00:00')
+        ).timestamp())
+    except ValueError:
+        return None
+
+
+class SkillQueue(object):
+    """ prepared queue of one pilot """
+    def __init__(self, entries):
+        self.entries = tuple(entries)
+        self.positions = [entry.position for entry in self.entries]
+        finishes = [entry.finish for entry in self.entries if entry.finish]
+        self.end = max(finishes) if finishes else None
+
+    @classmethod
+    def build(cls, queue, names):
+        """ from the slim skillqueue data and an {ID: name} map """
+        entries = []
+        previous = None
+        for skill in sorted(queue, key=lambda skill: skill.queue_position):
+            start = timestamp(skill.start_date)
+            finish = timestamp(skill.finish_date)
+            duration = None
+            if finish is not None:
+                # an entry starts training when the one before it is done
+                begin = max(start or 0, previous or 0)
+                duration = finish - begin if begin else None
+                previous = finish
+            entries.append(QueueEntry(
+                skill.queue_position, skill.skill_id,
+                names.get(skill.skill_id), skill.finished_level,
+                start, finish, duration,
+            ))
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def row(self, entry, now):
+        return [
+            entry.position, entry.skill_id, entry.name, entry.level,
+            entry.start, entry.finish, entry.duration,
+            max(0, entry.finish - int(now)) if entry.finish is not None else None,
+        ]
+
+    def page(self, after=-1, limit=50, now=None):
+        """ entries with a queue position above `after`, at most `limit`
+
+        Returns {'fields': ..., 'after': ..., 'rows': ..., 'next': position
+        or None, 'total': ..., 'end': unix time the queue is done}; pass
+        'next' as `after` to get the following page.
+        """
+        now = now or time.time()
+        index = bisect.bisect_right(self.positions, after)
+        entries = self.entries[index:index + limit]
+        more = index + limit < len(self.entries)
+        return {
+            'fields': QUEUE_FIELDS,
+            'after': after,
+            'rows': [self.row(entry, now) for entry in entries],
+            'next': entries[-1].position if more else None,
+            'total': len(self.entries),
+            'end': self.end,
+        }
+
+
+class SkillQueues(object):
+    """ prepared queues, kept while their ESI response is the one served
+
+    names  NameStore the skill names come from
+    size   pilots kept (LRU)
+    """
+    def __init__(self, names, size=1024):
+        self.names = names
+        self.size = size
+        self._queues = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, character_id, result):
+        """ the SkillQueue of a skillqueue Result """
+        with self._lock:
+            cached = self._queues.get(character_id)
+            if cached is not None and cached[0] is result:
+                self._queues.move_to_end(character_id)
+                return cached[1]
+        queue = result.data or ()
+        skill_ids = set(skill.skill_id for skill in queue)
+        names = self.names.get(skill_ids)
+        prepared = SkillQueue.build(queue, names)
+        if len(names) == len(skill_ids):
+            # kept once all are named, ESI may name the rest next time
+            with self._lock:
+                self._queues[character_id] = (result, prepared)
+                self._queues.move_to_end(character_id)
+                while len(self._queues) > self.size:
+                    self._queues.popitem(last=False)
+        return prepared
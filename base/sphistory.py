@@ -0,0 +1,367 @@
+# -*- encoding: utf-8 -*-
+""" Skill point history
+
+The skills table only has the last total_sp / unallocated_sp of a pilot.
+Every time they are read from ESI (the skills pages and the poller's
+'skills' endpoint) they are also recorded here as a point (character,
+unix time, total_sp, unallocated_sp) of integers, and only when one of
+them changed since the last point: a pilot not training adds nothing.
+
+Points older than SP_HISTORY_ARCHIVE_DAYS are moved by a daily job
+(archive_sp_history_job) into archive blocks, one row per pilot and run:
+the points delta encoded, as zigzag varints. A point of a pilot training
+steadily packs to a few bytes.
+
+rates() gives the SP/day of many pilots over a window without reading
+their whole history: SP only change at a point, so the SP at any time
+is the last point at or before it, which is one grouped query per CHUNK
+pilots and per end of the window.
+"""
+from sqlalchemy import and_
+from sqlalchemy import func
+
+from jobs import schedule_once
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# pilots per query, below the bound parameter limit of SQLite
+CHUNK = 500
+
+DEFAULT_ARCHIVE_DAYS = 90
+ARCHIVE_INTERVAL = 86400
+JOB_ID = 'sp-history-archive'
+
+POINT_FIELDS = ('at', 'total_sp', 'unallocated_sp')
+RATE_FIELDS = (
+    'character_id', 'from', 'to', 'total_sp_from', 'total_sp', 'sp_gained',
+    'sp_per_day', 'unallocated_sp',
+)
+
+# a shorter span than this gives no rate, it would be mostly noise
+MIN_RATE_SPAN = 3600
+
+
+# -----------------------------------------------------------------------
+# Packing
+# -----------------------------------------------------------------------
+def write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+
+def pack(points):
+    """ bytes of [(at, total_sp, unallocated_sp)], sorted by time: the
+    count, then the deltas to the point before (the first to 0) """
+    out = bytearray()
+    write_varint(out, len(points))
+    previous = (0, 0, 0)
+    for point in points:
+        write_varint(out, point[0] - previous[0])
+        write_varint(out, zigzag(point[1] - previous[1]))
+        write_varint(out, zigzag(point[2] - previous[2]))
+        previous = point
+    return bytes(out)
+
+
+def unpack(data):
+    count, position = read_varint(data, 0)
+    points = []
+    at = total = unallocated = 0
+    for _ in range(count):
+        delta, position = read_varint(data, position)
+        at += delta
+        delta, position = read_varint(data, position)
+        total += unzigzag(delta)
+        delta, position = read_varint(data, position)
+        unallocated += unzigzag(delta)
+        points.append((at, total, unallocated))
+    return points
+
+
+def number(value):
+    """ SP as an int, ESI and the skills table may give strings """
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# -----------------------------------------------------------------------
+# Store
+# -----------------------------------------------------------------------
+class SpHistory(object):
+    """ SP history of the registered pilots
+
+    model        ORM class of the points: character_id, at, total_sp and
+                 unallocated_sp, (character_id, at) primary key
+    archive      ORM class of the archive blocks: character_id, start,
+                 end, count and data (pack() of the points)
+    sessionmaker session factory of both
+    """
+    def __init__(self, model, archive, sessionmaker, chunk=CHUNK):
+        self.model = model
+        self.archive = archive
+        self.sessionmaker = sessionmaker
+        self.chunk = chunk
+        self._last = {}
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------------------------
+    # Writer
+    # -------------------------------------------------------------------
+    def record(self, character_id, total_sp, unallocated_sp, at=None):
+        """ add a point if the SP changed since the last one; returns
+        whether it did """
+        value = (number(total_sp), number(unallocated_sp))
+        last = self._last.get(character_id)
+        if last is None:
+            last = self.last(character_id)
+        if last is not None and last[1:] == value:
+            with self._lock:
+                self._last[character_id] = last
+            return False
+        point = (int(at if at is not None else time.time()),) + value
+        session = self.sessionmaker()
+        try:
+            session.merge(self.model(
+                character_id=character_id, at=point[0],
+                total_sp=point[1], unallocated_sp=point[2],
+            ))
+            session.commit()
+        except Exception:
+            logger.exception("Cannot record the SP of %d" % character_id)
+            session.rollback()
+            return False
+        finally:
+            session.close()
+        with self._lock:
+            self._last[character_id] = point
+        return True
+
+    def last(self, character_id):
+        """ the latest point of a pilot, None if it has none """
+        session = self.sessionmaker()
+        try:
+            return self.at_or_before(session, [character_id], None).get(character_id)
+        finally:
+            session.close()
+
+    def archive_before(self, before):
+        """ move the points older than `before` into archive blocks, one
+        transaction per pilot; returns the number of points moved """
+        Points = self.model
+        session = self.sessionmaker()
+        moved = 0
+        try:
+            character_ids = [character_id for (character_id,) in session.query(
+                Points.character_id
+            ).filter(Points.at < before).distinct()]
+            for character_id in character_ids:
+                points = [tuple(row) for row in session.query(
+                    Points.at, Points.total_sp, Points.unallocated_sp
+                ).filter(
+                    Points.character_id == character_id, Points.at < before
+                ).order_by(Points.at)]
+                try:
+                    session.add(self.archive(
+                        character_id=character_id, start=points[0][0],
+                        end=points[-1][0], count=len(points), data=pack(points),
+                    ))
+                    session.query(Points).filter(
+                        Points.character_id == character_id, Points.at < before
+                    ).delete(synchronize_session=False)
+                    session.commit()
+                except Exception:
+                    logger.exception("Cannot archive the SP history of %d" % character_id)
+                    session.rollback()
+                    continue
+                moved += len(points)
+        finally:
+            session.close()
+        return moved
+
+    # -------------------------------------------------------------------
+    # Readers
+    # -------------------------------------------------------------------
+    def history(self, character_id, since=0, until=None):
+        """ {'fields': POINT_FIELDS, 'rows': [...]} of a pilot, oldest
+        first, archived points included """
+        Points = self.model
+        Archive = self.archive
+        until = until if until is not None else int(time.time())
+        session = self.sessionmaker()
+        try:
+            rows = []
+            for (data,) in session.query(Archive.data).filter(
+                Archive.character_id == character_id,
+                Archive.end >= since, Archive.start <= until,
+            ).order_by(Archive.start):
+                rows.extend(
+                    list(point) for point in unpack(data) if since <= point[0] <= until
+                )
+            rows.extend(list(row) for row in session.query(
+                Points.at, Points.total_sp, Points.unallocated_sp
+            ).filter(
+                Points.character_id == character_id,
+                Points.at >= since, Points.at <= until,
+            ).order_by(Points.at))
+        finally:
+            session.close()
+        return {'fields': POINT_FIELDS, 'rows': rows}
+
+    def rates(self, character_ids, since, until=None):
+        """ SP/day of pilots between `since` and `until` (now)
+
+        The window of a pilot starts at `since`, or at its first point if
+        that is later (a pilot registered since). Returns {'fields':
+        RATE_FIELDS, 'rows': [...], 'unknown': [IDs without points]}.
+        """
+        until = int(until if until is not None else time.time())
+        character_ids = list(dict.fromkeys(int(i) for i in character_ids))
+        rows = []
+        unknown = []
+        session = self.sessionmaker()
+        try:
+            for start in range(0, len(character_ids), self.chunk):
+                chunk = character_ids[start:start + self.chunk]
+                ends = self.at_or_before(session, chunk, until)
+                starts = self.at_or_before(session, list(ends), since)
+                later = [character_id for character_id in ends if character_id not in starts]
+                firsts = self.first_after(session, later, since) if later else {}
+                for character_id in chunk:
+                    end = ends.get(character_id)
+                    if end is None:
+                        unknown.append(character_id)
+                        continue
+                    if character_id in starts:
+                        begin, begin_sp = since, starts[character_id][1]
+                    else:
+                        begin, begin_sp = firsts[character_id][:2]
+                    gained = end[1] - begin_sp
+                    span = until - begin
+                    rows.append([
+                        character_id, begin, until, begin_sp, end[1], gained,
+                        int(gained * 86400 / span) if span >= MIN_RATE_SPAN else None,
+                        end[2],
+                    ])
+        finally:
+            session.close()
+        return {'fields': RATE_FIELDS, 'rows': rows, 'unknown': unknown}
+
+    def at_or_before(self, session, character_ids, at):
+        """ {ID: point} of the latest point of each pilot at or before
+        `at` (None: the latest), archived ones if there is no live one """
+        Points = self.model
+        latest = session.query(
+            Points.character_id, func.max(Points.at).label('at')
+        ).filter(Points.character_id.in_(character_ids))
+        if at is not None:
+            latest = latest.filter(Points.at <= at)
+        points = self.points(session, latest.group_by(Points.character_id).subquery())
+        missing = [character_id for character_id in character_ids if character_id not in points]
+        if missing:
+            Archive = self.archive
+            blocks = session.query(
+                Archive.character_id, func.max(Archive.start).label('start')
+            ).filter(Archive.character_id.in_(missing))
+            if at is not None:
+                blocks = blocks.filter(Archive.start <= at)
+            for character_id, data in self.blocks(session, blocks):
+                found = [point for point in unpack(data) if at is None or point[0] <= at]
+                if found:
+                    points[character_id] = found[-1]
+        return points
+
+    def first_after(self, session, character_ids, at):
+        """ {ID: point} of the earliest point of each pilot after `at` """
+        Archive = self.archive
+        points = {}
+        blocks = session.query(
+            Archive.character_id, func.min(Archive.start).label('start')
+        ).filter(Archive.character_id.in_(character_ids), Archive.end > at)
+        for character_id, data in self.blocks(session, blocks):
+            found = [point for point in unpack(data) if point[0] > at]
+            if found:
+                points[character_id] = found[0]
+        missing = [character_id for character_id in character_ids if character_id not in points]
+        if missing:
+            Points = self.model
+            earliest = session.query(
+                Points.character_id, func.min(Points.at).label('at')
+            ).filter(Points.character_id.in_(missing), Points.at > at)
+            points.update(self.points(
+                session, earliest.group_by(Points.character_id).subquery()
+            ))
+        return points
+
+    def points(self, session, selected):
+        """ {ID: (at, total_sp, unallocated_sp)} of the (character_id, at)
+        rows of a subquery """
+        Points = self.model
+        return dict(
+            (row[0], tuple(row[1:])) for row in session.query(
+                Points.character_id, Points.at, Points.total_sp, Points.unallocated_sp
+            ).join(selected, and_(
+                Points.character_id == selected.c.character_id,
+                Points.at == selected.c.at,
+            ))
+        )
+
+    def blocks(self, session, selected):
+        """ (character_id, data) of the archive blocks a grouped
+        (character_id, start) query selects """
+        Archive = self.archive
+        selected = selected.group_by(Archive.character_id).subquery()
+        return session.query(Archive.character_id, Archive.data).join(selected, and_(
+            Archive.character_id == selected.c.character_id,
+            Archive.start == selected.c.start,
+        ))
+
+
+def archive_sp_history_job():
+    """ RQ job: archive the old SP history points, then schedule the next
+    run a day later """
+    from base import app
+    from base import sp_history
+
+    from rq import get_current_job
+    job = get_current_job()
+    try:
+        days = app.config.get('SP_HISTORY_ARCHIVE_DAYS', DEFAULT_ARCHIVE_DAYS)
+        moved = sp_history.archive_before(int(time.time()) - days * 86400)
+        logger.info("SP history archive: %d points" % moved)
+        return moved
+    finally:
+        # a failed run must not break the chain
+        if job is not None:
+            schedule(job.connection, ARCHIVE_INTERVAL)
+
+
+def schedule(connection, delay=0):
+    """ (re)schedule the archive job, there is only ever one """
+    return schedule_once(connection, archive_sp_history_job, JOB_ID, delay)
@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+""" Standings store and standings filter
+
+The poller refreshes the standings of every registered pilot in the
+background (the 'standings' endpoint, see poller.py) and keeps them in
+the standings table, one row per (character, from_id) with the standing
+in hundredths. Readers never call ESI: filter() checks thousands of
+pilots against standing thresholds with one query per CHUNK pilots.
+
+A pilot without any row has not been refreshed yet, it is reported as
+unknown rather than passed or rejected. A refreshed pilot without any
+standing is kept as a single row from NO_STANDINGS, so it is not.
+"""
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# from_type, integer coded; 0 is a type this code does not know
+FROM_TYPES = ('unknown', 'agent', 'npc_corp', 'faction')
+FROM_TYPE_CODES = dict((name, code) for code, name in enumerate(FROM_TYPES))
+
+# pilots per filter query, below the bound parameter limit of SQLite
+CHUNK = 500
+
+# from_id of the row of a refreshed pilot without standings, no entity
+# has this ID and its standing is neutral
+NO_STANDINGS = 0
+
+# the empires fighting Sansha's Nation: Caldari, Minmatar, Amarr, Gallente
+EMPIRE_FACTIONS = (500001, 500002, 500003, 500004)
+
+# fleet thresholds by default: their faction police attack at -5.0
+DEFAULT_THRESHOLDS = dict((faction, -4.99) for faction in EMPIRE_FACTIONS)
+
+
+def encode(standing):
+    """ stored standing of a float one, in hundredths """
+    return int(round((standing or 0) * 100))
+
+
+class StandingsStore(object):
+    """ standings of the registered pilots
+
+    model        ORM class with character_id, from_id, from_type and
+                 standing columns, (character_id, from_id) primary key
+    sessionmaker session factory of the model's database
+    """
+    def __init__(self, model, sessionmaker, chunk=CHUNK):
+        self.model = model
+        self.sessionmaker = sessionmaker
+        self.chunk = chunk
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    # -------------------------------------------------------------------
+    # Writer (the poller)
+    # -------------------------------------------------------------------
+    def update(self, character_id, standings):
+        """ replace the standings of a pilot with a list of dto.Standing,
+        in one transaction; returns False when nothing changed """
+        rows = sorted(
+            (entry.from_id, FROM_TYPE_CODES.get(entry.from_type, 0),
+             encode(entry.standing))
+            for entry in standings if entry.from_id
+        )
+        digest = hashlib.blake2b(repr(rows).encode(), digest_size=16).digest()
+        if self._digests.get(character_id) == digest:
+            return False
+        session = self.sessionmaker()
+        try:
+            session.query(self.model).filter(
+                self.model.character_id == character_id
+            ).delete(synchronize_session=False)
+            session.add_all([
+                self.model(
+                    character_id=character_id, from_id=from_id,
+                    from_type=from_type, standing=standing,
+                )
+                for from_id, from_type, standing in rows or [(NO_STANDINGS, 0, 0)]
+            ])
+            session.commit()
+        except Exception:
+            logger.exception("Cannot save the standings of %d" % character_id)
+            session.rollback()
+            return False
+        finally:
+            session.close()
+        with self._lock:
+            self._digests[character_id] = digest
+        return True
+
+    # -------------------------------------------------------------------
+    # Readers
+    # -------------------------------------------------------------------
+    def get(self, character_id):
+        """ [{'from_id', 'from_type', 'standing'}, ...] of a pilot """
+        Standings = self.model
+        session = self.sessionmaker()
+        try:
+            rows = session.query(
+                Standings.from_id, Standings.from_type, Standings.standing
+            ).filter(
+                Standings.character_id == character_id,
+                Standings.from_id != NO_STANDINGS,
+            ).order_by(Standings.from_id).all()
+        finally:
+            session.close()
+        return [{
+            'from_id': row.from_id,
+            'from_type': FROM_TYPES[row.from_type or 0],
+            'standing': row.standing / 100.0,
+        } for row in rows]
+
+    def filter(self, character_ids, thresholds):
+        """ split pilots by `thresholds`, {from_id: minimum standing}
+
+        A pilot passes when its standing toward every from_id is at least
+        the minimum; no standing toward one counts as neutral (0). Returns
+        {'allowed': [IDs], 'rejected': {ID: {from_id: standing}},
+        'unknown': [IDs of pilots without standings yet]}.
+        """
+        Standings = self.model
+        minimums = dict(
+            (int(from_id), encode(minimum)) for from_id, minimum in thresholds.items()
+        )
+        character_ids = list(dict.fromkeys(int(i) for i in character_ids))
+        known = set()
+        found = {}
+        session = self.sessionmaker()
+        try:
+            for start in range(0, len(character_ids), self.chunk):
+                chunk = character_ids[start:start + self.chunk]
+                known.update(character_id for (character_id,) in session.query(
+                    Standings.character_id
+                ).filter(Standings.character_id.in_(chunk)).distinct())
+                if not minimums:
+                    continue
+                rows = session.query(
+                    Standings.character_id, Standings.from_id, Standings.standing
+                ).filter(
+                    Standings.character_id.in_(chunk),
+                    Standings.from_id.in_(list(minimums)),
+                )
+                for character_id, from_id, standing in rows:
+                    found.setdefault(character_id, {})[from_id] = standing
+        finally:
+            session.close()
+
+        allowed = []
+        rejected = {}
+        unknown = []
+        for character_id in character_ids:
+            if character_id not in known:
+                unknown.append(character_id)
+                continue
+            standings = found.get(character_id, {})
+            failed = dict(
+                (from_id, standings.get(from_id, 0) / 100.0)
+                for from_id, minimum in minimums.items()
+                if standings.get(from_id, 0) < minimum
+            )
+            if failed:
+                rejected[character_id] = failed
+            else:
+                allowed.append(character_id)
+        return {'allowed': allowed, 'rejected': rejected, 'unknown': unknown}
@@ -0,0 +1,167 @@
+# -*- encoding: utf-8 -*-
+""" Background SSO token refresh
+
+Tokens expiring within TOKEN_REFRESH_WINDOW seconds are refreshed ahead
+of time by an RQ job, so a page view (or a background poll) never has to
+wait for a refresh. The job reschedules itself every
+TOKEN_REFRESH_INTERVAL seconds; run the worker with the scheduler on
+(worker/worker.py does).
+
+A refresh token SSO answers invalid_grant for (revoked by the pilot, or
+the character was transferred) never works again: it is cleared, which
+takes the pilot out of the refresh job and the poller until it logs in
+again, and logged once.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from esipy.exceptions import APIException
+
+from sqlalchemy import bindparam
+from sqlalchemy import update
+
+from jobs import schedule_once
+
+import copy
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# one scheduled refresh job at a time, whoever schedules it
+JOB_ID = 'refresh-expiring-tokens'
+
+
+def revoked(error):
+    """ whether an SSO error says the refresh token is dead for good """
+    response = error.response
+    if isinstance(response, bytes):
+        response = response.decode('utf-8', 'replace')
+    return error.status_code in (400, 401) and 'invalid_grant' in str(response)
+
+
+class TokenRefresher(object):
+    """ refresh expiring tokens with bounded concurrency, write them in
+    one batched UPDATE """
+    def __init__(self, db, user_model, esisecurity, window=300,
+                 concurrency=8):
+        self.db = db
+        self.User = user_model
+        self.esisecurity = esisecurity
+        self.window = window
+        self.concurrency = concurrency
+
+    def expiring(self):
+        """ users whose token expires within the window, uses the
+        access_token_expires index """
+        # same clock as User.update_token stores the expiry with
+        threshold = datetime.fromtimestamp(time.time() + self.window)
+        return self.User.query.filter(
+            self.User.access_token_expires < threshold,
+            self.User.refresh_token.isnot(None),
+        ).all()
+
+    def refresh_one(self, user):
+        """ refresh one user's token, returns the new token columns """
+        # a shallow copy shares the http session, not the token state
+        security = copy.copy(self.esisecurity)
+        security.update_token(user.get_sso_data())
+        try:
+            response = security.refresh()
+        except APIException as e:
+            if revoked(e):
+                logger.warning(
+                    "Refresh token revoked, cleared - uid: %d" % user.character_id
+                )
+                return {'uid': user.character_id, 'revoked': True}
+            logger.exception(
+                "Cannot refresh the token - uid: %d" % user.character_id
+            )
+            return None
+        security.signal_token_updated.send(
+            token_identifier=user.character_id, **response
+        )
+
+        fresh = self.User()
+        fresh.refresh_token = user.refresh_token
+        fresh.update_token(response)
+        return {
+            'uid': user.character_id,
+            'access_token': fresh.access_token,
+            'access_token_expires': fresh.access_token_expires,
+            'refresh_token': fresh.refresh_token,
+        }
+
+    def write(self, rows, revoked=()):
+        """ all refreshed tokens in one executemany UPDATE, the revoked
+        ones cleared in another """
+        if not rows and not revoked:
+            return
+        table = self.User.__table__
+        if rows:
+            self.db.session.execute(
+                update(table)
+                .where(table.c.character_id == bindparam('uid'))
+                .values(
+                    access_token=bindparam('access_token'),
+                    access_token_expires=bindparam('access_token_expires'),
+                    refresh_token=bindparam('refresh_token'),
+                ),
+                rows,
+            )
+        if revoked:
+            self.db.session.execute(
+                update(table)
+                .where(table.c.character_id.in_(list(revoked)))
+                .values(refresh_token=None)
+            )
+        self.db.session.commit()
+
+    def run(self):
+        """ returns (refreshed, failed, revoked) counts """
+        users = self.expiring()
+        if not users:
+            return 0, 0, 0
+        # detach the data we need before handing it to the threads
+        self.db.session.expunge_all()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = [row for row in executor.map(self.refresh_one, users) if row]
+        rows = [row for row in results if not row.get('revoked')]
+        revoked = [row['uid'] for row in results if row.get('revoked')]
+        self.write(rows, revoked)
+        return len(rows), len(users) - len(results), len(revoked)
+
+
+def refresh_tokens_job():
+    """ RQ job: refresh the expiring tokens, then schedule the next run """
+    from base import app
+    from base import db
+    from base import esisecurity
+    from base import User
+
+    refresher = TokenRefresher(
+        db, User, esisecurity,
+        window=app.config.get('TOKEN_REFRESH_WINDOW', 300),
+        concurrency=app.config.get('TOKEN_REFRESH_CONCURRENCY', 8),
+    )
+    from rq import get_current_job
+    job = get_current_job()
+    try:
+        with app.app_context():
+            refreshed, failed, revoked = refresher.run()
+        logger.info(
+            "Token refresh: %d refreshed, %d failed, %d revoked" % (
+                refreshed, failed, revoked)
+        )
+        return refreshed, failed, revoked
+    finally:
+        # a failed run must not break the chain
+        if job is not None:
+            schedule(
+                job.connection, app.config.get('TOKEN_REFRESH_INTERVAL', 60)
+            )
+
+
+def schedule(connection, delay=0):
+    """ (re)schedule the refresh job, there is only ever one """
+    return schedule_once(connection, refresh_tokens_job, JOB_ID, delay)
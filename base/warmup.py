@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+""" Pre-fork warm-up and per-worker memory report
+
+With `gunicorn --preload` the app is imported once in the master: the
+parsed swagger spec, the role tables, the entity store and (after
+warm()) every compiled template are built before the workers fork, so
+the workers share those pages copy-on-write instead of each building
+their own copy. warm() then moves everything into the permanent GC
+generation (gc.freeze), so collections in the workers never write to
+the shared objects' headers and unshare their pages.
+
+Per worker resources (DB connections, the health check thread) are set
+up after the fork, see base.after_fork and gunicorn.conf.py.
+
+    python warmup.py [MASTER_PID]   # RSS / PSS / shared memory per worker
+"""
+import gc
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# fields of /proc/<pid>/smaps_rollup in the memory report, kB
+MEMORY_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty',
+                 'Private_Clean', 'Private_Dirty')
+
+
+def warm(app):
+    """ build what the workers will share, then freeze it; run in the
+    master after the app is imported, before the workers fork """
+    start = time.perf_counter()
+    templates = 0
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+        templates += 1
+    gc.collect()
+    gc.freeze()
+    logger.info(
+        "Warm-up: %d templates compiled, %d objects frozen in %.0f ms" % (
+            templates, gc.get_freeze_count(),
+            (time.perf_counter() - start) * 1000)
+    )
+
+
+def memory(pid='self'):
+    """ memory of a process in kB, keyed by MEMORY_FIELDS """
+    values = {}
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as handle:
+            for line in handle:
+                name, _, rest = line.partition(':')
+                if name in MEMORY_FIELDS:
+                    values[name] = int(rest.split()[0])
+    except (IOError, OSError, ValueError):
+        return values
+    values['Shared'] = values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0)
+    values['Private'] = values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+    return values
+
+
+def children(pid):
+    """ pids of the direct children of `pid` (the gunicorn workers) """
+    pids = []
+    try:
+        for task in os.listdir('/proc/%d/task' % pid):
+            with open('/proc/%d/task/%s/children' % (pid, task)) as handle:
+                pids.extend(int(child) for child in handle.read().split())
+    except (IOError, OSError):
+        pass
+    return pids
+
+
+def report(master_pid):
+    """ lines of a memory table for the master and its workers """
+    yield '%-10s %8s %10s %10s %10s %10s' % (
+        'process', 'pid', 'RSS MB', 'PSS MB', 'shared MB', 'private MB')
+    total = 0
+    for label, pid in [('master', master_pid)] + [
+            ('worker', child) for child in children(master_pid)]:
+        values = memory(pid)
+        total += values.get('Pss', 0)
+        yield '%-10s %8d %10.1f %10.1f %10.1f %10.1f' % (
+            label, pid,
+            values.get('Rss', 0) / 1024.0,
+            values.get('Pss', 0) / 1024.0,
+            values.get('Shared', 0) / 1024.0,
+            values.get('Private', 0) / 1024.0)
+    # PSS splits shared pages between their users, so it adds up
+    yield '%-10s %8s %10s %10.1f' % ('total', '', '', total / 1024.0)
+
+
+if __name__ == '__main__':
+    # gunicorn is PID 1 in the container
+    master = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for line in report(master):
+        print(line)
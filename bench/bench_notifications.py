@@ -0,0 +1,67 @@
+# -*- encoding: utf-8 -*-
+""" Notification dispatch benchmark against the webhook stand-in
+
+Every round publishes EVENTS fleet events and runs one collect + deliver
+cycle of the dispatcher: four webhooks answer right away, one answers
+slower than the dispatcher timeout. The fast ones must get every event,
+in batches, while the slow one only holds its own thread and then backs
+off.
+"""
+import sys
+
+import pytest
+
+from conftest import ROUNDS
+
+EVENTS = 200
+FAST = ('fast-1', 'fast-2', 'fast-3', 'fast-4')
+SLOW_LATENCY = 1.0
+TIMEOUT = 0.25
+
+
+@pytest.fixture(scope='session')
+def webhooks():
+    import webhooks
+    server = webhooks.WebhookServer().start()
+    server.standin.configure('slow', latency=SLOW_LATENCY)
+    yield server
+    server.stop()
+
+
+def bench_dispatch(benchmark, webhooks):
+    import harness
+    if harness.BASE_DIR not in sys.path:
+        sys.path.insert(0, harness.BASE_DIR)
+    import notifications
+
+    hooks = [
+        notifications.Webhook(name, webhooks.hook_url(name), rate=200, batch=10)
+        for name in FAST + ('slow',)
+    ]
+    state = {}
+
+    def setup():
+        if 'dispatcher' in state:
+            state['dispatcher'].close()
+        webhooks.standin.reset()
+        mailbox = notifications.MemoryMailbox()
+        publisher = notifications.Publisher(mailbox)
+        for fleet_id in range(EVENTS):
+            publisher.fleet_formed(fleet_id, 2112000001, 'Bench Pilot')
+        state['dispatcher'] = notifications.Dispatcher(
+            mailbox, hooks, timeout=TIMEOUT, backoff=4,
+        )
+
+    def dispatch():
+        dispatcher = state['dispatcher']
+        dispatcher.collect()
+        state['sent'] = dispatcher.deliver(duration=2)
+
+    benchmark.pedantic(dispatch, setup=setup, rounds=ROUNDS, iterations=1)
+
+    for name in FAST:
+        assert state['sent'][name] == EVENTS
+        assert len(webhooks.standin.received(name)) == EVENTS // 10
+    assert state['sent']['slow'] == 0
+    # the slow webhook did not hold the others back
+    assert benchmark.stats.stats.max < SLOW_LATENCY
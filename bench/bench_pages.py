@@ -0,0 +1,60 @@
+# -*- encoding: utf-8 -*-
+""" Page render benchmarks against the ESI stand-in
+
+cold: the ESI response cache is emptied before every render, so each
+      render pays for all of its ESI calls; the shared entity store
+      (corporations, stations, structures) stays warm, as it does for a
+      new process reading it from the database
+warm: renders served from the ESI response cache (Expires of 300s)
+
+BENCH_ROUNDS, BENCH_ESI_LATENCY and BENCH_ESI_JITTER tune the runs.
+"""
+import pytest
+
+from conftest import ROUNDS
+
+PAGES = ['/', '/main', '/pilot', '/skills', '/implants']
+
+
+def run_page(benchmark, report, base, standin, queries, client, path, name,
+             cold):
+    def render():
+        response = client.get(path)
+        assert response.status_code == 200
+
+    def setup():
+        if cold:
+            base.planner.cache.clear()
+
+    # one untimed render, so imports and connection pools are warm
+    setup()
+    render()
+
+    standin.standin.reset()
+    queries.count = 0
+    benchmark.pedantic(render, setup=setup, rounds=ROUNDS, iterations=1)
+
+    row = report.add(
+        name,
+        benchmark.stats.stats.data,
+        standin.standin.stats()['total'] / float(ROUNDS),
+        queries.count / float(ROUNDS),
+    )
+    benchmark.extra_info.update(row)
+
+
+@pytest.mark.parametrize('path', PAGES)
+def bench_pilot_cold(benchmark, report, base, standin, queries, pilot, path):
+    run_page(benchmark, report, base, standin, queries, pilot, path,
+             'pilot %s cold' % path, cold=True)
+
+
+@pytest.mark.parametrize('path', PAGES)
+def bench_pilot_warm(benchmark, report, base, standin, queries, pilot, path):
+    run_page(benchmark, report, base, standin, queries, pilot, path,
+             'pilot %s warm' % path, cold=False)
+
+
+def bench_guest_index(benchmark, report, base, standin, queries, guest):
+    run_page(benchmark, report, base, standin, queries, guest, '/',
+             'guest / cold', cold=True)
@@ -0,0 +1,73 @@
+# -*- encoding: utf-8 -*-
+# harness (flask, the app) is imported lazily, so a plain `pytest` run
+# from the repository root does not need the app requirements.
+import os
+
+import pytest
+
+ROUNDS = int(os.environ.get('BENCH_ROUNDS', 30))
+ESI_LATENCY = float(os.environ.get('BENCH_ESI_LATENCY', 0))
+ESI_JITTER = float(os.environ.get('BENCH_ESI_JITTER', 0))
+
+report_rows = []
+
+
+@pytest.fixture(scope='session')
+def report():
+    import harness
+    report = harness.Report()
+    report_rows.append(report)
+    return report
+
+
+@pytest.fixture(scope='session')
+def standin():
+    import harness
+    server = harness.StandInServer(
+        latency=ESI_LATENCY, jitter=ESI_JITTER, expires=300,
+    ).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='session')
+def base(standin, tmp_path_factory):
+    import harness
+    return harness.load_base(
+        standin.url, workdir=str(tmp_path_factory.mktemp('bench'))
+    )
+
+
+@pytest.fixture(scope='session')
+def pilot_id(base, standin):
+    import harness
+    return harness.seed_pilots(base, standin.url)[0]
+
+
+@pytest.fixture
+def guest(base):
+    return base.app.test_client()
+
+
+@pytest.fixture
+def pilot(base, pilot_id):
+    client = base.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(pilot_id)
+        session['_fresh'] = True
+    return client
+
+
+@pytest.fixture
+def queries(base):
+    import harness
+    with base.app.app_context():
+        return harness.QueryCounter([base.engine, base.db.engine])
+
+
+def pytest_terminal_summary(terminalreporter):
+    for report in report_rows:
+        if report.rows:
+            terminalreporter.section('pages')
+            for line in report.lines():
+                terminalreporter.write_line(line)
@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+""" Helpers shared by the benchmarks and the load profile
+
+- start the ESI/SSO stand-in in a thread
+- import the app (base/base.py) configured against the stand-in
+- seed registered pilots and forge their flask-login session cookie
+
+    python harness.py seed        # seed pilots into base/config.py's database
+    python harness.py cookie ID   # print a session cookie for a pilot
+"""
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+from werkzeug.serving import make_server
+
+import collections
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import types
+
+import standin as standin_module
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.join(os.path.dirname(HERE), 'base')
+CONFIG_DIST = os.path.join(BASE_DIR, 'config.dist')
+
+
+def fixture_pilots(fixtures=standin_module.DEFAULT_FIXTURES):
+    with open(fixtures) as handle:
+        return json.load(handle)['sso']['characters']
+
+
+class StandInServer(object):
+    """ the stand-in running in a background thread """
+    def __init__(self, host='127.0.0.1', port=0, **options):
+        self.standin = standin_module.StandIn(**options)
+        self.server = make_server(
+            host, port, standin_module.create_app(self.standin), threaded=True
+        )
+        self.url = 'http://%s:%d' % (host, self.server.server_port)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name='esi-standin', daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def load_base(standin_url, workdir=None, **overrides):
+    """ import base.py with config.dist pointed at the stand-in """
+    workdir = workdir or tempfile.mkdtemp(prefix='eve-bench-')
+    config = types.ModuleType('config')
+    with open(CONFIG_DIST) as handle:
+        exec(handle.read(), config.__dict__)
+    config.DEBUG = False
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///%s' % os.path.join(workdir, 'bench.db')
+    config.ESI_SWAGGER_URL = standin_url + '/latest/swagger.json'
+    config.ESI_SSO_URL = standin_url
+    config.ESI_CLIENT_ID = 'bench'
+    config.ESI_SECRET_KEY = 'bench'
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    sys.modules['config'] = config
+
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    import base
+
+    # SQL echo to stdout would drown the benchmark report
+    base.engine.echo = False
+    with base.app.app_context():
+        base.db.create_all()
+    return base
+
+
+def seed_pilots(base, standin_url, pilots=None):
+    """ register the fixture pilots with valid tokens """
+    pilots = pilots or fixture_pilots()
+    with base.app.app_context():
+        for pilot in pilots:
+            user = base.User()
+            user.character_id = pilot['id']
+            user.character_name = pilot['name']
+            user.character_owner_hash = pilot['owner']
+            user.access_token = standin_module.character_token(
+                pilot, 'bench', standin_url
+            )
+            user.access_token_expires = (
+                datetime.datetime.utcnow() + datetime.timedelta(hours=12)
+            )
+            user.refresh_token = 'refresh-%d' % pilot['id']
+            base.db.session.merge(user)
+        base.db.session.commit()
+    return [pilot['id'] for pilot in pilots]
+
+
+def session_cookie(secret_key, character_id):
+    """ a flask-login session cookie value for character_id """
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    return serializer.dumps({'_user_id': str(character_id), '_fresh': True})
+
+
+class QueryCounter(object):
+    """ counts SQL round trips issued by the benchmark thread """
+    def __init__(self, engines):
+        self.count = 0
+        self.thread = threading.get_ident()
+        from sqlalchemy import event
+        for engine in engines:
+            event.listen(engine, 'after_cursor_execute', self._executed)
+
+    def _executed(self, *args):
+        if threading.get_ident() == self.thread:
+            self.count += 1
+
+
+class Report(object):
+    """ p50/p99, ESI calls and DB round trips per benchmarked page """
+    def __init__(self):
+        self.rows = collections.OrderedDict()
+
+    def add(self, name, timings, esi_calls, db_round_trips):
+        timings = sorted(timings)
+        self.rows[name] = {
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'esi_calls': esi_calls,
+            'db_round_trips': db_round_trips,
+        }
+        return self.rows[name]
+
+    def lines(self):
+        yield '%-28s %10s %10s %10s %10s' % (
+            'page', 'p50 ms', 'p99 ms', 'ESI/page', 'DB/page')
+        for name, row in self.rows.items():
+            yield '%-28s %10.1f %10.1f %10.1f %10.1f' % (
+                name, row['p50_ms'], row['p99_ms'], row['esi_calls'],
+                row['db_round_trips'])
+
+
+def percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    index = min(int(round(percent / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'seed':
+        sys.path.insert(0, BASE_DIR)
+        import base
+        import config
+        print(seed_pilots(base, config.ESI_SSO_URL))
+    elif command == 'cookie':
+        sys.path.insert(0, BASE_DIR)
+        import config
+        print(session_cookie(config.SECRET_KEY, int(sys.argv[2])))
+    else:
+        print(__doc__)
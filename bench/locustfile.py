@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+""" Load profile for a running app pointed at the ESI stand-in
+
+    python standin.py --latency 0.08 --jitter 0.04 &
+    # base/config.py: ESI_SWAGGER_URL / ESI_SSO_URL -> the stand-in
+    python harness.py seed
+    locust -f locustfile.py --host http://localhost:5000
+
+Pilots use forged flask-login session cookies (BENCH_SECRET_KEY must be
+the app SECRET_KEY). At the end of the run the ESI calls per page are
+read from the stand-in (BENCH_STANDIN_URL).
+"""
+from locust import HttpUser
+from locust import between
+from locust import events
+from locust import task
+
+import json
+import os
+import urllib.request
+
+import harness
+
+SECRET_KEY = os.environ.get('BENCH_SECRET_KEY', 'YouNeedToChangeThisToBeSecure!')
+STANDIN_URL = os.environ.get('BENCH_STANDIN_URL', 'http://127.0.0.1:5099')
+PILOTS = [pilot['id'] for pilot in harness.fixture_pilots()]
+
+
+class Pilot(HttpUser):
+    """ a registered pilot clicking through the dashboard """
+    weight = 9
+    wait_time = between(1, 5)
+
+    def on_start(self):
+        character_id = PILOTS[id(self) % len(PILOTS)]
+        self.client.cookies.set(
+            'session', harness.session_cookie(SECRET_KEY, character_id)
+        )
+
+    @task(5)
+    def pilot(self):
+        self.client.get('/pilot')
+
+    @task(3)
+    def skills(self):
+        self.client.get('/skills')
+
+    @task(2)
+    def implants(self):
+        self.client.get('/implants')
+
+    @task(2)
+    def main(self):
+        self.client.get('/main')
+
+    @task(1)
+    def index(self):
+        self.client.get('/')
+
+
+class Guest(HttpUser):
+    """ a visitor that is not logged in """
+    weight = 1
+    wait_time = between(2, 10)
+
+    @task
+    def index(self):
+        self.client.get('/')
+
+
+def standin_stats(path='/_standin/stats', method='GET'):
+    request = urllib.request.Request(STANDIN_URL + path, method=method)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+@events.test_start.add_listener
+def reset_standin(environment, **kwargs):
+    try:
+        standin_stats('/_standin/reset', 'POST')
+    except OSError:
+        pass
+
+
+@events.test_stop.add_listener
+def report_esi_calls(environment, **kwargs):
+    try:
+        stats = standin_stats()
+    except OSError:
+        return
+    pages = environment.stats.total.num_requests or 1
+    print('ESI calls: %d for %d pages, %.1f per page' % (
+        stats['total'], pages, stats['total'] / float(pages)))
+    for op, count in sorted(stats['ops'].items()):
+        print('  %-45s %d' % (op, count))
@@ -0,0 +1,517 @@
+# -*- encoding: utf-8 -*-
+""" Local ESI and SSO stand-in
+
+Serves a swagger spec for the ESI operations the app uses, replays
+recorded responses from fixtures/esi.json and answers the EVE SSO
+endpoints (discovery, authorize, token, JWKS) with locally signed JWTs.
+Latency, error rate and the Expires header are configurable, and every
+request is counted on /_standin/stats.
+
+    python standin.py --port 5099 --latency 0.08 --jitter 0.04 --expires 60
+
+With --record https://esi.evetech.net, operations missing from the
+fixtures are forwarded to ESI (with the caller's Authorization header)
+and the responses are saved to the fixtures file.
+"""
+from email.utils import formatdate
+
+from flask import Flask
+from flask import jsonify
+from flask import redirect
+from flask import request
+
+import argparse
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FIXTURES = os.path.join(HERE, 'fixtures', 'esi.json')
+
+# SSO signing key and client, the app config must use the same client id
+SSO_KID = 'JWT-Signature-Key'
+SSO_SECRET = b'bench-standin-signing-key'
+SSO_TOKEN_LIFETIME = 1199
+
+# -----------------------------------------------------------------------
+# Swagger spec of the stand-in
+# -----------------------------------------------------------------------
+I = {'type': 'integer', 'format': 'int32'}
+L = {'type': 'integer', 'format': 'int64'}
+F = {'type': 'number', 'format': 'float'}
+S = {'type': 'string'}
+B = {'type': 'boolean'}
+DT = {'type': 'string', 'format': 'date-time'}
+
+
+def obj(**properties):
+    return {'type': 'object', 'properties': properties}
+
+
+def arr(items):
+    return {'type': 'array', 'items': items}
+
+
+# operationId, method, path, response schema, scope
+OPS = [
+    ('get_status', 'get', '/status/',
+     obj(players=I, server_version=S, start_time=DT), None),
+    ('get_incursions', 'get', '/incursions/',
+     arr(obj(constellation_id=I, faction_id=I, has_boss=B,
+             infested_solar_systems=arr(I), influence=F,
+             staging_solar_system_id=I, state=S, type=S)), None),
+    ('get_characters_character_id', 'get', '/characters/{character_id}/',
+     obj(name=S, corporation_id=I, alliance_id=I, birthday=DT,
+         security_status=F, description=S, gender=S, race_id=I,
+         bloodline_id=I), None),
+    ('get_characters_character_id_online', 'get',
+     '/characters/{character_id}/online/',
+     obj(online=B, last_login=DT, last_logout=DT, logins=I),
+     'esi-location.read_online.v1'),
+    ('get_characters_character_id_location', 'get',
+     '/characters/{character_id}/location/',
+     obj(solar_system_id=I, station_id=I, structure_id=L),
+     'esi-location.read_location.v1'),
+    ('get_characters_character_id_ship', 'get',
+     '/characters/{character_id}/ship/',
+     obj(ship_item_id=L, ship_name=S, ship_type_id=I),
+     'esi-location.read_ship_type.v1'),
+    ('get_characters_character_id_fleet', 'get',
+     '/characters/{character_id}/fleet/',
+     obj(fleet_id=L, role=S, squad_id=L, wing_id=L),
+     'esi-fleets.read_fleet.v1'),
+    ('get_characters_character_id_standings', 'get',
+     '/characters/{character_id}/standings/',
+     arr(obj(from_id=I, from_type=S, standing=F)),
+     'esi-characters.read_standings.v1'),
+    ('get_characters_character_id_implants', 'get',
+     '/characters/{character_id}/implants/', arr(I),
+     'esi-clones.read_implants.v1'),
+    ('get_characters_character_id_skills', 'get',
+     '/characters/{character_id}/skills/',
+     obj(skills=arr(obj(skill_id=I, skillpoints_in_skill=L,
+                        trained_skill_level=I, active_skill_level=I)),
+         total_sp=L, unallocated_sp=I),
+     'esi-skills.read_skills.v1'),
+    ('get_characters_character_id_skillqueue', 'get',
+     '/characters/{character_id}/skillqueue/',
+     arr(obj(skill_id=I, finished_level=I, queue_position=I,
+             start_date=DT, finish_date=DT, training_start_sp=I,
+             level_start_sp=I, level_end_sp=I)),
+     'esi-skills.read_skillqueue.v1'),
+    ('get_corporations_corporation_id', 'get',
+     '/corporations/{corporation_id}/',
+     obj(name=S, ticker=S, member_count=I, url=S, alliance_id=I,
+         ceo_id=I, tax_rate=F), None),
+    ('get_universe_systems_system_id', 'get', '/universe/systems/{system_id}/',
+     obj(system_id=I, name=S, constellation_id=I, security_status=F,
+         star_id=I), None),
+    ('get_universe_stations_station_id', 'get',
+     '/universe/stations/{station_id}/',
+     obj(station_id=I, name=S, system_id=I, type_id=I, owner=I), None),
+    ('get_universe_structures_structure_id', 'get',
+     '/universe/structures/{structure_id}/',
+     obj(name=S, owner_id=I, solar_system_id=I, type_id=I),
+     'esi-universe.read_structures.v1'),
+    ('get_universe_types_type_id', 'get', '/universe/types/{type_id}/',
+     obj(type_id=I, name=S, description=S, group_id=I, published=B), None),
+    ('get_universe_groups_group_id', 'get', '/universe/groups/{group_id}/',
+     obj(group_id=I, name=S, category_id=I, published=B), None),
+    ('post_universe_names', 'post', '/universe/names/',
+     arr(obj(id=I, name=S, category=S)), None),
+    ('get_fleets_fleet_id_wings', 'get', '/fleets/{fleet_id}/wings/',
+     arr(obj(id=L, name=S, squads=arr(obj(id=L, name=S)))),
+     'esi-fleets.read_fleet.v1'),
+    ('post_fleets_fleet_id_members', 'post', '/fleets/{fleet_id}/members/',
+     None, 'esi-fleets.write_fleet.v1'),
+]
+
+# operationId -> its body parameter
+BODY_PARAMS = {
+    'post_universe_names': {'name': 'ids', 'schema': arr(I)},
+    'post_fleets_fleet_id_members': {
+        'name': 'invitation',
+        'schema': obj(character_id=I, role=S, wing_id=L, squad_id=L),
+    },
+}
+
+# operations answering 204 without a body
+NO_CONTENT = ('post_fleets_fleet_id_members',)
+
+# /universe/names/ answers from these fixtures: operationId -> category
+NAME_SOURCES = {
+    'get_characters_character_id': 'character',
+    'get_corporations_corporation_id': 'corporation',
+    'get_universe_systems_system_id': 'solar_system',
+    'get_universe_stations_station_id': 'station',
+    'get_universe_types_type_id': 'inventory_type',
+}
+
+ID_PARAMS = {
+    'structure_id': L,
+    'fleet_id': L,
+}
+
+
+def path_params(path):
+    return [part[1:-1] for part in path.split('/') if part.startswith('{')]
+
+
+def swagger(host):
+    """ the swagger spec, pointing at this stand-in """
+    paths = collections.defaultdict(dict)
+    scopes = {}
+    for op, method, path, schema, scope in OPS:
+        operation = {
+            'operationId': op,
+            'parameters': [
+                dict(name=name, required=True, **{'in': 'path'},
+                     **ID_PARAMS.get(name, I))
+                for name in path_params(path)
+            ],
+            'responses': {
+                '200': {'description': 'ok', 'schema': schema},
+                'default': {'description': 'error', 'schema': obj(error=S)},
+            },
+        }
+        if op in NO_CONTENT:
+            operation['responses'] = {
+                '204': {'description': 'no content'},
+                'default': {'description': 'error', 'schema': obj(error=S)},
+            }
+        if op in BODY_PARAMS:
+            operation['parameters'].append(
+                dict(required=True, **{'in': 'body'}, **BODY_PARAMS[op])
+            )
+        if scope is not None:
+            operation['security'] = [{'evesso': [scope]}]
+            scopes[scope] = scope
+        paths[path][method] = operation
+    return {
+        'swagger': '2.0',
+        'info': {'title': 'ESI stand-in', 'version': '1.0'},
+        'host': host,
+        'basePath': '/latest',
+        'schemes': ['http'],
+        'consumes': ['application/json'],
+        'produces': ['application/json'],
+        'paths': paths,
+        'securityDefinitions': {
+            'evesso': {
+                'type': 'oauth2',
+                'flow': 'implicit',
+                'authorizationUrl': 'http://%s/v2/oauth/authorize' % host,
+                'scopes': scopes,
+            },
+        },
+    }
+
+
+# -----------------------------------------------------------------------
+# Stand-in state
+# -----------------------------------------------------------------------
+class StandIn(object):
+    """ fixtures, behaviour knobs and request counters """
+    def __init__(self, fixtures=DEFAULT_FIXTURES, latency=0.0, jitter=0.0,
+                 error_rate=0.0, expires=60, record=None):
+        self.fixtures_path = fixtures
+        with open(fixtures) as handle:
+            self.fixtures = json.load(handle)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.expires = expires
+        self.record = record
+        self.error_limit = 100
+        self.error_reset = time.time() + 60
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.counts = collections.Counter()
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {'total': sum(counts.values()), 'ops': counts}
+
+    def count(self, op):
+        with self.lock:
+            self.counts[op] += 1
+
+    def lookup(self, op, ids):
+        """ fixture body for op, by the first path parameter """
+        entries = self.fixtures.get(op)
+        if entries is None:
+            return None
+        if ids:
+            body = entries.get(str(ids[0]))
+            if body is not None:
+                return body
+        return entries.get('default')
+
+    def names(self, ids):
+        """ /universe/names/ body for `ids`, None if one of them is
+        unknown (ESI answers 404 then) """
+        known = {}
+        for op, category in NAME_SOURCES.items():
+            for key, body in self.fixtures.get(op, {}).items():
+                if key != 'default' and 'name' in body:
+                    known[int(key)] = {'id': int(key), 'name': body['name'],
+                                       'category': category}
+        if not all(entity_id in known for entity_id in ids or ()):
+            return None
+        return [known[entity_id] for entity_id in ids]
+
+    def save(self, op, ids, body):
+        key = str(ids[0]) if ids else 'default'
+        with self.lock:
+            self.fixtures.setdefault(op, {})[key] = body
+            with open(self.fixtures_path, 'w') as handle:
+                json.dump(self.fixtures, handle, indent=1, sort_keys=True)
+
+    def error_headers(self, failed=False):
+        now = time.time()
+        if now > self.error_reset:
+            self.error_limit = 100
+            self.error_reset = now + 60
+        if failed:
+            self.error_limit = max(self.error_limit - 1, 0)
+        headers = {
+            'X-Esi-Error-Limit-Remain': str(self.error_limit),
+            'X-Esi-Error-Limit-Reset': str(int(self.error_reset - now)),
+        }
+        if self.expires:
+            headers['Expires'] = formatdate(now + self.expires, usegmt=True)
+        return headers
+
+
+# -----------------------------------------------------------------------
+# SSO tokens
+# -----------------------------------------------------------------------
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def sign_jwt(claims):
+    """ HS256 JWT signed with the stand-in key """
+    header = b64(json.dumps(
+        {'alg': 'HS256', 'kid': SSO_KID, 'typ': 'JWT'}
+    ).encode('utf-8'))
+    payload = b64(json.dumps(claims).encode('utf-8'))
+    signature = hmac.new(
+        SSO_SECRET, ('%s.%s' % (header, payload)).encode('ascii'),
+        hashlib.sha256
+    ).digest()
+    return '%s.%s.%s' % (header, payload, b64(signature))
+
+
+def character_token(character, client_id, issuer):
+    now = int(time.time())
+    return sign_jwt({
+        'scp': character.get('scopes', []),
+        'jti': b64(os.urandom(12)),
+        'kid': SSO_KID,
+        'sub': 'CHARACTER:EVE:%d' % character['id'],
+        'azp': client_id,
+        'tenant': 'tranquility',
+        'tier': 'live',
+        'region': 'world',
+        'aud': [client_id, 'EVE Online'],
+        'name': character['name'],
+        'owner': character['owner'],
+        'exp': now + SSO_TOKEN_LIFETIME,
+        'iat': now,
+        'iss': issuer,
+    })
+
+
+# -----------------------------------------------------------------------
+# Flask app
+# -----------------------------------------------------------------------
+def create_app(standin):
+    app = Flask(__name__)
+
+    def handler(op, method):
+        def view(**ids):
+            standin.count(op)
+            if standin.latency or standin.jitter:
+                time.sleep(standin.latency + random.uniform(0, standin.jitter))
+
+            if standin.error_rate and random.random() < standin.error_rate:
+                return (
+                    jsonify({'error': 'stand-in injected error'}), 502,
+                    standin.error_headers(failed=True),
+                )
+
+            values = list(ids.values())
+            if op in NO_CONTENT:
+                return '', 204, standin.error_headers()
+            if op == 'post_universe_names':
+                body = standin.names(request.get_json(silent=True))
+            else:
+                body = standin.lookup(op, values)
+            if body is None and standin.record and method == 'get':
+                body = record(op, values)
+            if body is None:
+                return (
+                    jsonify({'error': 'no fixture for %s %s' % (op, values)}),
+                    404, standin.error_headers(failed=True),
+                )
+            return (
+                app.response_class(json.dumps(body), mimetype='application/json'),
+                200, standin.error_headers(),
+            )
+        view.__name__ = op
+        return view
+
+    def record(op, ids):
+        url = standin.record.rstrip('/') + request.full_path
+        upstream = urllib.request.Request(url, method=request.method)
+        if 'Authorization' in request.headers:
+            upstream.add_header('Authorization', request.headers['Authorization'])
+        try:
+            with urllib.request.urlopen(upstream, timeout=10) as response:
+                body = json.loads(response.read().decode('utf-8'))
+        except urllib.error.URLError:
+            return None
+        standin.save(op, ids, body)
+        return body
+
+    for op, method, path, schema, scope in OPS:
+        rule = '/latest' + path
+        for name in path_params(path):
+            rule = rule.replace('{%s}' % name, '<int:%s>' % name)
+        app.add_url_rule(rule, op, handler(op, method), methods=[method.upper()])
+
+    @app.route('/latest/swagger.json')
+    def swagger_json():
+        return jsonify(swagger(request.host))
+
+    # SSO
+    @app.route('/.well-known/oauth-authorization-server')
+    def sso_discovery():
+        root = request.host_url.rstrip('/')
+        return jsonify({
+            'issuer': root,
+            'authorization_endpoint': root + '/v2/oauth/authorize',
+            'token_endpoint': root + '/v2/oauth/token',
+            'jwks_uri': root + '/oauth/jwks',
+            'revocation_endpoint': root + '/v2/oauth/revoke',
+            'response_types_supported': ['code', 'token'],
+            'subject_types_supported': ['public'],
+            'token_endpoint_auth_signing_alg_values_supported': ['HS256'],
+        })
+
+    @app.route('/oauth/jwks')
+    def sso_jwks():
+        return jsonify({'keys': [{
+            'alg': 'HS256', 'kid': SSO_KID, 'kty': 'oct', 'use': 'sig',
+            'k': b64(SSO_SECRET),
+        }]})
+
+    @app.route('/v2/oauth/authorize')
+    def sso_authorize():
+        """ log in as the first fixture character right away """
+        character = standin.fixtures['sso']['characters'][0]
+        query = urllib.parse.urlencode({
+            'code': 'code-%d' % character['id'],
+            'state': request.args.get('state', ''),
+        })
+        return redirect('%s?%s' % (request.args['redirect_uri'], query))
+
+    @app.route('/v2/oauth/token', methods=['POST'])
+    def sso_token():
+        standin.count('sso_token')
+        grant = request.form.get('grant_type')
+        if grant == 'authorization_code':
+            character_id = int(request.form['code'].split('-')[-1])
+        elif grant == 'refresh_token':
+            character_id = int(request.form['refresh_token'].split('-')[-1])
+        else:
+            return jsonify({'error': 'unsupported_grant_type'}), 400
+        characters = dict(
+            (character['id'], character)
+            for character in standin.fixtures['sso']['characters']
+        )
+        if character_id not in characters:
+            return jsonify({'error': 'invalid_grant'}), 400
+        client_id = request.form.get('client_id') or 'bench'
+        if request.authorization is not None:
+            client_id = request.authorization.username
+        return jsonify({
+            'access_token': character_token(
+                characters[character_id], client_id,
+                request.host_url.rstrip('/'),
+            ),
+            'expires_in': SSO_TOKEN_LIFETIME,
+            'token_type': 'Bearer',
+            'refresh_token': 'refresh-%d' % character_id,
+        })
+
+    @app.route('/v2/oauth/revoke', methods=['POST'])
+    def sso_revoke():
+        return '', 200
+
+    # stand-in control
+    @app.route('/_standin/stats')
+    def standin_stats():
+        return jsonify(standin.stats())
+
+    @app.route('/_standin/reset', methods=['POST'])
+    def standin_reset():
+        standin.reset()
+        return jsonify(standin.stats())
+
+    @app.route('/_standin/config', methods=['POST'])
+    def standin_config():
+        """ change latency, jitter, error_rate or expires at runtime """
+        for name in ('latency', 'jitter', 'error_rate', 'expires'):
+            if name in request.json:
+                setattr(standin, name, float(request.json[name]))
+        return jsonify({
+            'latency': standin.latency,
+            'jitter': standin.jitter,
+            'error_rate': standin.error_rate,
+            'expires': standin.expires,
+        })
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every ESI response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many extra random seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of ESI requests answered with a 502')
+    parser.add_argument('--expires', type=float, default=60,
+                        help='Expires header in seconds, 0 to leave it out')
+    parser.add_argument('--record', default=None,
+                        help='forward fixture misses to this ESI and save them')
+    args = parser.parse_args()
+
+    standin = StandIn(
+        fixtures=args.fixtures, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, expires=args.expires, record=args.record,
+    )
+    create_app(standin).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# -*- encoding: utf-8 -*-
+""" Local webhook stand-in
+
+Takes webhook calls on /hooks/<name> and keeps what it got, so the
+notification dispatcher (base/notifications.py) can be tried without a
+chat server. Each hook can be made slow, failing or rate limited.
+
+    python webhooks.py --port 5098 --latency 0.05
+    # in base/config.py:
+    #   NOTIFY_WEBHOOKS = [{'name': 'fast', 'url': 'http://127.0.0.1:5098/hooks/fast'},
+    #                      {'name': 'slow', 'url': 'http://127.0.0.1:5098/hooks/slow'}]
+    curl -XPOST -H 'Content-Type: application/json' \\
+         -d '{"slow": {"latency": 10}}' http://127.0.0.1:5098/_webhooks/config
+"""
+from flask import Flask
+from flask import jsonify
+from flask import request
+
+from werkzeug.serving import make_server
+
+import argparse
+import collections
+import threading
+import time
+
+
+class WebhookStandIn(object):
+    """ hook behaviour and the calls received
+
+    Per hook options (all optional):
+    latency  seconds before answering
+    status   status code to answer with
+    limit    calls per second before answering 429 with a Retry-After
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.hooks = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = collections.defaultdict(list)
+
+    def configure(self, name, **options):
+        with self.lock:
+            self.hooks[name].update(options)
+
+    def receive(self, name, body):
+        """ returns (status, headers) to answer a call with """
+        options = self.hooks.get(name, {})
+        time.sleep(options.get('latency', self.latency))
+        now = time.time()
+        with self.lock:
+            calls = self.calls[name]
+            limit = options.get('limit')
+            if limit and len([at for at, _, _ in calls if at > now - 1]) >= limit:
+                calls.append((now, 429, body))
+                return 429, {'Retry-After': '1'}
+            status = options.get('status', 204)
+            calls.append((now, status, body))
+        return status, {}
+
+    def received(self, name):
+        """ bodies of the calls answered with success """
+        with self.lock:
+            return [body for _, status, body in self.calls[name] if status < 300]
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                (name, {
+                    'calls': len(calls),
+                    'accepted': len([c for c in calls if c[1] < 300]),
+                })
+                for name, calls in self.calls.items()
+            )
+
+
+def create_app(standin):
+    app = Flask(__name__)
+
+    @app.route('/hooks/<name>', methods=['POST'])
+    def hook(name):
+        status, headers = standin.receive(name, request.get_json(silent=True))
+        return '', status, headers
+
+    @app.route('/_webhooks/stats')
+    def webhooks_stats():
+        return jsonify(standin.stats())
+
+    @app.route('/_webhooks/reset', methods=['POST'])
+    def webhooks_reset():
+        standin.reset()
+        return jsonify(standin.stats())
+
+    @app.route('/_webhooks/config', methods=['POST'])
+    def webhooks_config():
+        for name, options in (request.get_json() or {}).items():
+            standin.configure(name, **options)
+        return jsonify(dict(standin.hooks))
+
+    return app
+
+
+class WebhookServer(object):
+    """ the webhook stand-in running in a background thread """
+    def __init__(self, host='127.0.0.1', port=0, **options):
+        self.standin = WebhookStandIn(**options)
+        self.server = make_server(
+            host, port, create_app(self.standin), threaded=True
+        )
+        self.url = 'http://%s:%d' % (host, self.server.server_port)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name='webhook-standin',
+            daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def hook_url(self, name):
+        return '%s/hooks/%s' % (self.url, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5098)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before answering a webhook call')
+    args = parser.parse_args()
+    standin = WebhookStandIn(latency=args.latency)
+    create_app(standin).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ from esipy import EsiClient
 from esipy import EsiSecurity
 from esipy.exceptions import APIException
 
+from jose import jwt
+from jose.exceptions import JWTError
+
 from flask import Flask
 from flask import redirect
 from flask import request
@@ -22,13 +25,16 @@ from flask_login import logout_user
 
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import or_
+from sqlalchemy import update
 
 import config
 import hashlib
 import hmac
 import logging
 import random
+import requests
+import threading
 import time
 
 # logger stuff
@@ -69,10 +75,12 @@ class User(db.Model, UserMixin):
     )
     character_owner_hash = db.Column(db.String(255))
     character_name = db.Column(db.String(200))
+    # linked characters (alts) share the character ID of the main one
+    account_id = db.Column(db.BigInteger, index=True)
 
     # SSO Token stuff
     access_token = db.Column(db.String(4096))
-    access_token_expires = db.Column(db.DateTime())
+    access_token_expires = db.Column(db.DateTime(), index=True)
     refresh_token = db.Column(db.String(100))
 
     def get_id(self):
@@ -107,17 +115,87 @@ def load_user(character_id):
     """ Required user loader for Flask-Login """
     return User.query.get(character_id)
 
+# -----------------------------------------------------------------------
+# SSO token verification
+# -----------------------------------------------------------------------
+class JwksCache(object):
+    """ EVE SSO signing keys, to verify access tokens locally
+
+    The key set is fetched again every `refresh` seconds, or right away
+    when a token is signed with a key id we do not know yet.
+    """
+    def __init__(self, jwks_uri, issuer, refresh=3600, headers=None):
+        self.jwks_uri = jwks_uri
+        # EVE SSO tokens carry the issuer with or without the scheme
+        self.issuers = (issuer, issuer.split('://')[-1])
+        self.refresh = refresh
+        self.headers = headers or {}
+        self.key_set = {}
+        self.fetched = 0
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        """ download the key set, returns the raw JWKS """
+        res = requests.get(self.jwks_uri, headers=self.headers, timeout=10)
+        res.raise_for_status()
+        jwks = res.json()
+        self.key_set = dict((key['kid'], key) for key in jwks['keys'])
+        self.fetched = time.time()
+        return jwks
+
+    def key(self, kid):
+        stale = time.time() - self.fetched > self.refresh
+        if stale or kid not in self.key_set:
+            with self._lock:
+                if time.time() - self.fetched > self.refresh or kid not in self.key_set:
+                    try:
+                        self.fetch()
+                    except requests.RequestException:
+                        # keep verifying with the keys we have
+                        logger.exception("Cannot refresh the SSO JWKS")
+        if kid not in self.key_set:
+            raise JWTError('Unknown JWT signing key: %s' % kid)
+        return self.key_set[kid]
+
+    def decode(self, token):
+        """ verify the token signature and claims, return the claims """
+        key = self.key(jwt.get_unverified_header(token).get('kid'))
+        return jwt.decode(
+            token,
+            key,
+            algorithms=[key['alg']],
+            issuer=self.issuers,
+            audience='EVE Online',
+        )
+
 # -----------------------------------------------------------------------
 # ESIPY Init
 # -----------------------------------------------------------------------
 # create the app
 esiapp = EsiApp().get_latest_swagger
 
+# EVE SSO endpoints and signing keys, fetched once and shared with esipy
+sso_endpoints = requests.get(
+    '%s/.well-known/oauth-authorization-server' % app.config.get(
+        'ESI_SSO_URL', 'https://login.eveonline.com'
+    ),
+    headers={'User-Agent': config.ESI_USER_AGENT},
+    timeout=10,
+).json()
+jwks = JwksCache(
+    sso_endpoints['jwks_uri'],
+    sso_endpoints['issuer'],
+    refresh=app.config.get('SSO_JWKS_REFRESH', 3600),
+    headers={'User-Agent': config.ESI_USER_AGENT},
+)
+
 # init the security object
 esisecurity = EsiSecurity(
     redirect_uri=config.ESI_CALLBACK,
     client_id=config.ESI_CLIENT_ID,
     secret_key=config.ESI_SECRET_KEY,
+    sso_endpoints=sso_endpoints,
+    jwks_key=jwks.fetch(),
     headers={'User-Agent': config.ESI_USER_AGENT}
 )
 
@@ -142,16 +220,47 @@ def generate_token():
         hashlib.sha256
     ).hexdigest()
 
+SCOPES = ['publicData', 'esi-universe.read_structures.v1', 'esi-location.read_online.v1', 'esi-location.read_location.v1', 'esi-location.read_ship_type.v1', 'esi-skills.read_skills.v1', 'esi-skills.read_skillqueue.v1', 'esi-fleets.read_fleet.v1', 'esi-fleets.write_fleet.v1', 'esi-characters.read_standings.v1', 'esi-clones.read_implants.v1']
+
 @app.route('/sso/login')
 def login():
     """ this redirects the user to the EVE SSO login """
     token = generate_token()
     session['token'] = token
+    session.pop('link', None)
     return redirect(esisecurity.get_auth_uri(
         state=token,
-        scopes=['publicData', 'esi-universe.read_structures.v1', 'esi-location.read_online.v1', 'esi-location.read_location.v1', 'esi-location.read_ship_type.v1', 'esi-skills.read_skills.v1', 'esi-skills.read_skillqueue.v1', 'esi-fleets.read_fleet.v1', 'esi-fleets.write_fleet.v1', 'esi-characters.read_standings.v1', 'esi-clones.read_implants.v1']
+        scopes=SCOPES
     ))
 
+@app.route('/sso/link')
+@login_required
+def link():
+    """ SSO login of another character, linked to the current one as an
+    alt instead of replacing it in the session """
+    token = generate_token()
+    session['token'] = token
+    session['link'] = current_user.character_id
+    return redirect(esisecurity.get_auth_uri(
+        state=token,
+        scopes=SCOPES
+    ))
+
+@app.route('/sso/unlink/<int:character_id>')
+@login_required
+def unlink(character_id):
+    """ remove an alt from the account of the current user """
+    if (current_user.account_id is not None
+            and character_id != current_user.character_id):
+        db.session.execute(
+            update(User)
+            .where(User.character_id == character_id)
+            .where(User.account_id == current_user.account_id)
+            .values(account_id=None)
+        )
+        db.session.commit()
+    return redirect("/alts")
+
 @app.route('/sso/logout')
 @login_required
 def logout():
@@ -176,43 +285,85 @@ def callback():
     except APIException as e:
         return 'Login EVE Online SSO failed: %s' % e, 403
 
-    # we get the character informations
-    cdata = esisecurity.verify()
+    # we get the character informations from the token itself
+    try:
+        cdata = jwks.decode(auth_response['access_token'])
+    except JWTError as e:
+        return 'Login EVE Online SSO failed: %s' % e, 403
+
+    # linking an alt keeps the current user logged in
+    link_to = session.pop('link', None)
+    linking = (
+        link_to is not None and current_user.is_authenticated
+        and current_user.character_id == link_to
+    )
 
     # if the user is already authed, we log him out
-    if current_user.is_authenticated:
+    if current_user.is_authenticated and not linking:
         logout_user()
 
-    # now we check in database, if the user exists
-    # actually we'd have to also check with character_owner_hash, to be
-    # sure the owner is still the same, but that's an example only...
-    try:
-        user = User.query.filter(
-            User.character_id == cdata['sub'].split(':')[2],
-        ).one()
-
-    except NoResultFound:
-        user = User()
-        user.character_id = cdata['sub'].split(':')[2]
-
+    user = User()
+    user.character_id = int(cdata['sub'].split(':')[2])
     user.character_owner_hash = cdata['owner']
     user.character_name = cdata['name']
     user.update_token(auth_response)
 
-    # now the user is ready, so update/create it and log the user
     try:
-        db.session.merge(user)
+        # known character, same owner and name: only the tokens change,
+        # in a single UPDATE without loading the row first
+        tokens = {
+            'access_token': user.access_token,
+            'access_token_expires': user.access_token_expires,
+        }
+        if user.refresh_token is not None:
+            tokens['refresh_token'] = user.refresh_token
+        result = db.session.execute(
+            update(User)
+            .where(User.character_id == user.character_id)
+            .where(User.character_owner_hash == user.character_owner_hash)
+            .where(User.character_name == user.character_name)
+            .values(**tokens)
+        )
+
+        # new character, or it changed owner or name: update/create it
+        if result.rowcount != 1:
+            known = db.session.get(User, user.character_id)
+            if known is not None and known.character_owner_hash != user.character_owner_hash:
+                # sold character, no longer an alt of its old account
+                user.account_id = None
+            user = db.session.merge(user)
+
+        if linking:
+            link_account(current_user, user.character_id)
         db.session.commit()
 
+        if linking:
+            return redirect("/alts")
         login_user(user)
         session.permanent = True
 
     except:
         logger.exception("Cannot login the user - uid: %d" % user.character_id)
         db.session.rollback()
-        logout_user()
+        if not linking:
+            logout_user()
 
     return redirect("/")
 
+def link_account(main, character_id):
+    """ put `character_id`, and the alts already linked to it, in the
+    account of `main` """
+    if character_id == main.character_id:
+        return
+    account_id = main.account_id or main.character_id
+    db.session.execute(
+        update(User)
+        .where(or_(
+            User.character_id.in_([main.character_id, character_id]),
+            User.account_id == character_id,
+        ))
+        .values(account_id=account_id)
+    )
+
 if __name__ == '__main__':
     app.run(port=config.PORT, host=config.HOST)
@@ -1,7 +1,8 @@
 import os
+import sys
 
 import redis
-from rq import Worker, Queue, Connection
+from rq import SimpleWorker, Queue
 
 listen = ['default']
 
@@ -9,8 +10,35 @@ redis_url = os.getenv('REDIS_URL', 'redis://lab-6:6379')
 
 conn = redis.from_url(redis_url)
 
+# jobs like tokens.refresh_tokens_job live next to the app
+base_dir = os.getenv(
+    'BASE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'base'),
+)
+if os.path.isdir(base_dir):
+    sys.path.insert(0, base_dir)
+
 if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(list(map(Queue, listen)))
-        worker.work()
-        
\ No newline at end of file
+    if sys.argv[1:] == ['poller']:
+        # one sharded pilot poller per pod, next to the RQ worker
+        import poller
+        poller.run_poller(conn)
+        sys.exit(0)
+
+    if os.path.isdir(base_dir):
+        import incursions
+        import notifications
+        import sphistory
+        import tokens
+        incursions.schedule(conn)
+        notifications.schedule(conn)
+        sphistory.schedule(conn)
+        tokens.schedule(conn)
+
+    # jobs run in this process, not a fork per job: what they keep from
+    # one run to the next (the notification dispatcher's HTTP session and
+    # threads, the ESI caches) lives as long as the worker
+    worker = SimpleWorker([Queue(name, connection=conn) for name in listen], connection=conn)
+    # the scheduler runs the enqueue_in jobs (token refresh, incursions,
+    # notifications, SP history archive)
+    worker.work(with_scheduler=True)